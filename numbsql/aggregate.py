@@ -1,25 +1,41 @@
 from __future__ import annotations
 
+import functools
+import inspect
 import typing
-from typing import Tuple, Type
+from typing import Any, Callable, Optional, Tuple, Type, Union, overload
 
-from numba import cfunc, types, void
+from numba import types, void
+from numba.core.typing.templates import Signature
 from numba.types import CPointer, intc, voidptr
 
+from .cache import fingerprint, trampoline
+from .compiler import defer
 from .exceptions import UnsupportedAggregateTypeError
 from .numbaext import (
+    AGGREGATE_CONTEXT_HEADER_SIZE,
+    AGGREGATE_NULL_POLICIES,
+    accepts_return_type,
+    call_or_fail,
     init,
+    is_blob_type,
+    is_datetime_type,
+    is_heap_type,
     is_not_null_pointer,
     make_arg_tuple,
+    null_error,
     python_type_hints_to_numba_signature,
-    reset_init,
+    release_state,
     sizeof,
-    sqlite3_result,
+    sqlite3_aggregate_context,
+    sqlite3_result_error,
+    sqlite3_result_of,
+    state_size,
     unsafe_cast,
 )
-from .sqlite import sqlite3_aggregate_context, sqlite3_result_null, sqlite3_user_data
 
 _SUPPORTED_AGGREGATE_TYPES: Tuple[types.Type, ...] = (
+    types.boolean,
     types.uint8,
     types.uint16,
     types.uint32,
@@ -34,62 +50,123 @@ _SUPPORTED_AGGREGATE_TYPES: Tuple[types.Type, ...] = (
 _SUPPORTED_AGGREGATE_TYPES += tuple(map(types.optional, _SUPPORTED_AGGREGATE_TYPES))
 
 
-def sqlite_udaf(cls: Type) -> Type:
-    """Define a custom aggregate function."""
+@overload
+def sqlite_udaf(
+    cls: None = None,
+    *,
+    cache: bool = False,
+    lazy: bool = False,
+    max_memory: Optional[int] = None,
+    null_policy: str = "error",
+) -> Callable[[Type], Type]: ...
+
+
+@overload
+def sqlite_udaf(
+    cls: Type,
+    *,
+    cache: bool = False,
+    lazy: bool = False,
+    max_memory: Optional[int] = None,
+    null_policy: str = "error",
+) -> Type: ...
+
+
+def sqlite_udaf(
+    cls: Optional[Type] = None,
+    *,
+    cache: bool = False,
+    lazy: bool = False,
+    max_memory: Optional[int] = None,
+    null_policy: str = "error",
+) -> Union[Type, Callable[[Type], Type]]:
+    """Define a custom aggregate function.
+
+    Parameters
+    ----------
+    cls
+        A `jitclass`-decorated class with `__init__`, `step` and `finalize`
+        methods, and optionally `value` and `inverse` methods for use as a
+        window function. An optional `merge(self, other)` method adds the
+        state of `other`, another instance of the class, to this instance's,
+        so that partitions of the input can be aggregated separately with
+        `numbsql.parallel.parallel_aggregate` or
+        `numbsql.parallel.aggregate_partitions`.
+    cache
+        Whether to cache the compiled methods on disk. Later processes
+        defining the same aggregate load the compiled code from the cache
+        instead of compiling it.
+    lazy
+        Whether to defer compilation until the aggregate is registered with
+        `create_aggregate` or passed to `warmup`.
+    max_memory
+        The most memory, in bytes, that the strings, lists and dicts in the
+        state of a single group may hold. The query fails once a call to
+        `step` goes over the limit. Sizes are approximate: they count the
+        characters, items, keys and values, but not numba's bookkeeping.
+    null_policy
+        What to do when a NULL is passed to an argument of `step` or `inverse`
+        that isn't optional: ``"error"`` fails the query, and ``"skip_row"``
+        leaves the row out of the aggregate.
+
+    Notes
+    -----
+    Fields can be scalars, datetimes, timedeltas, fixed-size arrays declared
+    with `numba.types.NestedArray`, strings, `numba.typed.List` objects and
+    `numba.typed.Dict` objects. Strings, lists and dicts are released once
+    `finalize` returns.
+
+    Exceptions raised by the methods fail the query with a `sqlite3.Error`.
+    """
+    if cls is None:
+
+        def decorator(cls: Type) -> Type:
+            return sqlite_udaf(
+                cls,
+                cache=cache,
+                lazy=lazy,
+                max_memory=max_memory,
+                null_policy=null_policy,
+            )
+
+        return decorator
+
+    if null_policy not in AGGREGATE_NULL_POLICIES:
+        raise ValueError(
+            f"`{null_policy}` isn't a NULL policy of aggregates, expected one of "
+            f"{list(AGGREGATE_NULL_POLICIES)}"
+        )
 
     class_type = cls.class_type
     for field, typ in class_type.struct.items():
-        if typ not in _SUPPORTED_AGGREGATE_TYPES:
+        # fixed-size arrays are stored inline, after the other fields
+        element_type = typ.dtype if isinstance(typ, types.NestedArray) else typ
+        if not (
+            element_type in _SUPPORTED_AGGREGATE_TYPES
+            or is_datetime_type(element_type)
+            or is_heap_type(typ)
+        ):
             raise UnsupportedAggregateTypeError(typ)
 
     instance_type = class_type.instance_type
 
     init_func = class_type.jit_methods["__init__"]
     init_signature = python_type_hints_to_numba_signature(
-        typing.get_type_hints(class_type.methods["__init__"]), self_type=instance_type
+        typing.get_type_hints(class_type.methods["__init__"], include_extras=True),
+        self_type=instance_type,
     )
-    init_func.compile(init_signature)
 
     step_func = class_type.jit_methods["step"]
     step_signature = python_type_hints_to_numba_signature(
-        typing.get_type_hints(class_type.methods["step"]),
+        typing.get_type_hints(class_type.methods["step"], include_extras=True),
         self_type=instance_type,
     )
-    step_func.compile(step_signature)
-
-    @cfunc(void(voidptr, intc, CPointer(voidptr)))  # type: ignore[misc]
-    def step(  # type: ignore[no-untyped-def]
-        ctx, argc: int, argv
-    ) -> None:  # pragma: no cover
-        raw_pointer = sqlite3_aggregate_context(ctx, sizeof(cls))
-
-        if is_not_null_pointer(raw_pointer):
-            agg_ctx = unsafe_cast(raw_pointer, cls)
-            is_initialized = sqlite3_user_data(ctx)
-            init(agg_ctx, is_initialized)
-            args = make_arg_tuple(step_func, argv)
-            agg_ctx.step(*args)
 
     finalize_func = class_type.jit_methods["finalize"]
     finalize_signature = python_type_hints_to_numba_signature(
-        typing.get_type_hints(class_type.methods["finalize"]), self_type=instance_type
+        typing.get_type_hints(class_type.methods["finalize"], include_extras=True),
+        self_type=instance_type,
     )
-    finalize_func.compile(finalize_signature)
-
-    @cfunc(void(voidptr))  # type: ignore[misc]
-    def finalize(ctx) -> None:  # type: ignore[no-untyped-def]  # pragma: no cover
-        raw_pointer = sqlite3_aggregate_context(ctx, 0)
-        if is_not_null_pointer(raw_pointer):
-            agg_ctx = unsafe_cast(raw_pointer, cls)
-            result = agg_ctx.finalize()
-
-            if result is None:
-                sqlite3_result_null(ctx)
-            else:
-                sqlite3_result(ctx, result)
-
-            is_initialized = sqlite3_user_data(ctx)
-            reset_init(is_initialized)
 
     try:
         value_func = class_type.jit_methods["value"]
@@ -107,39 +184,171 @@ def sqlite_udaf(cls: Type) -> Type:
 
     is_window_function = has_value_func and has_inverse_func
 
-    if is_window_function:
-        # aggregates can always return a NULL value
-        value_signature = finalize_signature
-        value_func.compile(value_signature)
+    merge_func = class_type.jit_methods.get("merge")
+    if merge_func is not None:
+        merge_parameters = inspect.signature(class_type.methods["merge"]).parameters
+        if len(merge_parameters) != 2:
+            raise TypeError(
+                f"`{cls.__name__}.merge` must take exactly one argument besides "
+                f"`self`, got {len(merge_parameters) - 1}"
+            )
 
-        @cfunc(void(voidptr))  # type: ignore[misc]
-        def value(ctx) -> None:  # type: ignore[no-untyped-def]  # pragma: no cover
-            raw_pointer = sqlite3_aggregate_context(ctx, 0)
-            if is_not_null_pointer(raw_pointer):
-                agg_ctx = unsafe_cast(raw_pointer, cls)
-                result = agg_ctx.value()
-                if result is None:
-                    sqlite3_result_null(ctx)
-                else:
-                    sqlite3_result(ctx, result)
-
-        inverse_signature = step_signature
-        inverse_func.compile(inverse_signature)
-
-        @cfunc(void(voidptr, intc, CPointer(voidptr)))  # type: ignore[misc,]
-        def inverse(  # type: ignore[no-untyped-def]
+    # aggregates can always return a NULL value
+    value_signature = finalize_signature
+    inverse_signature = step_signature
+
+    def compile_result_method(method: Any, signature: Signature) -> None:
+        declared_type = signature.return_type
+        if not is_blob_type(declared_type):
+            method.compile(signature)
+            return
+
+        # have numba infer the exact type of arrays, which are only declared
+        # by their dtype
+        method.compile(signature.args)
+        for compiled_signature in method.nopython_signatures:
+            return_type = compiled_signature.return_type
+            if not accepts_return_type(declared_type, return_type):
+                raise TypeError(
+                    f"`{cls.__name__}.{method.py_func.__name__}` returns "
+                    f"`{return_type}`, expected `{declared_type}`"
+                )
+
+    def compile_methods() -> None:
+        init_func.compile(init_signature)
+        step_func.compile(step_signature)
+        compile_result_method(finalize_func, finalize_signature)
+
+        if is_window_function:
+            compile_result_method(value_func, value_signature)
+            inverse_func.compile(inverse_signature)
+
+        if merge_func is not None:
+            merge_func.compile((instance_type, instance_type))
+            for compiled_signature in merge_func.nopython_signatures:
+                return_type = compiled_signature.return_type
+                if return_type != types.none:
+                    raise TypeError(
+                        f"`{cls.__name__}.merge` returns `{return_type}`, "
+                        "expected `none`"
+                    )
+
+    # the instance type's name contains its address, so leave it out of the
+    # method signatures
+    udaf_fingerprint = functools.partial(
+        fingerprint,
+        cls.__module__,
+        cls.__qualname__,
+        sorted(class_type.struct.items()),
+        *(method for _, method in sorted(class_type.methods.items())),
+        step_signature.args[1:],
+        finalize_signature.return_type,
+        max_memory,
+        null_policy,
+    )
+
+    # numba can't compile comparisons with an optional limit
+    memory_limit = -1 if max_memory is None else max_memory
+    memory_limit_error = (
+        f"the state of aggregate `{cls.__name__}` takes more than {max_memory} bytes"
+    )
+    fail_on_null = null_policy == "error"
+    step_null_error = null_error(f"{cls.__name__}.step")
+    inverse_null_error = null_error(f"{cls.__name__}.inverse")
+
+    def compile_udaf(cache: bool = cache) -> None:
+        @trampoline(  # type: ignore[misc]
+            void(voidptr, intc, CPointer(voidptr)),
+            fingerprint=udaf_fingerprint("step"),
+            cache=cache,
+            prepare=compile_methods,
+        )
+        def step(  # type: ignore[no-untyped-def]
             ctx, argc: int, argv
         ) -> None:  # pragma: no cover
-            raw_pointer = sqlite3_aggregate_context(ctx, sizeof(cls))
+            # every aggregate context tracks whether its own state has been
+            # constructed, in a header that SQLite zero-fills, so that
+            # contexts of the same function can be live at the same time
+            raw_pointer = sqlite3_aggregate_context(
+                ctx, AGGREGATE_CONTEXT_HEADER_SIZE + sizeof(cls)
+            )
+
             if is_not_null_pointer(raw_pointer):
-                agg_ctx = unsafe_cast(raw_pointer, cls)
-                args = make_arg_tuple(inverse_func, argv)
-                agg_ctx.inverse(*args)
+                agg_ctx = unsafe_cast(raw_pointer + AGGREGATE_CONTEXT_HEADER_SIZE, cls)
+                init(agg_ctx, raw_pointer)
+                missing, args = make_arg_tuple(step_func, argv)
+                if missing:
+                    if fail_on_null:
+                        sqlite3_result_error(ctx, step_null_error)
+                elif not call_or_fail(ctx, step_func, (agg_ctx,) + args):
+                    if memory_limit >= 0 and state_size(agg_ctx) > memory_limit:
+                        sqlite3_result_error(ctx, memory_limit_error)
+
+        @trampoline(  # type: ignore[misc]
+            void(voidptr),
+            fingerprint=udaf_fingerprint("finalize"),
+            cache=cache,
+            prepare=compile_methods,
+        )
+        def finalize(ctx) -> None:  # type: ignore[no-untyped-def]  # pragma: no cover
+            raw_pointer = sqlite3_aggregate_context(ctx, 0)
+            if is_not_null_pointer(raw_pointer):
+                agg_ctx = unsafe_cast(raw_pointer + AGGREGATE_CONTEXT_HEADER_SIZE, cls)
+                sqlite3_result_of(ctx, finalize_func, (agg_ctx,))
+
+                # SQLite calls finalize exactly once for every group, even
+                # when the query fails, and frees the context afterwards
+                release_state(agg_ctx)
+
+        if is_window_function:
+
+            @trampoline(  # type: ignore[misc]
+                void(voidptr),
+                fingerprint=udaf_fingerprint("value"),
+                cache=cache,
+                prepare=compile_methods,
+            )
+            def value(ctx) -> None:  # type: ignore[no-untyped-def]  # pragma: no cover
+                raw_pointer = sqlite3_aggregate_context(ctx, 0)
+                if is_not_null_pointer(raw_pointer):
+                    agg_ctx = unsafe_cast(
+                        raw_pointer + AGGREGATE_CONTEXT_HEADER_SIZE, cls
+                    )
+                    sqlite3_result_of(ctx, value_func, (agg_ctx,))
+
+            @trampoline(  # type: ignore[misc]
+                void(voidptr, intc, CPointer(voidptr)),
+                fingerprint=udaf_fingerprint("inverse"),
+                cache=cache,
+                prepare=compile_methods,
+            )
+            def inverse(  # type: ignore[no-untyped-def]
+                ctx, argc: int, argv
+            ) -> None:  # pragma: no cover
+                raw_pointer = sqlite3_aggregate_context(
+                    ctx, AGGREGATE_CONTEXT_HEADER_SIZE + sizeof(cls)
+                )
+                if is_not_null_pointer(raw_pointer):
+                    agg_ctx = unsafe_cast(
+                        raw_pointer + AGGREGATE_CONTEXT_HEADER_SIZE, cls
+                    )
+                    missing, args = make_arg_tuple(inverse_func, argv)
+                    if missing:
+                        if fail_on_null:
+                            sqlite3_result_error(ctx, inverse_null_error)
+                    else:
+                        call_or_fail(ctx, inverse_func, (agg_ctx,) + args)
+
+        cls.step.address = step.address
+        cls.step.trampoline = step
+        cls.finalize.address = finalize.address
+        cls.finalize.trampoline = finalize
 
-    cls.step.address = step.address
-    cls.finalize.address = finalize.address
+        if is_window_function:
+            cls.value.address = value.address
+            cls.value.trampoline = value
+            cls.inverse.address = inverse.address
+            cls.inverse.trampoline = inverse
 
-    if is_window_function:
-        cls.value.address = value.address
-        cls.inverse.address = inverse.address
+    defer(cls, compile_udaf, lazy=lazy)
     return cls
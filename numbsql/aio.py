@@ -0,0 +1,232 @@
+"""Query SQLite from asyncio without blocking the event loop.
+
+`AsyncConnection` runs every operation of a connection on a thread of its
+own. The `sqlite3` module releases the GIL while SQLite runs a statement, and
+the functions numbsql compiles don't take it back, so the event loop keeps
+serving other tasks while a query that calls them runs.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import concurrent.futures
+import os
+import sqlite3
+import threading
+from types import TracebackType
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Type,
+    TypeVar,
+    Union,
+)
+
+import numpy as np
+
+from .interrupt import InterruptState, interrupt_state
+from .register import UDFs, create_functions
+
+T = TypeVar("T")
+
+
+def _fetchall(
+    con: sqlite3.Connection, sql: str, parameters: Sequence[Any]
+) -> List[Tuple[Any, ...]]:
+    return con.execute(sql, parameters).fetchall()
+
+
+def _array(values: Sequence[Any]) -> np.ndarray:
+    # SQLite columns aren't typed, so only convert columns of numbers of a
+    # single type: NumPy's fixed-width strings and bytes would drop trailing
+    # NUL characters
+    kinds = set(map(type, values))
+    if len(kinds) > 1 or not kinds <= {int, float}:
+        return np.array(values, dtype=object)
+    return np.array(values)
+
+
+def _fetch_numpy(
+    con: sqlite3.Connection, sql: str, parameters: Sequence[Any]
+) -> Dict[str, np.ndarray]:
+    cursor = con.execute(sql, parameters)
+    names = [name for name, *_ in cursor.description]
+    rows = cursor.fetchall()
+    columns = zip(*rows) if rows else (() for _ in names)
+    return {name: _array(column) for name, column in zip(names, columns)}
+
+
+class _Call:
+    __slots__ = ("cancelled", "running")
+
+    def __init__(self) -> None:
+        self.cancelled = False
+        self.running = False
+
+
+class AsyncConnection:
+    """A SQLite connection whose operations run on a thread of its own.
+
+    Create one with `connect`. Cancelling a call that's waiting for earlier
+    calls to finish drops it, and cancelling a call that's running interrupts
+    its statement, along with any function of the connection that checks
+    `check_interrupt`.
+
+    Examples
+    --------
+    >>> import asyncio
+    >>> from numbsql import sqlite_udf
+    >>> @sqlite_udf
+    ... def add_one(x: int) -> int:
+    ...     return x + 1
+    ...
+    >>> async def main():
+    ...     async with await AsyncConnection.connect(
+    ...         ":memory:", functions=[add_one]
+    ...     ) as con:
+    ...         return await con.fetchall("SELECT add_one(?)", (41,))
+    ...
+    >>> asyncio.run(main())
+    [(42,)]
+    """
+
+    def __init__(
+        self,
+        con: sqlite3.Connection,
+        executor: concurrent.futures.Executor,
+        interrupt: InterruptState,
+    ) -> None:
+        self._con = con
+        self._executor = executor
+        self._interrupt = interrupt
+        # guards the state of calls
+        self._lock = threading.Lock()
+
+    @classmethod
+    async def connect(
+        cls,
+        database: Union[str, os.PathLike[str]],
+        *,
+        functions: UDFs = (),
+        **kwargs: Any,
+    ) -> AsyncConnection:
+        """Connect to `database` and register `functions` with the connection.
+
+        Parameters
+        ----------
+        database : str or os.PathLike
+            The database to connect to
+        functions : module, mapping or iterable
+            The `sqlite_udf` functions and `sqlite_udaf` classes to register:
+            a module's functions, a mapping of names to functions, or
+            functions registered under their own names
+        kwargs
+            Passed to `sqlite3.connect`
+        """
+        executor = concurrent.futures.ThreadPoolExecutor(
+            1, thread_name_prefix="numbsql"
+        )
+
+        def connect() -> Tuple[sqlite3.Connection, InterruptState]:
+            con = sqlite3.connect(database, **kwargs)
+            try:
+                interrupt = interrupt_state(con)
+                create_functions(con, functions)
+            except BaseException:
+                con.close()
+                raise
+            return con, interrupt
+
+        loop = asyncio.get_running_loop()
+        try:
+            con, interrupt = await loop.run_in_executor(executor, connect)
+        except BaseException:
+            executor.shutdown(wait=False)
+            raise
+        return cls(con, executor, interrupt)
+
+    def _call(self, call: _Call, func: Callable[..., T], args: Tuple[Any, ...]) -> T:
+        with self._lock:
+            if call.cancelled:
+                raise concurrent.futures.CancelledError()
+            call.running = True
+        try:
+            return func(self._con, *args)
+        finally:
+            with self._lock:
+                call.running = False
+                if call.cancelled:
+                    # let the next call run
+                    self._interrupt.reset()
+
+    async def _run(self, func: Callable[..., T], *args: Any) -> T:
+        call = _Call()
+        future = self._executor.submit(self._call, call, func, args)
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            # calls that haven't started never run, and a running statement
+            # can't be abandoned on its thread, so stop it, but only if it's
+            # this call's
+            if not future.cancel():
+                with self._lock:
+                    call.cancelled = True
+                    if call.running:
+                        self._interrupt.cancel()
+                        self._con.interrupt()
+            raise
+
+    async def register(self, functions: UDFs) -> None:
+        """Register more `sqlite_udf` functions and `sqlite_udaf` classes."""
+        await self._run(create_functions, functions)
+
+    async def execute(self, sql: str, parameters: Sequence[Any] = ()) -> None:
+        """Run a statement, discarding any rows it returns."""
+        await self._run(_fetchall, sql, parameters)
+
+    async def executemany(self, sql: str, parameters: Sequence[Sequence[Any]]) -> None:
+        """Run a statement once for every set of parameters."""
+        await self._run(sqlite3.Connection.executemany, sql, parameters)
+
+    async def fetchall(
+        self, sql: str, parameters: Sequence[Any] = ()
+    ) -> List[Tuple[Any, ...]]:
+        """Run a query and return its rows."""
+        return await self._run(_fetchall, sql, parameters)
+
+    async def fetch_numpy(
+        self, sql: str, parameters: Sequence[Any] = ()
+    ) -> Dict[str, np.ndarray]:
+        """Run a query and return its columns as NumPy arrays, keyed by name.
+
+        Columns of integers or of floats are arrays of that type, and other
+        columns, including those holding NULLs, are object arrays.
+        """
+        return await self._run(_fetch_numpy, sql, parameters)
+
+    async def commit(self) -> None:
+        """Commit the current transaction."""
+        await self._run(sqlite3.Connection.commit)
+
+    async def close(self) -> None:
+        """Close the connection and stop its thread."""
+        try:
+            await self._run(sqlite3.Connection.close)
+        finally:
+            self._executor.shutdown(wait=False)
+
+    async def __aenter__(self) -> AsyncConnection:
+        return self
+
+    async def __aexit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc_value: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        await self.close()
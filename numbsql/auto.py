@@ -0,0 +1,319 @@
+"""Register functions with every SQLite connection the process opens.
+
+`auto_register` adds functions to a process-wide registry, which a compiled
+routine installed with `sqlite3_auto_extension` registers with each new
+connection as SQLite opens it. Opening a connection runs no Python, and
+functions are available wherever connections come from, including to the
+expression indexes and generated columns of a schema that use them.
+
+The routine reads the registry through a symbol-named pointer to a table that
+starts with the number of functions, followed by one row for each:
+
+    name, number of parameters, flags, xFunc, xStep, xFinal, xValue, xInverse
+
+Changes to the registry publish a new table, so connections that are being
+opened never see one that's partially written. The routine counts itself as a
+reader of the registry while it runs, so that tables that have been replaced
+are freed once nothing can be reading them.
+"""
+
+from __future__ import annotations
+
+import ctypes
+import threading
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Tuple
+
+import llvmlite.binding as llvm
+from llvmlite import ir
+from numba import cfunc, extending, njit, types
+from numba.core.base import BaseContext
+from numba.core.ccallback import CFunc
+from numba.core.typing.context import Context
+from numba.core.typing.templates import Signature
+from numba.types import intc, voidptr
+
+from .compiler import warmup
+from .exceptions import MissingAggregateMethod
+from .numbaext import (
+    sqlite3_create_function_v2_external,
+    sqlite3_create_window_function_external,
+)
+from .register import UDFs, collect_udfs, function_flags, num_params
+from .sqlite import SQLITE_OK, sqlite3_auto_extension
+
+if TYPE_CHECKING:
+    from llvmlite.ir.builder import IRBuilder
+    from llvmlite.ir.instructions import Value
+
+# Generated code reads the registry and its number of readers by symbol name,
+# so that it can be cached.
+REGISTRY_SYMBOL = "numbsql_auto_registry"
+_REGISTRY = ctypes.c_void_p()
+llvm.add_symbol(REGISTRY_SYMBOL, ctypes.addressof(_REGISTRY))
+READERS_SYMBOL = "numbsql_auto_readers"
+_READERS = ctypes.c_int64()
+llvm.add_symbol(READERS_SYMBOL, ctypes.addressof(_READERS))
+
+# the number of integers in each row of the table
+_ROW_SIZE = 8
+
+_TABLE_TYPE = types.Array(types.int64, 2, "C", readonly=True)
+
+
+def _global(builder: IRBuilder, symbol: str, typ: ir.Type) -> Value:
+    module = builder.module
+    try:
+        return module.get_global(symbol)
+    except KeyError:
+        variable = ir.GlobalVariable(module, typ, symbol)
+        variable.linkage = "external"
+        return variable
+
+
+@extending.intrinsic  # type: ignore[misc, untyped-decorator]
+def count_reader(
+    typingctx: Context, delta: types.Integer
+) -> Tuple[
+    Signature, Callable[[BaseContext, IRBuilder, Signature, Tuple[Value]], None]
+]:
+    """Add `delta` to the number of readers of the registry."""
+    sig = types.void(types.int64)
+
+    def codegen(
+        context: BaseContext,
+        builder: IRBuilder,
+        signature: Signature,
+        args: Tuple[Value],
+    ) -> None:
+        (delta,) = args
+        readers = _global(builder, READERS_SYMBOL, ir.IntType(64))
+        builder.atomic_rmw("add", readers, delta, "seq_cst")
+
+    return sig, codegen
+
+
+@extending.intrinsic  # type: ignore[misc, untyped-decorator]
+def replace_table(
+    typingctx: Context, table: types.Integer
+) -> Tuple[
+    Signature, Callable[[BaseContext, IRBuilder, Signature, Tuple[Value]], Value]
+]:
+    """Publish the table at address `table`, and return the number of readers
+    of the registry right after."""
+    sig = types.int64(types.intp)
+
+    def codegen(
+        context: BaseContext,
+        builder: IRBuilder,
+        signature: Signature,
+        args: Tuple[Value],
+    ) -> Value:
+        (table,) = args
+        i64 = ir.IntType(64)
+        registry = _global(builder, REGISTRY_SYMBOL, i64.as_pointer())
+        builder.store_atomic(
+            builder.inttoptr(table, i64.as_pointer()), registry, "seq_cst", 8
+        )
+        readers = _global(builder, READERS_SYMBOL, i64)
+        return builder.load_atomic(readers, "seq_cst", 8)
+
+    return sig, codegen
+
+
+@njit(nogil=True)  # type: ignore[misc, untyped-decorator]
+def _replace_table(table: int) -> int:
+    return replace_table(table)
+
+
+@extending.intrinsic  # type: ignore[misc, untyped-decorator]
+def registry_table(
+    typingctx: Context,
+) -> Tuple[Signature, Callable[[BaseContext, IRBuilder, Signature, Tuple[()]], Value]]:
+    """Return a view of the rows of the registry's current table."""
+    sig = _TABLE_TYPE()
+
+    def codegen(
+        context: BaseContext,
+        builder: IRBuilder,
+        signature: Signature,
+        args: Tuple[()],
+    ) -> Value:
+        i64 = ir.IntType(64)
+        registry = _global(builder, REGISTRY_SYMBOL, i64.as_pointer())
+        # sequentially consistent with counting the reader and publishing the
+        # table, so that a table isn't freed while it's being read
+        table = builder.load_atomic(registry, "seq_cst", 8)
+        intp_type = context.get_value_type(types.intp)
+        array = context.make_array(_TABLE_TYPE)(context, builder)
+        context.populate_array(
+            array,
+            data=builder.gep(table, [i64(1)]),
+            shape=[builder.load(table), intp_type(_ROW_SIZE)],
+            strides=[intp_type(_ROW_SIZE * 8), intp_type(8)],
+            itemsize=intp_type(8),
+            # the registry owns the table
+            meminfo=None,
+        )
+        return array._getvalue()
+
+    return sig, codegen
+
+
+@njit(nogil=True)  # type: ignore[misc, untyped-decorator]
+def _register_table(db: int, table: Any) -> int:
+    for i in range(table.shape[0]):
+        name, num_params, flags, x_func, x_step, x_final, x_value, x_inverse = (
+            table[i, 0],
+            table[i, 1],
+            table[i, 2],
+            table[i, 3],
+            table[i, 4],
+            table[i, 5],
+            table[i, 6],
+            table[i, 7],
+        )
+        if x_value and x_inverse:
+            rc = sqlite3_create_window_function_external(
+                db, name, num_params, flags, 0, x_step, x_final, x_value, x_inverse, 0
+            )
+        else:
+            rc = sqlite3_create_function_v2_external(
+                db, name, num_params, flags, 0, x_func, x_step, x_final, 0
+            )
+        if rc != SQLITE_OK:
+            return rc
+    return SQLITE_OK
+
+
+@cfunc(intc(voidptr, voidptr, voidptr), nogil=True)  # type: ignore[misc, untyped-decorator]
+def _register_all(db: int, error_message: int, api: int) -> int:
+    count_reader(1)
+    rc = _register_table(db, registry_table())
+    count_reader(-1)
+    return rc
+
+
+# the encoded name, number of parameters, flags and callbacks of a function:
+# xFunc, xStep, xFinal, xValue and xInverse, or None for those it doesn't have
+Registration = Tuple[ctypes.Array[ctypes.c_char], int, int, List[Optional[CFunc]]]
+
+_lock = threading.Lock()
+# the registration of each function, keyed by name
+_functions: Dict[str, Registration] = {}
+# the tables that may still be read, with the registrations they point to,
+# because a connection being opened can still be reading one that has been
+# replaced
+_tables: List[Tuple[ctypes.Array[ctypes.c_int64], List[Registration]]] = []
+_installed = False
+
+
+def _trampoline(func: Any, method: str) -> Optional[CFunc]:
+    return getattr(getattr(func, method, None), "trampoline", None)
+
+
+def _callbacks(func: Any) -> List[Optional[CFunc]]:
+    if hasattr(func, "scalar"):
+        return [func.scalar, None, None, None, None]
+    for method in ("step", "finalize"):
+        if not hasattr(func, method):
+            raise MissingAggregateMethod(func, method)
+    # a window function needs both `value` and `inverse`
+    value, inverse = _trampoline(func, "value"), _trampoline(func, "inverse")
+    if value is None or inverse is None:
+        value = inverse = None
+    return [
+        None,
+        _trampoline(func, "step"),
+        _trampoline(func, "finalize"),
+        value,
+        inverse,
+    ]
+
+
+def _publish() -> None:
+    registrations = list(_functions.values())
+    rows = [
+        [
+            ctypes.addressof(name),
+            num_params,
+            flags,
+            *(0 if callback is None else callback.address for callback in callbacks),
+        ]
+        for name, num_params, flags, callbacks in registrations
+    ]
+    table = (ctypes.c_int64 * (1 + _ROW_SIZE * len(rows)))(
+        len(rows), *(value for row in rows for value in row)
+    )
+    # the names and callbacks stay alive as long as the table, even once
+    # they're replaced or unregistered
+    _tables.append((table, registrations))
+    if not _replace_table(ctypes.addressof(table)):
+        # nothing was reading the registry when the table was replaced, and
+        # whatever reads it from now on reads the new table
+        del _tables[:-1]
+
+
+def auto_register(udfs: UDFs, *, deterministic: bool = False) -> None:
+    """Register `sqlite_udf` functions and `sqlite_udaf` classes with every
+    SQLite connection opened from now on.
+
+    Functions replace earlier ones with the same name. Connections that are
+    already open are unaffected. The functions are registered without an
+    `InterruptState`, so `check_interrupt` never stops them, although
+    `set_progress_handler` still interrupts their statements.
+
+    Parameters
+    ----------
+    udfs : module, mapping or iterable
+        The functions to register: the functions defined in a module, a
+        mapping of names to functions, or functions to register under their
+        own names
+    deterministic : bool
+        True if these functions return the same output given the same input,
+        which SQLite requires of functions used by indexes and generated
+        columns
+
+    Examples
+    --------
+    >>> import sqlite3
+    >>> from numbsql import sqlite_udf
+    >>> @sqlite_udf
+    ... def triple(value: int) -> int:
+    ...     return value * 3
+    ...
+    >>> auto_register([triple], deterministic=True)
+    >>> con = sqlite3.connect(":memory:")
+    >>> con.execute("SELECT triple(14)").fetchall()
+    [(42,)]
+    >>> con.close()
+    >>> auto_unregister("triple")
+    """
+    global _installed
+
+    functions = collect_udfs(udfs)
+    warmup(*functions.values())
+    registrations = {
+        name: (
+            ctypes.create_string_buffer(name.encode("utf8")),
+            num_params(func),
+            function_flags(func, deterministic),
+            _callbacks(func),
+        )
+        for name, func in functions.items()
+    }
+    with _lock:
+        _functions.update(registrations)
+        _publish()
+        if not _installed:
+            rc = sqlite3_auto_extension(_register_all.address)
+            if rc != SQLITE_OK:
+                raise RuntimeError(f"Unable to install the auto extension: error {rc}")
+            _installed = True
+
+
+def auto_unregister(*names: str) -> None:
+    """Stop registering the functions called `names` with new connections."""
+    with _lock:
+        for name in names:
+            _functions.pop(name, None)
+        _publish()
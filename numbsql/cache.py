@@ -0,0 +1,202 @@
+"""On-disk caching of the C callbacks that SQLite calls.
+
+Numba's own cache keys closures by pickling the values they close over, which
+never matches across processes for the trampolines generated by `sqlite_udf`
+and `sqlite_udaf`. Instead, trampolines are keyed by a fingerprint of the
+user-defined code they call, everything numba freezes into that code, the
+numba signature of that code and the versions of numba and llvmlite. Numba
+adds the target CPU name and features to every key.
+
+The cache lives wherever numba puts its own cache files, which can be
+controlled with the `NUMBA_CACHE_DIR` environment variable.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import os
+import types as pytypes
+from typing import Any, Callable, Iterable, Set, Tuple
+
+import llvmlite
+import numba
+import numpy as np
+from numba.core import sigutils
+from numba.core.caching import FunctionCache
+from numba.core.ccallback import CFunc
+from numba.core.codegen import Codegen
+from numba.core.compiler import CompileResult
+from numba.core.typing.templates import Signature
+
+
+def _code_parts(code: pytypes.CodeType) -> Iterable[bytes]:
+    yield code.co_code
+    yield repr(code.co_names).encode("utf8")
+    for const in code.co_consts:
+        if isinstance(const, pytypes.CodeType):
+            yield from _code_parts(const)
+        else:
+            yield repr(const).encode("utf8")
+
+
+def _global_names(code: pytypes.CodeType) -> Set[str]:
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, pytypes.CodeType):
+            names |= _global_names(const)
+    return names
+
+
+def _source_stamp(code: pytypes.CodeType) -> bytes:
+    # like numba's own cache, invalidate when the source file changes
+    try:
+        stat = os.stat(code.co_filename)
+    except OSError:
+        return b""
+    return repr((code.co_filename, stat.st_mtime, stat.st_size)).encode("utf8")
+
+
+def _value_parts(value: Any, seen: Set[int]) -> Iterable[bytes]:
+    # numba freezes the values of globals into the code that reads them, and
+    # compiles the jitted functions and jitclasses it calls
+    if isinstance(getattr(value, "py_func", None), pytypes.FunctionType):
+        yield from _function_parts(value.py_func, seen)
+    elif hasattr(value, "class_type"):
+        for _, method in sorted(value.class_type.methods.items()):
+            yield from _function_parts(method, seen)
+    elif isinstance(value, (pytypes.FunctionType, pytypes.BuiltinFunctionType)):
+        # numba only calls plain functions through its own implementations
+        yield f"{value.__module__}.{value.__qualname__}".encode("utf8")
+    elif isinstance(value, pytypes.ModuleType):
+        yield value.__name__.encode("utf8")
+    elif isinstance(value, np.ndarray):
+        yield repr((value.dtype, value.shape)).encode("utf8")
+        yield value.tobytes()
+    else:
+        yield repr(value).encode("utf8")
+
+
+def _function_parts(func: pytypes.FunctionType, seen: Set[int]) -> Iterable[bytes]:
+    yield f"{func.__module__}.{func.__qualname__}".encode("utf8")
+    if id(func) in seen:
+        return
+    seen.add(id(func))
+
+    code = func.__code__
+    yield _source_stamp(code)
+    yield from _code_parts(code)
+
+    names = sorted(_global_names(code))
+    for name in names:
+        try:
+            value = func.__globals__[name]
+        except KeyError:
+            # a builtin or an attribute
+            continue
+        yield name.encode("utf8")
+        yield from _value_parts(value, seen)
+        if isinstance(value, pytypes.ModuleType):
+            # attributes of modules are frozen too, such as `config.LIMIT`
+            for attribute in names:
+                member = getattr(value, attribute, None)
+                if member is not None and not isinstance(member, pytypes.ModuleType):
+                    yield attribute.encode("utf8")
+                    yield from _value_parts(member, seen)
+    for cell in func.__closure__ or ():
+        yield from _value_parts(cell.cell_contents, seen)
+
+
+def fingerprint(*parts: Any) -> str:
+    """Compute a stable digest of `parts`.
+
+    Functions contribute their bytecode and constants, the values of the
+    globals and closure variables they read, the jitted functions and
+    jitclasses those refer to, and the modification times of their source
+    files. Everything else contributes its `repr`.
+    """
+    hasher = hashlib.sha256()
+    seen: Set[int] = set()
+    for part in (numba.__version__, llvmlite.__version__, *parts):
+        if isinstance(part, pytypes.FunctionType):
+            for chunk in _function_parts(part, seen):
+                hasher.update(chunk)
+        else:
+            hasher.update(repr(part).encode("utf8"))
+    return hasher.hexdigest()
+
+
+class TrampolineCache(FunctionCache):
+    """A numba function cache keyed by a precomputed fingerprint."""
+
+    def __init__(self, py_func: Callable[..., Any], fingerprint: str) -> None:
+        super().__init__(py_func)
+        self._fingerprint = fingerprint
+
+    def _index_key(
+        self, sig: Signature, codegen: Codegen
+    ) -> Tuple[Signature, Tuple[str, str, str], str]:
+        return sig, codegen.magic_tuple(), self._fingerprint
+
+
+class _Trampoline(CFunc):
+    def __init__(
+        self,
+        pyfunc: Callable[..., Any],
+        sig: Signature,
+        *,
+        prepare: Callable[[], None],
+        cache: bool,
+        fingerprint: str,
+    ) -> None:
+        # trampolines for different user-defined functions are all generated
+        # from the same Python function, so give each of them a distinct name
+        #
+        # this name ends up in both the cache file name and the symbol name
+        # of the generated code, which must not collide when several cached
+        # trampolines are loaded into the same process
+        pyfunc.__qualname__ = f"{pyfunc.__qualname__}_{fingerprint[:16]}"
+        super().__init__(
+            pyfunc, sigutils.normalize_signature(sig), locals={}, options={}
+        )
+        self._prepare = prepare
+        if cache:
+            self._cache = TrampolineCache(pyfunc, fingerprint)
+
+    def _compile_uncached(self) -> CompileResult:
+        # only compile the user-defined code if the trampoline isn't cached
+        self._prepare()
+        return super()._compile_uncached()
+
+
+def trampoline(
+    sig: Signature,
+    *,
+    fingerprint: str,
+    cache: bool = False,
+    prepare: Callable[[], None] = lambda: None,
+) -> Callable[[Callable[..., Any]], CFunc]:
+    """Compile a C callback, optionally loading it from the on-disk cache.
+
+    Parameters
+    ----------
+    sig
+        The C signature of the callback.
+    fingerprint
+        A digest identifying everything the callback's generated code depends
+        on, computed with `fingerprint`.
+    cache
+        Whether to load the callback from and save it to the on-disk cache.
+    prepare
+        Called before compiling the callback, but only if it wasn't found in
+        the cache. Use this to compile the user-defined functions that the
+        callback calls.
+    """
+
+    def wrapper(pyfunc: Callable[..., Any]) -> CFunc:
+        result = _Trampoline(
+            pyfunc, sig, prepare=prepare, cache=cache, fingerprint=fingerprint
+        )
+        result.compile()
+        return result
+
+    return wrapper
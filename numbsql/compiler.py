@@ -0,0 +1,163 @@
+"""Control over when user-defined functions are compiled."""
+
+from __future__ import annotations
+
+import multiprocessing
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.context import BaseContext
+from typing import Any, Callable, List, Optional, Sequence, TypeVar
+
+from numba.core.compiler_lock import global_compiler_lock
+
+T = TypeVar("T")
+
+# UDFs and UDAFs defined with `lazy=True` that haven't been compiled yet,
+# mapped to the function that compiles them
+#
+# the compile functions take an optional `cache` argument that overrides the
+# `cache` argument of the decorator
+_pending: weakref.WeakKeyDictionary[Any, Callable[..., None]] = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def defer(obj: Any, compile: Callable[..., None], *, lazy: bool) -> None:
+    """Call `compile` now, or later on the first call to `warmup(obj)`."""
+    if lazy:
+        _pending[obj] = compile
+    else:
+        compile()
+
+
+def is_pending(obj: Any) -> bool:
+    """Return whether `obj` was defined with `lazy=True` and hasn't been
+    compiled yet."""
+    return obj in _pending
+
+
+@global_compiler_lock  # type: ignore[misc, untyped-decorator]
+def _warmup(obj: Any, **kwargs: Any) -> None:
+    try:
+        compile = _pending[obj]
+    except KeyError:
+        # either compiled already, or not a numbsql function at all
+        return
+
+    compile(**kwargs)
+    del _pending[obj]
+
+
+def warmup(*funcs: Any) -> None:
+    """Compile `sqlite_udf` functions and `sqlite_udaf` classes defined with
+    `lazy=True`.
+
+    Registering a lazy function with `create_function` or `create_aggregate`
+    compiles it as well. Call this function to move that cost somewhere else,
+    such as before forking worker processes.
+
+    Examples
+    --------
+    >>> from numbsql import sqlite_udf, warmup
+    >>> @sqlite_udf(lazy=True)
+    ... def add_one(value: int) -> int:
+    ...     return value + 1
+    ...
+    >>> hasattr(add_one, "scalar")
+    False
+    >>> warmup(add_one)
+    >>> hasattr(add_one, "scalar")
+    True
+    """
+    for func in funcs:
+        _warmup(func)
+
+
+# the objects being compiled by `compile_all`, set in each worker process
+_batch: Sequence[Any] = ()
+
+
+def _init_worker(batch: Sequence[Any]) -> None:
+    global _batch
+    _batch = batch
+
+
+def _compile_one(index: int) -> None:
+    _warmup(_batch[index], cache=True)
+
+
+def _default_context() -> BaseContext:
+    # forked workers inherit the objects to compile, whereas spawned workers
+    # have to import them by name
+    if "fork" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("fork")
+    return multiprocessing.get_context("spawn")
+
+
+def compile_all(
+    funcs: Sequence[T],
+    *,
+    max_workers: Optional[int] = None,
+    mp_context: Optional[BaseContext] = None,
+) -> List[T]:
+    """Compile many `sqlite_udf` functions and `sqlite_udaf` classes defined
+    with `lazy=True` in parallel.
+
+    Each function is compiled in a separate worker process, which saves the
+    result to the on-disk cache whether or not the function was defined with
+    `cache=True`. The compiled code is then loaded from the cache in the
+    calling process. Functions that are already compiled are left alone, and
+    a single function is compiled in the calling process.
+
+    Parameters
+    ----------
+    funcs
+        The functions and classes to compile.
+    max_workers
+        The maximum number of worker processes. Defaults to the number of
+        CPUs.
+    mp_context
+        The multiprocessing context used to start workers. Defaults to `fork`
+        where it is available. Workers started any other way must be able to
+        import every function from its module.
+
+    Returns
+    -------
+    List
+        `funcs`, ready to be registered with `create_function` or
+        `create_aggregate`.
+
+    Examples
+    --------
+    >>> from numbsql import compile_all, sqlite_udf
+    >>> @sqlite_udf(lazy=True)
+    ... def add_one(value: int) -> int:
+    ...     return value + 1
+    ...
+    >>> @sqlite_udf(lazy=True)
+    ... def add_two(value: int) -> int:
+    ...     return value + 2
+    ...
+    >>> funcs = compile_all([add_one, add_two])
+    >>> all(hasattr(func, "scalar") for func in funcs)
+    True
+    """
+    funcs = list(funcs)
+    indices = [i for i, func in enumerate(funcs) if func in _pending]
+    if len(indices) < 2:
+        # not worth starting any processes
+        warmup(*funcs)
+        return funcs
+
+    with ProcessPoolExecutor(
+        max_workers=min(len(indices), max_workers or multiprocessing.cpu_count()),
+        mp_context=mp_context or _default_context(),
+        initializer=_init_worker,
+        initargs=(funcs,),
+    ) as executor:
+        # consume the results to raise the first error, if any
+        list(executor.map(_compile_one, indices))
+
+    for i in indices:
+        _warmup(funcs[i], cache=True)
+    return funcs
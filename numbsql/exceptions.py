@@ -28,6 +28,23 @@ class MissingLibrary(Exception):
         return f"Library `{self.library}` not found"
 
 
+class UnsupportedExtensionSymbol(Exception):
+    def __init__(self, symbol: str) -> None:
+        self.symbol = symbol
+        super().__init__(self.symbol)
+
+    def __str__(self) -> str:
+        return (
+            f"Compiled code depends on `{self.symbol}`, which isn't available "
+            "outside of a Python process"
+        )
+
+
+class Interrupted(Exception):
+    def __str__(self) -> str:
+        return "interrupted"
+
+
 class UnsupportedAggregateTypeError(NotImplementedError):
     def __init__(self, typ: types.Type) -> None:
         self.typ = typ
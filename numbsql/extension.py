@@ -0,0 +1,467 @@
+"""Build SQLite loadable extensions out of numbsql functions.
+
+The extension contains the same C callbacks that `create_function` and
+`create_aggregate` register, so it can be loaded by any program that uses
+SQLite, such as the `sqlite3` shell, without Python or numba.
+
+Build an extension from the command line with
+
+    python -m numbsql.extension mypackage.udfs -o udfs.so
+
+or from Python with `build_extension`, and load it into a Python connection
+with `numbsql.load_extension`. Building requires a C and a C++
+compiler, and SQLite's `sqlite3ext.h` header.
+
+Code that SQLite calls through the extension runs without a Python
+interpreter, so compiled code that calls into Python can't do so, and such
+calls do nothing. Exceptions raised by user-defined functions never reach
+Python, and fail the SQLite call like they do when registered from Python.
+"""
+
+from __future__ import annotations
+
+import argparse
+import importlib
+import os
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Mapping, NamedTuple, Optional, Union
+
+import llvmlite.binding as llvm
+import numba
+from numba.core.ccallback import CFunc
+
+from .compiler import warmup
+from .exceptions import UnsupportedExtensionSymbol
+from .interrupt import INTERRUPT_KEY_SYMBOL
+from .register import UDFs, collect_udfs, function_flags, num_params
+
+# numba runtime functions that are only called on the way to raising a Python
+# exception
+_NUMBA_EXCEPTION_HELPERS = frozenset(
+    {
+        "numba_do_raise",
+        "numba_gil_ensure",
+        "numba_gil_release",
+        "numba_runtime_build_excinfo_struct",
+        "numba_unpickle",
+    }
+)
+
+# numba runtime functions used by string methods, implemented below from
+# numba's copy of CPython's unicode database
+_NUMBA_UNICODE_HELPERS = frozenset(
+    {"numba_gettyperecord", "numba_get_PyUnicode_ExtendedCase"}
+)
+
+_C_TYPES = {
+    "void": "void",
+    "i1": "uint8_t",
+    "i8": "uint8_t",
+    "i16": "int16_t",
+    "i32": "int32_t",
+    "i64": "int64_t",
+    "float": "float",
+    "double": "double",
+}
+
+_PRELUDE = """\
+#include <pthread.h>
+#include <stdint.h>
+#include <stdio.h>
+#include <sqlite3ext.h>
+
+SQLITE_EXTENSION_INIT1
+
+#define NUMBSQL_HIDDEN __attribute__((visibility("hidden")))
+#define NUMBSQL_EXPORT __attribute__((visibility("default")))
+
+void NRT_MemSys_init(void);
+
+/* connections can load the extension on several threads at once */
+static pthread_once_t numbsql_init_once = PTHREAD_ONCE_INIT;
+"""
+
+_UNICODE_HELPERS = """\
+#include "_unicodetype_db.h"
+
+NUMBSQL_HIDDEN void numba_gettyperecord(
+    Py_UCS4 code, int *upper, int *lower, int *title, unsigned char *decimal,
+    unsigned char *digit, unsigned short *flags) {
+    int index = 0;
+    const numba_PyUnicode_TypeRecord *rec;
+    if (code < 0x110000) {
+        index = index1[(code >> SHIFT)];
+        index = index2[(index << SHIFT) + (code & ((1 << SHIFT) - 1))];
+    }
+    rec = &numba_PyUnicode_TypeRecords[index];
+    *upper = rec->upper;
+    *lower = rec->lower;
+    *title = rec->title;
+    *decimal = rec->decimal;
+    *digit = rec->digit;
+    *flags = rec->flags;
+}
+
+NUMBSQL_HIDDEN Py_UCS4 numba_get_PyUnicode_ExtendedCase(int code) {
+    return numba_PyUnicode_ExtendedCase[code];
+}
+"""
+
+
+class _Function(NamedTuple):
+    name: str
+    num_params: int
+    # the flags argument of sqlite3_create_function
+    flags: int
+    # C callback names, keyed by the name of the sqlite3_create_function
+    # argument they're passed as
+    callbacks: Dict[str, str]
+
+
+def _c_type(llvm_type: str) -> str:
+    if llvm_type == "ptr" or llvm_type.endswith("*"):
+        return "void *"
+    return _C_TYPES[llvm_type]
+
+
+def _c_prototype(fn: llvm.ValueRef, name: str) -> str:
+    _, _, return_type = str(fn.global_value_type).partition(" (")[0].rpartition(" ")
+    params = ", ".join(
+        f"{_c_type(str(arg.type))} a{i}" for i, arg in enumerate(fn.arguments)
+    )
+    return f"{_c_type(return_type)} {name}({params or 'void'})"
+
+
+def _trampolines(obj: Any, name: str) -> Dict[str, CFunc]:
+    warmup(obj)
+    scalar = getattr(obj, "scalar", None)
+    if isinstance(scalar, CFunc):
+        return {"xFunc": scalar}
+
+    callbacks = {
+        argument: getattr(getattr(obj, method, None), "trampoline", None)
+        for argument, method in (
+            ("xStep", "step"),
+            ("xFinal", "finalize"),
+            ("xValue", "value"),
+            ("xInverse", "inverse"),
+        )
+    }
+    if callbacks["xStep"] is None:
+        raise TypeError(
+            f"`{name}` is not a `sqlite_udf` function or a `sqlite_udaf` class"
+        )
+    return {argument: cfunc for argument, cfunc in callbacks.items() if cfunc}
+
+
+def _link(
+    udfs: Mapping[str, Any],
+    deterministic: bool = False,
+) -> tuple[llvm.ModuleRef, List[_Function]]:
+    """Link the trampolines of `udfs` and everything they call into a single
+    module, renaming the trampolines to valid C identifiers."""
+    module: Optional[llvm.ModuleRef] = None
+    functions = []
+    for i, (name, obj) in enumerate(udfs.items()):
+        callbacks = {}
+        for argument, cfunc in _trampolines(obj, name).items():
+            # the module for linking has every function the trampoline calls,
+            # whether or not the trampoline was loaded from the cache
+            trampoline_module = cfunc._library._get_module_for_linking().clone()
+            trampoline = trampoline_module.get_function(cfunc.native_name)
+            trampoline.linkage = "external"
+            trampoline.name = c_name = f"numbsql_{i}_{argument}"
+            callbacks[argument] = c_name
+
+            if module is None:
+                module = trampoline_module
+            else:
+                module.link_in(trampoline_module)
+        functions.append(
+            _Function(
+                name, num_params(obj), function_flags(obj, deterministic), callbacks
+            )
+        )
+
+    if module is None:
+        raise ValueError("No functions to build an extension from")
+    return module, functions
+
+
+def _generate_glue(
+    module: llvm.ModuleRef, functions: List[_Function], entry_point: str
+) -> str:
+    """Generate the C source code that connects compiled code in `module` to
+    SQLite, redirecting references to symbols that aren't available outside of
+    Python along the way."""
+    sections = [_PRELUDE]
+
+    for fn in module.functions:
+        name = fn.name
+        if not fn.is_declaration or name.startswith("llvm."):
+            continue
+
+        if name.startswith("sqlite3_"):
+            # SQLite functions must be called through the pointers SQLite
+            # passes to the extension, since the process loading the extension
+            # might not export them
+            fn.name = shim = f"numbsql_{name}"
+            args = ", ".join(f"a{i}" for i in range(len(list(fn.arguments))))
+            prototype = _c_prototype(fn, shim)
+            cast = prototype.replace(f" {shim}(", " (*)(", 1)
+            member = name.removeprefix("sqlite3_")
+            sections.append(
+                f"NUMBSQL_HIDDEN {prototype} {{\n"
+                f"    return (({cast})sqlite3_api->{member})({args});\n"
+                "}\n"
+            )
+        elif name == "PyErr_WriteUnraisable":
+            sections.append(
+                f"NUMBSQL_HIDDEN {_c_prototype(fn, name)} {{\n"
+                '    fputs("numbsql: user-defined function raised an exception\\n",'
+                " stderr);\n"
+                "}\n"
+            )
+        elif name.startswith(("Py", "_Py")) or name in _NUMBA_EXCEPTION_HELPERS:
+            prototype = _c_prototype(fn, name)
+            body = "" if prototype.startswith("void ") else " return 0; "
+            sections.append(f"NUMBSQL_HIDDEN {prototype} {{{body}}}\n")
+        elif name in _NUMBA_UNICODE_HELPERS:
+            if _UNICODE_HELPERS not in sections:
+                sections.append(_UNICODE_HELPERS)
+        elif name.startswith("numba_"):
+            raise UnsupportedExtensionSymbol(name)
+        # everything else is either part of numba's runtime library, which is
+        # compiled into the extension, or the C library
+
+    init_statements = ["NRT_MemSys_init();"]
+    for gv in module.global_variables:
+        if gv.is_declaration:
+            if gv.name == INTERRUPT_KEY_SYMBOL:
+                # the functions are registered without an interrupt state, so
+                # `check_interrupt` never fails in extensions, but the
+                # trampolines of functions that call it still publish it
+                sections.append(f"NUMBSQL_HIDDEN pthread_key_t {gv.name};\n")
+                init_statements.append(f"pthread_key_create(&{gv.name}, NULL);")
+                continue
+            if not gv.name.startswith(("Py", "_Py")):
+                raise UnsupportedExtensionSymbol(gv.name)
+            sections.append(f"NUMBSQL_HIDDEN char {gv.name};\n")
+
+    # keep everything but the entry point out of the extension's exports
+    for value in (*module.functions, *module.global_variables):
+        if not value.is_declaration and value.linkage not in (
+            llvm.Linkage.internal,
+            llvm.Linkage.private,
+        ):
+            value.visibility = "hidden"
+
+    for function in functions:
+        for argument, c_name in function.callbacks.items():
+            if argument in ("xFunc", "xStep", "xInverse"):
+                sections.append(
+                    f"void {c_name}(sqlite3_context *, int, sqlite3_value **);\n"
+                )
+            else:
+                sections.append(f"void {c_name}(sqlite3_context *);\n")
+
+    statements = []
+    for function in functions:
+        callbacks = function.callbacks
+        name = function.name.replace("\\", "\\\\").replace('"', '\\"')
+        if "xFunc" in callbacks:
+            statements.append(
+                f'rc = sqlite3_create_function_v2(db, "{name}", '
+                f"{function.num_params}, {function.flags:d}, NULL, "
+                f"{callbacks['xFunc']}, NULL, NULL, NULL);"
+            )
+        else:
+            if "xValue" in callbacks and "xInverse" in callbacks:
+                statements.append(
+                    f'rc = sqlite3_create_window_function(db, "{name}", '
+                    f"{function.num_params}, {function.flags:d}, NULL, "
+                    f"{callbacks['xStep']}, {callbacks['xFinal']}, "
+                    f"{callbacks['xValue']}, {callbacks['xInverse']}, NULL);"
+                )
+            else:
+                statements.append(
+                    f'rc = sqlite3_create_function_v2(db, "{name}", '
+                    f"{function.num_params}, {function.flags:d}, NULL, NULL, "
+                    f"{callbacks['xStep']}, {callbacks['xFinal']}, NULL);"
+                )
+        statements.append("if (rc != SQLITE_OK) return rc;")
+    body = "\n    ".join(statements)
+    init = "\n    ".join(init_statements)
+
+    sections.append(f"static void numbsql_init(void) {{\n    {init}\n}}\n")
+    sections.append(
+        f"NUMBSQL_EXPORT int {entry_point}(\n"
+        "    sqlite3 *db, char **pzErrMsg, const sqlite3_api_routines *pApi) {\n"
+        "    int rc;\n"
+        "    (void)pzErrMsg;\n"
+        "    SQLITE_EXTENSION_INIT2(pApi);\n"
+        "    pthread_once(&numbsql_init_once, numbsql_init);\n"
+        f"    {body}\n"
+        "    return SQLITE_OK;\n"
+        "}\n"
+    )
+    return "\n".join(sections)
+
+
+def build_extension(
+    path: Union[str, os.PathLike[str]],
+    udfs: UDFs,
+    *,
+    entry_point: str = "sqlite3_extension_init",
+    include_dirs: Iterable[str] = (),
+    cpu: Optional[str] = None,
+    features: Optional[str] = None,
+    deterministic: bool = False,
+) -> Path:
+    """Build a SQLite loadable extension that registers `udfs`.
+
+    Parameters
+    ----------
+    path
+        Where to write the extension.
+    udfs
+        The `sqlite_udf` functions and `sqlite_udaf` classes to register. This
+        is either a module, in which case every function and class defined in
+        it is registered, a mapping from SQL function name to function or
+        class, or an iterable of functions and classes, which are registered
+        with their Python names.
+    entry_point
+        The name of the function that SQLite calls to load the extension.
+    include_dirs
+        Additional directories to search for SQLite's `sqlite3ext.h`.
+    cpu
+        The CPU to generate code for. Defaults to the host CPU; use
+        `"generic"` for an extension that runs on any CPU of the host's
+        architecture.
+    features
+        The CPU features to generate code for. Defaults to the features of
+        the host CPU when `cpu` isn't given, otherwise to none.
+    deterministic
+        True if the functions return the same output given the same input,
+        which SQLite requires of functions used by indexes and generated
+        columns.
+
+    Returns
+    -------
+    Path
+        The path to the extension.
+    """
+    path = Path(path)
+    module, functions = _link(collect_udfs(udfs), deterministic)
+    glue = _generate_glue(module, functions, entry_point)
+    module.verify()
+
+    if cpu is None:
+        cpu = llvm.get_host_cpu_name()
+        if features is None:
+            features = llvm.get_host_cpu_features().flatten()
+    # code loaded by numba isn't position independent, so generate it again
+    target_machine = llvm.Target.from_triple(module.triple).create_target_machine(
+        cpu=cpu, features=features or "", opt=3, reloc="pic", codemodel="default"
+    )
+
+    numba_dir = Path(numba.__file__).parent
+    cc = os.environ.get("CC", "cc")
+    cxx = os.environ.get("CXX", "c++")
+    cflags = ["-O2", "-fPIC", "-fvisibility=hidden", f"-I{numba_dir}"]
+    cflags.extend(f"-I{include_dir}" for include_dir in include_dirs)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        build_dir = Path(tmpdir)
+        functions_object = build_dir / "functions.o"
+        functions_object.write_bytes(target_machine.emit_object(module))
+
+        glue_source = build_dir / "extension.c"
+        glue_source.write_text(glue)
+        glue_object = build_dir / "extension.o"
+        subprocess.check_call(
+            [cc, *cflags, "-c", str(glue_source), "-o", str(glue_object)]
+        )
+
+        # numba's runtime library manages memory for strings and arrays
+        nrt_object = build_dir / "nrt.o"
+        subprocess.check_call(
+            [
+                cxx,
+                *cflags,
+                "-fno-exceptions",
+                "-fno-rtti",
+                "-c",
+                str(numba_dir / "core" / "runtime" / "nrt.cpp"),
+                "-o",
+                str(nrt_object),
+            ]
+        )
+
+        ldflags = ["-shared"]
+        if sys.platform.startswith("linux"):
+            ldflags += ["-Wl,--no-undefined", "-Wl,-Bsymbolic"]
+        subprocess.check_call(
+            [
+                cc,
+                *ldflags,
+                "-o",
+                str(path),
+                str(functions_object),
+                str(glue_object),
+                str(nrt_object),
+                "-lm",
+                "-lpthread",
+            ]
+        )
+    return path
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        prog="python -m numbsql.extension",
+        description=(
+            "Build a SQLite loadable extension from the numbsql functions "
+            "defined in a module."
+        ),
+    )
+    parser.add_argument("module", help="the module defining the functions")
+    parser.add_argument(
+        "-o", "--output", required=True, help="where to write the extension"
+    )
+    parser.add_argument(
+        "--entry-point",
+        default="sqlite3_extension_init",
+        help="the name of the function that SQLite calls to load the extension",
+    )
+    parser.add_argument(
+        "-I",
+        dest="include_dirs",
+        action="append",
+        default=[],
+        help="an additional directory to search for sqlite3ext.h",
+    )
+    parser.add_argument(
+        "--cpu", help="the CPU to generate code for, defaults to the host CPU"
+    )
+    parser.add_argument(
+        "--deterministic",
+        action="store_true",
+        help="register the functions as deterministic",
+    )
+    args = parser.parse_args(argv)
+    build_extension(
+        args.output,
+        importlib.import_module(args.module),
+        entry_point=args.entry_point,
+        include_dirs=args.include_dirs,
+        cpu=args.cpu,
+        deterministic=args.deterministic,
+    )
+
+
+if __name__ == "__main__":
+    main()
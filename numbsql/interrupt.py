@@ -0,0 +1,411 @@
+"""Cancel queries and time-box them without the GIL.
+
+Every connection has an `InterruptState`: a cancel flag and a deadline that
+Python sets with `InterruptState.cancel` and `InterruptState.set_deadline` (or
+`InterruptState.deadline`), and compiled code reads atomically:
+
+* the progress handler installed by `set_progress_handler` makes SQLite
+  interrupt the statement the connection is running, and
+* `check_interrupt` makes a long-running UDF or UDAF method registered with
+  the connection fail.
+
+Either way the query fails with ``sqlite3.OperationalError: interrupted``.
+Neither needs the GIL, so another thread can cancel a query while it runs.
+Cancelling a connection leaves the queries of every other connection alone,
+unless they were given the same state. A connection's state can be replaced
+at any time, and the functions registered with it read the new one.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import ctypes
+import sqlite3
+import sys
+import threading
+import time
+import weakref
+from typing import TYPE_CHECKING, Any, Callable, Dict, Generator, Optional, Tuple
+
+import llvmlite.binding as llvm
+from llvmlite import ir
+from numba import cfunc, extending, types
+from numba.core import cgutils
+from numba.core.base import BaseContext
+from numba.core.typing.context import Context
+from numba.core.typing.templates import Signature
+from numba.types import intc, voidptr
+
+from .exceptions import Interrupted
+from .sqlite import get_sqlite_db, progressfunc, sqlite3_progress_handler
+
+if TYPE_CHECKING:
+    from llvmlite.ir.builder import IRBuilder
+    from llvmlite.ir.instructions import Value
+
+_CLOCK = time.CLOCK_MONOTONIC
+
+# Compiled functions find the state of the connection calling them through
+# SQLite's user data: the address of the connection's slot, which points to
+# its current state. Trampolines publish it in a thread-local variable for
+# `check_interrupt` to read. Generated code reads the variable's key by symbol
+# name, so that it can be cached.
+INTERRUPT_KEY_SYMBOL = "numbsql_interrupt_key"
+_pthread_key_t = ctypes.c_ulong if sys.platform == "darwin" else ctypes.c_uint
+_KEY = _pthread_key_t()
+if ctypes.CDLL(None).pthread_key_create(ctypes.byref(_KEY), None) != 0:
+    raise OSError("failed to create the thread-local key of interrupt states")
+llvm.add_symbol(INTERRUPT_KEY_SYMBOL, ctypes.addressof(_KEY))
+
+
+def _now() -> int:
+    return time.clock_gettime_ns(_CLOCK)
+
+
+class InterruptState:
+    """A cancel flag and a deadline, read by compiled code without the GIL.
+
+    Examples
+    --------
+    >>> import sqlite3
+    >>> from numbsql import set_progress_handler
+    >>> con = sqlite3.connect(":memory:")
+    >>> state = set_progress_handler(con)
+    >>> with state.deadline(30):
+    ...     con.execute("SELECT 1").fetchall()
+    [(1,)]
+    >>> con.close()
+    """
+
+    __slots__ = ("_state",)
+
+    def __init__(self) -> None:
+        # nonzero once cancelled, and the deadline in nanoseconds of the
+        # monotonic clock, or zero if there isn't one
+        self._state = (ctypes.c_int64 * 2)()
+
+    @property
+    def address(self) -> int:
+        """The address of the state, passed to compiled code."""
+        return ctypes.addressof(self._state)
+
+    def cancel(self) -> None:
+        """Interrupt queries until `reset` is called."""
+        self._state[0] = 1
+
+    def set_deadline(self, seconds: Optional[float]) -> None:
+        """Interrupt queries that are still running `seconds` from now, or
+        remove the deadline if `seconds` is None."""
+        self._state[1] = 0 if seconds is None else max(_now() + int(seconds * 1e9), 1)
+
+    def reset(self) -> None:
+        """Clear the cancel flag and the deadline."""
+        self._state[0] = 0
+        self._state[1] = 0
+
+    @contextlib.contextmanager
+    def deadline(self, seconds: float) -> Generator[None, None, None]:
+        """Interrupt queries that are still running `seconds` after entering
+        the block, and clear the cancel flag and the deadline on exit."""
+        self.set_deadline(seconds)
+        try:
+            yield
+        finally:
+            self.reset()
+
+    def is_interrupted(self) -> bool:
+        """Return whether queries are being interrupted."""
+        cancelled, when = self._state
+        return bool(cancelled) or (when != 0 and _now() >= when)
+
+
+class _Slot:
+    """A connection's pointer to its current state.
+
+    Functions registered with the connection and its progress handler are
+    given the address of the pointer rather than of a state, so that the
+    connection's state can be replaced without touching them. The slot is
+    the callable of a hidden collation, which keeps it alive until the
+    connection is closed.
+    """
+
+    __slots__ = ("pointer", "state", "states", "__weakref__")
+
+    def __init__(self, state: InterruptState) -> None:
+        self.pointer = ctypes.c_void_p(state.address)
+        self.state = state
+        # every state the slot has pointed at, since compiled code running on
+        # another thread may still be reading one that has been replaced
+        self.states = [state]
+
+    def __call__(self, first: str, second: str) -> int:
+        return (first > second) - (first < second)
+
+    @property
+    def address(self) -> int:
+        return ctypes.addressof(self.pointer)
+
+    def point_at(self, state: InterruptState) -> None:
+        if not any(known is state for known in self.states):
+            self.states.append(state)
+        self.state = state
+        self.pointer.value = state.address
+
+
+# `sqlite3.Connection` can't be weakly referenced, so slots are looked up by
+# database handle and connection. The connection holds the only reference to
+# its slot, so a slot that's gone means that its connection was closed, and
+# that a connection opened since at the same address needs a slot of its own.
+_SLOT_COLLATION = "numbsql_interrupt_state"
+_slots: Dict[Tuple[int, int], weakref.ReferenceType[_Slot]] = {}
+_slots_lock = threading.Lock()
+
+
+def _slot(con: sqlite3.Connection, state: Optional[InterruptState]) -> _Slot:
+    key = get_sqlite_db(con), id(con)
+    with _slots_lock:
+        ref = _slots.get(key)
+        slot = ref() if ref is not None else None
+        if slot is None:
+            slot = _Slot(InterruptState() if state is None else state)
+            con.create_collation(_SLOT_COLLATION, slot)
+
+            def forget(ref: weakref.ReferenceType[_Slot]) -> None:
+                if _slots.get(key) is ref:
+                    del _slots[key]
+
+            _slots[key] = weakref.ref(slot, forget)
+        elif state is not None:
+            slot.point_at(state)
+        return slot
+
+
+def interrupt_state(
+    con: sqlite3.Connection, state: Optional[InterruptState] = None
+) -> InterruptState:
+    """Return the `InterruptState` of `con`.
+
+    Parameters
+    ----------
+    con : sqlite3.Connection
+        A connection to a SQLite database
+    state : InterruptState, optional
+        A state to give `con` instead of the one it has, for example to
+        cancel several connections together. By default a connection gets a
+        state of its own the first time it's needed. Functions registered
+        earlier read the new state too.
+    """
+    return _slot(con, state).state
+
+
+def state_pointer(con: sqlite3.Connection) -> int:
+    """Return the address of the pointer to the `InterruptState` of `con`,
+    the user data of the functions registered with it."""
+    return _slot(con, None).address
+
+
+def check_interrupt() -> None:
+    """Raise `Interrupted` if the queries of the connection running this
+    function are being interrupted.
+
+    Call this in the loops of long-running UDFs and UDAF methods: SQLite only
+    calls its progress handler between the steps of a statement, not while a
+    function runs. In compiled code this reads the connection's state
+    atomically, without the GIL. Called from Python, outside of a query,
+    there's no connection, so it does nothing.
+    """
+
+
+def _interrupt_key(builder: IRBuilder) -> Value:
+    module = builder.module
+    try:
+        key = module.get_global(INTERRUPT_KEY_SYMBOL)
+    except KeyError:
+        key = ir.GlobalVariable(
+            module, ir.IntType(ctypes.sizeof(_KEY) * 8), INTERRUPT_KEY_SYMBOL
+        )
+        key.linkage = "external"
+    return builder.load(key)
+
+
+def checks_interrupt(library: Any) -> bool:
+    """Return whether the compiled code in `library` calls `check_interrupt`,
+    and so needs its connection's slot."""
+    return INTERRUPT_KEY_SYMBOL in library.get_llvm_str()
+
+
+def generate_set_current_slot(builder: IRBuilder, slot: Value) -> None:
+    """Generate code making `slot`, a pointer to the pointer to an
+    `InterruptState`, the one `check_interrupt` reads on this thread."""
+    key = _interrupt_key(builder)
+    pthread_setspecific = cgutils.get_or_insert_function(
+        builder.module,
+        ir.FunctionType(ir.IntType(32), [key.type, cgutils.voidptr_t]),
+        "pthread_setspecific",
+    )
+    builder.call(pthread_setspecific, [key, slot])
+
+
+def generate_current_slot(builder: IRBuilder) -> Value:
+    """Generate code returning the slot `check_interrupt` reads on this
+    thread."""
+    key = _interrupt_key(builder)
+    pthread_getspecific = cgutils.get_or_insert_function(
+        builder.module,
+        ir.FunctionType(cgutils.voidptr_t, [key.type]),
+        "pthread_getspecific",
+    )
+    return builder.call(pthread_getspecific, [key])
+
+
+def _load_state(builder: IRBuilder, state: Value, index: int) -> Value:
+    # an atomic load is never hoisted out of the loop that's checking it
+    pointer = builder.gep(
+        builder.bitcast(state, ir.IntType(64).as_pointer()),
+        [ir.Constant(ir.IntType(32), index)],
+    )
+    return builder.load_atomic(pointer, "monotonic", 8)
+
+
+def _clock_gettime_ns(builder: IRBuilder) -> Value:
+    i64 = ir.IntType(64)
+    timespec = ir.LiteralStructType([i64, i64])
+    clock_gettime = cgutils.get_or_insert_function(
+        builder.module,
+        ir.FunctionType(ir.IntType(32), [ir.IntType(32), timespec.as_pointer()]),
+        "clock_gettime",
+    )
+    now = cgutils.alloca_once(builder, timespec)
+    builder.call(clock_gettime, [ir.Constant(ir.IntType(32), _CLOCK), now])
+    seconds = builder.load(cgutils.gep_inbounds(builder, now, 0, 0))
+    nanoseconds = builder.load(cgutils.gep_inbounds(builder, now, 0, 1))
+    return builder.add(
+        builder.mul(seconds, ir.Constant(i64, 1_000_000_000)), nanoseconds
+    )
+
+
+def generate_is_interrupted(builder: IRBuilder, slot: Value) -> Value:
+    """Generate code returning whether the queries of the state `slot` points
+    to are being interrupted.
+
+    `slot` is a pointer to the pointer to an `InterruptState`, and may be
+    NULL.
+    """
+    i64 = ir.IntType(64)
+    zero = ir.Constant(i64, 0)
+    result = cgutils.alloca_once_value(builder, cgutils.false_bit)
+    state = cgutils.alloca_once_value(builder, cgutils.voidptr_t(None))
+    # functions registered without a state, like those of extensions, are
+    # never interrupted
+    with builder.if_then(cgutils.is_not_null(builder, slot), likely=True):
+        # the pointer changes when the connection's state is replaced
+        address = builder.load_atomic(
+            builder.bitcast(slot, i64.as_pointer()), "monotonic", 8
+        )
+        builder.store(builder.inttoptr(address, cgutils.voidptr_t), state)
+    state = builder.load(state)
+    with builder.if_then(cgutils.is_not_null(builder, state), likely=True):
+        cancelled = builder.icmp_unsigned("!=", _load_state(builder, state, 0), zero)
+        builder.store(cancelled, result)
+        when = _load_state(builder, state, 1)
+        # only read the clock if there's a deadline
+        has_deadline = builder.and_(
+            builder.not_(cancelled), builder.icmp_signed("!=", when, zero)
+        )
+        with builder.if_then(has_deadline, likely=False):
+            builder.store(
+                builder.icmp_signed(">=", _clock_gettime_ns(builder), when), result
+            )
+    return builder.load(result)
+
+
+@extending.intrinsic  # type: ignore[misc, untyped-decorator]
+def interrupted(
+    typingctx: Context, slot: types.Type
+) -> Tuple[
+    Signature, Callable[[BaseContext, IRBuilder, Signature, Tuple[Value]], Value]
+]:
+    """Return whether the queries of the state `slot` points to are being
+    interrupted."""
+    sig = types.boolean(voidptr)
+
+    def codegen(
+        context: BaseContext,
+        builder: IRBuilder,
+        signature: Signature,
+        args: Tuple[Value],
+    ) -> Value:
+        (slot,) = args
+        return generate_is_interrupted(builder, slot)
+
+    return sig, codegen
+
+
+@extending.intrinsic  # type: ignore[misc, untyped-decorator]
+def current_slot(
+    typingctx: Context,
+) -> Tuple[Signature, Callable[[BaseContext, IRBuilder, Signature, Tuple[()]], Value]]:
+    """Return the slot of the connection calling the running function."""
+    sig = voidptr()
+
+    def codegen(
+        context: BaseContext,
+        builder: IRBuilder,
+        signature: Signature,
+        args: Tuple[()],
+    ) -> Value:
+        return generate_current_slot(builder)
+
+    return sig, codegen
+
+
+@extending.overload(check_interrupt)  # type: ignore[misc]
+def ol_check_interrupt():  # type: ignore[no-untyped-def]
+    def impl():  # type: ignore[no-untyped-def]
+        if interrupted(current_slot()):
+            raise Interrupted()
+
+    return impl
+
+
+@cfunc(intc(voidptr), nogil=True)  # type: ignore[misc, untyped-decorator]
+def _progress_handler(slot: int) -> int:
+    return 1 if interrupted(slot) else 0
+
+
+def set_progress_handler(
+    con: sqlite3.Connection,
+    num_ops: int = 1000,
+    state: Optional[InterruptState] = None,
+) -> InterruptState:
+    """Make SQLite interrupt statements run by `con` when its queries are
+    being interrupted.
+
+    Parameters
+    ----------
+    con : sqlite3.Connection
+        A connection to a SQLite database
+    num_ops : int
+        The approximate number of virtual machine instructions SQLite runs
+        between checks. Values less than one remove the handler.
+    state : InterruptState, optional
+        A state to give `con`, as in `interrupt_state`
+
+    Returns
+    -------
+    InterruptState
+        The state of `con`, which cancels or time-boxes its queries
+
+    Notes
+    -----
+    A connection has a single progress handler, so this replaces the one set
+    by `sqlite3.Connection.set_progress_handler`, and vice versa.
+    """
+    slot = _slot(con, state)
+    sqlite3_progress_handler(
+        get_sqlite_db(con),
+        num_ops,
+        progressfunc(_progress_handler.address),
+        slot.address,
+    )
+    return slot.state
@@ -7,37 +7,280 @@ work correctly.
 
 from __future__ import annotations
 
-import contextlib
-from typing import TYPE_CHECKING, Any, Callable, Generator, MutableMapping, Tuple
+import ctypes
+import functools
+import inspect
+import itertools
+import json
+import math
+import operator
+import types as pytypes
+import typing
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    List,
+    MutableMapping,
+    Optional,
+    Sequence,
+    Tuple,
+)
 
+import llvmlite.binding as llvm
 import numba
+import numpy as np
 from llvmlite import ir
 from llvmlite.ir.instructions import (
     CallInstr,
     Constant,
     ICMPInstr,
-    InsertValue,
     LoadInstr,
     Value,
 )
-from numba import extending, types
-from numba.core import cgutils, imputils, pythonapi
+from numba import extending, float64, int32, int64, njit, optional, types
+from numba.core import cgutils, funcdesc, imputils
 from numba.core.base import BaseContext
-from numba.core.typing import ctypes_utils
+from numba.core.registry import cpu_target
 from numba.core.typing.context import Context
 from numba.core.typing.templates import Signature
+from numba.cpython.unicode import (
+    PY_UNICODE_1BYTE_KIND,
+    PY_UNICODE_2BYTE_KIND,
+    PY_UNICODE_4BYTE_KIND,
+    _empty_string,
+    _get_code_point,
+    _set_code_point,
+)
+from numba.experimental.jitclass.base import _mangle_attr
+from numba.types import intc, string, uint8, uintp, void, voidptr
 
+from .interrupt import (
+    checks_interrupt,
+    generate_is_interrupted,
+    generate_set_current_slot,
+)
 from .sqlite import (
-    SQLITE3_RESULT_SETTERS,
-    SQLITE3_VALUE_EXTRACTORS,
+    SQLITE_BLOB,
+    SQLITE_FLOAT,
+    SQLITE_INTEGER,
     SQLITE_NULL,
-    sqlite3_value_type,
-    strlen,
+    SQLITE_TEXT,
+    SQLITE_TRANSIENT,
+    SQLITE_UTF8,
+)
+from .structured import (
+    JSON_SUBTYPE,
+    declared_encoding,
+    packed_dtype,
+    write_boolean,
+    write_bytes,
+    write_float,
+    write_integer,
+    write_null,
+    write_string,
+    write_unsigned,
+)
+from .timestamps import (
+    FRACTION_DIGITS,
+    NAT,
+    UNITS_PER_DAY,
+    datetime_type_hint,
+    declared_storage,
+    format_iso8601,
+    from_days,
+    from_julian_day,
+    parse_iso8601,
+    to_days,
+    to_julian_day,
 )
 
 if TYPE_CHECKING:
     from llvmlite.ir.builder import IRBuilder
 
+# Make the SQLite C API visible to LLVM's symbol resolution, so that generated
+# code can call it by name instead of through a constant function pointer.
+#
+# Constant function pointers are specific to the process that created them,
+# which prevents numba from caching any code that uses them.
+llvm.load_library_permanently("libsqlite3.so")
+
+# The following functions are only ever called from generated code, and are
+# bound by symbol name
+sqlite3_aggregate_context = types.ExternalFunction(
+    "sqlite3_aggregate_context", uintp(voidptr, intc)
+)
+sqlite3_result_double = types.ExternalFunction(
+    "sqlite3_result_double", void(voidptr, float64)
+)
+sqlite3_result_int64 = types.ExternalFunction(
+    "sqlite3_result_int64", void(voidptr, int64)
+)
+sqlite3_result_int = types.ExternalFunction("sqlite3_result_int", void(voidptr, intc))
+sqlite3_result_text64 = types.ExternalFunction(
+    "sqlite3_result_text64",
+    void(
+        # sqlite3_context
+        voidptr,
+        # result string
+        voidptr,
+        # the number of characters to consume from the result string, not
+        # including the null byte
+        types.uint64,
+        # function pointer destructor for the string, or SQLITE_TRANSIENT
+        voidptr,
+        # encoding
+        uint8,
+    ),
+)
+sqlite3_result_blob64 = types.ExternalFunction(
+    "sqlite3_result_blob64",
+    void(
+        # sqlite3_context
+        voidptr,
+        # result data
+        voidptr,
+        # the number of bytes in the result
+        types.uint64,
+        # function pointer destructor for the data, or SQLITE_TRANSIENT
+        voidptr,
+    ),
+)
+sqlite3_result_null = types.ExternalFunction("sqlite3_result_null", void(voidptr))
+sqlite3_user_data = types.ExternalFunction("sqlite3_user_data", voidptr(voidptr))
+sqlite3_result_subtype = types.ExternalFunction(
+    "sqlite3_result_subtype", void(voidptr, types.uint32)
+)
+sqlite3_result_error_external = types.ExternalFunction(
+    "sqlite3_result_error",
+    void(
+        # sqlite3_context
+        voidptr,
+        # UTF-8 encoded error message
+        voidptr,
+        # the number of bytes in the error message
+        intc,
+    ),
+)
+# pointers are passed as integers, which the C ABI passes the same way
+sqlite3_create_function_v2_external = types.ExternalFunction(
+    "sqlite3_create_function_v2",
+    intc(voidptr, uintp, intc, intc, uintp, uintp, uintp, uintp, uintp),
+)
+sqlite3_create_window_function_external = types.ExternalFunction(
+    "sqlite3_create_window_function",
+    intc(voidptr, uintp, intc, intc, uintp, uintp, uintp, uintp, uintp, uintp),
+)
+
+
+# the largest integer SQLite can store as an INTEGER
+INT64_MAX = np.iinfo(np.int64).max
+
+
+def sqlite3_result_number(ctx: types.Integer, value: Any):  # type: ignore[no-untyped-def]
+    raise NotImplementedError(type(value))
+
+
+@extending.overload(sqlite3_result_number, inline="always")  # type: ignore[misc]
+def ol_sqlite3_result_number(ctx, value):  # type: ignore[no-untyped-def]
+    # these call SQLite directly from the trampoline, rather than through a
+    # separately compiled function, so that LLVM sees the whole call
+    if isinstance(value, types.Optional):
+        return lambda ctx, value: sqlite3_result_number(ctx, unwrap_optional(value))
+    if isinstance(value, types.Float):
+        return lambda ctx, value: sqlite3_result_double(ctx, np.float64(value))
+    if isinstance(value, types.Boolean):
+        return lambda ctx, value: sqlite3_result_int(ctx, np.int32(1 if value else 0))
+    if isinstance(value, types.Integer):
+        if value.bitwidth < 32 or (value.signed and value.bitwidth == 32):
+            return lambda ctx, value: sqlite3_result_int(ctx, np.int32(value))
+        if value.signed or value.bitwidth < 64:
+            return lambda ctx, value: sqlite3_result_int64(ctx, np.int64(value))
+
+        def set_uint64(ctx, value):  # type: ignore[no-untyped-def]
+            # SQLite integers are signed 64-bit integers, so larger values are
+            # stored as the nearest REAL
+            if value > INT64_MAX:
+                sqlite3_result_double(ctx, np.float64(value))
+            else:
+                sqlite3_result_int64(ctx, np.int64(value))
+
+        return set_uint64
+    raise TypeError(f"`{value}` values can't be SQLite results")
+
+
+# the bytes at the start of every aggregate context that track whether its
+# state has been constructed, one word so that the state stays as aligned as
+# SQLite's allocations
+AGGREGATE_CONTEXT_HEADER_SIZE = 8
+
+
+# what scalar functions and aggregates do when a NULL is passed to an argument
+# that isn't optional
+SCALAR_NULL_POLICIES = ("error", "return_null")
+AGGREGATE_NULL_POLICIES = ("error", "skip_row")
+
+
+# the SQLite storage class of each way of storing datetimes and timedeltas
+DATETIME_STORAGE_CLASSES = {
+    "text": SQLITE_TEXT,
+    "integer": SQLITE_INTEGER,
+    "real": SQLITE_FLOAT,
+}
+
+
+def _get_value_method(typename: str, restype: types.Type) -> types.ExternalFunction:
+    return types.ExternalFunction(f"sqlite3_value_{typename}", restype(voidptr))
+
+
+SQLITE3_VALUE_EXTRACTORS = {
+    optional(float64): _get_value_method("double", float64),
+    optional(int64): _get_value_method("int64", int64),
+    optional(int32): _get_value_method("int", intc),
+    optional(string): _get_value_method("text", voidptr),
+    float64: _get_value_method("double", float64),
+    int64: _get_value_method("int64", int64),
+    int32: _get_value_method("int", intc),
+    string: _get_value_method("text", voidptr),
+    # narrower types are cast from the closest type SQLite provides
+    types.float32: _get_value_method("double", float64),
+    types.boolean: _get_value_method("int64", int64),
+    types.int8: _get_value_method("int", intc),
+    types.int16: _get_value_method("int", intc),
+    types.uint8: _get_value_method("int", intc),
+    types.uint16: _get_value_method("int", intc),
+    types.uint32: _get_value_method("int64", int64),
+    types.uint64: _get_value_method("int64", int64),
+}
+
+sqlite3_value_type = _get_value_method("type", intc)
+sqlite3_value_blob = _get_value_method("blob", voidptr)
+sqlite3_value_bytes = _get_value_method("bytes", intc)
+
+# the type of `numpy.ndarray` arguments
+BLOB_ARRAY_TYPE = types.Array(types.uint8, 1, "C", readonly=True)
+
+# the type of `bytes` arguments
+BYTES_TYPE = types.Bytes(types.uint8, 1, "C", readonly=True)
+
+# the SQLite storage class that each argument type is extracted from without
+# conversion
+SQLITE3_STORAGE_CLASSES = {
+    float64: SQLITE_FLOAT,
+    int64: SQLITE_INTEGER,
+    int32: SQLITE_INTEGER,
+    string: SQLITE_TEXT,
+    types.float32: SQLITE_FLOAT,
+    types.boolean: SQLITE_INTEGER,
+    types.int8: SQLITE_INTEGER,
+    types.int16: SQLITE_INTEGER,
+    types.uint8: SQLITE_INTEGER,
+    types.uint16: SQLITE_INTEGER,
+    types.uint32: SQLITE_INTEGER,
+    types.uint64: SQLITE_INTEGER,
+}
+
 
 def _add_linking_libs(context: BaseContext, call: CallInstr) -> None:
     """Add the required libs for the callable to allow inlining."""
@@ -50,17 +293,39 @@ def _add_linking_libs(context: BaseContext, call: CallInstr) -> None:
         context.add_linking_libs(libs)
 
 
-@contextlib.contextmanager
-def gil(pyapi: pythonapi.PythonAPI) -> Generator[ir.AllocaInstr, None, None]:
-    """Generate instructions to hold the GIL."""
-    locked_gil = pyapi.gil_ensure()
-    try:
-        yield locked_gil
-    finally:
-        pyapi.gil_release(locked_gil)
+def call_external(
+    context: BaseContext,
+    builder: IRBuilder,
+    fn: types.ExternalFunction,
+    args: Sequence[Value],
+) -> CallInstr:
+    """Generate a direct call to the C function `fn`, bound by symbol name.
+
+    This is the same code numba generates when calling a
+    `numba.types.ExternalFunction` from a jitted function. Unlike calling a
+    ctypes function, no process-specific address is embedded in the code.
+    """
+    fndesc = funcdesc.ExternalFunctionDescriptor(
+        fn.symbol, fn.sig.return_type, fn.sig.args
+    )
+    callee = context.declare_external_function(builder.module, fndesc)
+    return context.call_external_function(builder, callee, fndesc.argtypes, args)
+
+
+def keep_reference_counting(builder: IRBuilder) -> None:
+    """Stop numba from removing reference counting from the function being
+    built.
+
+    Numba removes every incref and decref from functions whose arguments and
+    return value don't need them, assuming that such functions can't create
+    references that outlive them.
+    """
+    module = builder.module
+    nmd = module.add_named_metadata("numba_args_may_always_need_nrt")
+    nmd.add(module.add_metadata([builder.function]))
 
 
-@extending.intrinsic  # type: ignore[misc]
+@extending.intrinsic  # type: ignore[misc, untyped-decorator]
 def unsafe_cast(
     typingctx: Context,
     src: types.Integer,
@@ -125,18 +390,19 @@ def unsafe_cast(
     raise TypeError(f"Unable to cast pointer type {src} to class type {dst}")
 
 
-@extending.intrinsic  # type: ignore[misc]
+@extending.intrinsic  # type: ignore[misc, untyped-decorator]
 def init(
     typingctx: Context,
     inst_typ: types.ClassInstanceType,
-    user_data: types.Integer,
+    header: types.Integer,
 ) -> Tuple[
     Signature,
     Callable[[BaseContext, IRBuilder, Signature, Tuple[Value, Value]], None],
 ]:
-    """Initialize a `jitclass` by calling its constructor."""
+    """Initialize a `jitclass` by calling its constructor, unless the
+    aggregate context that starts with `header` already has been."""
     if isinstance(inst_typ, types.ClassInstanceType) and isinstance(
-        user_data, types.Integer
+        header, types.Integer
     ):
         sig = types.void(inst_typ, types.voidptr)
 
@@ -146,10 +412,11 @@ def init(
             signature: Signature,
             args: Tuple[Value, Value],
         ) -> None:
-            instance, user_data = args
+            instance, header = args
 
-            # cast the user-defined void* payload to bool*
-            raw = builder.bitcast(user_data, cgutils.bool_t.as_pointer())
+            # SQLite zero-fills new aggregate contexts, so the first byte of
+            # the header is false until the constructor has been called
+            raw = builder.bitcast(header, cgutils.bool_t.as_pointer())
 
             # generate an if statement to check whether the constructor has
             # been called
@@ -163,10 +430,14 @@ def init(
 
                 _add_linking_libs(context, fn)
 
-                # set the blob to True to indicate that the constructor has
+                # set the header to True to indicate that the constructor has
                 # been called
                 builder.store(context.get_constant(types.boolean, True), raw)
 
+                # point array fields at their storage before the constructor
+                # can use them
+                init_inline_arrays(context, builder, inst_typ, instance)
+
                 # call the constructor on the instance
                 fn(builder, [instance])
 
@@ -178,28 +449,203 @@ def python_type_hints_to_numba_signature(
     type_hints: MutableMapping[str, Any], *, self_type: types.ClassInstanceType
 ) -> Signature:
     """Convert a Python `inspect.Signature` object into a numba `Signature`."""
-    return_type = extending.as_numba_type(type_hints.pop("return"))
+    return_type = as_numba_type(type_hints.pop("return"))
     return return_type(
         extending.as_numba_type(self_type),
-        *map(extending.as_numba_type, type_hints.values()),
+        *map(as_numba_type, type_hints.values()),
     )
 
 
-@extending.intrinsic  # type: ignore[misc]
-def reset_init(
-    typingctx: Context,
-    user_data: types.Integer,
+def as_numba_type(type_hint: Any) -> types.Type:
+    """Convert a Python type hint into a numba type.
+
+    On top of the type hints numba understands, `numpy.ndarray` is a read-only
+    array of the bytes of a BLOB, `numpy.typing.NDArray[dtype]` is a
+    read-only array of `dtype` viewing the bytes of a BLOB and `bytes` is a
+    numba bytes object viewing the bytes of a BLOB. NumPy scalar types such
+    as `numpy.int8` and `numpy.float32` are the matching numba types, and
+    `numpy.datetime64` and `numpy.timedelta64` are datetimes and timedeltas of
+    the unit they're annotated with. `typing.NamedTuple` classes are named
+    tuples of the types of their fields. Other annotations are ignored.
+    """
+    if type_hint is np.ndarray:
+        return BLOB_ARRAY_TYPE
+    if type_hint is bytes:
+        return BYTES_TYPE
+
+    datetime_type = datetime_type_hint(type_hint)
+    if datetime_type is not None:
+        numba_type, _ = datetime_type
+        return numba_type
+    if typing.get_origin(type_hint) is typing.Annotated:
+        return as_numba_type(typing.get_args(type_hint)[0])
+
+    if isinstance(type_hint, type) and issubclass(type_hint, np.generic):
+        return numba.from_dtype(np.dtype(type_hint))
+
+    if (
+        isinstance(type_hint, type)
+        and issubclass(type_hint, tuple)
+        and hasattr(type_hint, "_fields")
+    ):
+        field_hints = typing.get_type_hints(type_hint, include_extras=True)
+        return types.NamedTuple(
+            [as_numba_type(field_hints[name]) for name in type_hint._fields],
+            type_hint,
+        )
+
+    origin = typing.get_origin(type_hint)
+    if origin is tuple:
+        return types.BaseTuple.from_types(
+            [as_numba_type(member) for member in typing.get_args(type_hint)]
+        )
+    if origin is np.ndarray:
+        _, dtype_hint = typing.get_args(type_hint)
+        (scalar_type,) = typing.get_args(dtype_hint)
+        # SQLite doesn't guarantee any particular alignment of BLOB data
+        return types.Array(
+            numba.from_dtype(np.dtype(scalar_type)),
+            1,
+            "C",
+            readonly=True,
+            aligned=False,
+        )
+    if origin in (typing.Union, pytypes.UnionType):
+        members = typing.get_args(type_hint)
+        if len(members) == 2 and type(None) in members:
+            (member,) = (member for member in members if member is not type(None))
+            return types.optional(as_numba_type(member))
+    return extending.as_numba_type(type_hint)
+
+
+def type_hint_alternatives(type_hint: Any) -> List[types.Type]:
+    """Convert a Python type hint into the numba types it allows.
+
+    A union of several types, not counting `None`, allows each of them, and
+    they're all optional if `None` is part of the union.
+    """
+    if typing.get_origin(type_hint) in (typing.Union, pytypes.UnionType):
+        members = typing.get_args(type_hint)
+        alternatives = [member for member in members if member is not type(None)]
+        if len(alternatives) > 1:
+            nullable = len(alternatives) < len(members)
+            return [
+                as_numba_type(typing.Optional[alternative] if nullable else alternative)
+                for alternative in alternatives
+            ]
+    return [as_numba_type(type_hint)]
+
+
+def variadic_arguments_type(type_hint: Any, *, func_name: str) -> VariadicArguments:
+    """Convert the type hint of the `*args` of a user-defined function into
+    the numba type of the arguments it collects.
+
+    The arguments must all have the same type, which may be optional.
+    """
+    alternatives = type_hint_alternatives(type_hint)
+    if len(alternatives) > 1:
+        raise TypeError(
+            f"`*args` of `{func_name}` must have a single type, got {alternatives}"
+        )
+    (dtype,) = alternatives
+    return VariadicArguments(
+        dtype, func_name=func_name, storage=declared_storage(type_hint)
+    )
+
+
+def is_blob_type(typ: types.Type) -> bool:
+    """Return whether values of `typ`, optional or not, map to SQLite BLOBs."""
+    return isinstance(getattr(typ, "type", typ), types.Buffer)
+
+
+def is_datetime_type(typ: types.Type) -> bool:
+    """Return whether values of `typ`, optional or not, are datetimes or
+    timedeltas."""
+    return isinstance(getattr(typ, "type", typ), (types.NPDatetime, types.NPTimedelta))
+
+
+def is_tuple_type(typ: types.Type) -> bool:
+    """Return whether values of `typ`, optional or not, are tuples."""
+    return isinstance(getattr(typ, "type", typ), types.BaseTuple)
+
+
+def declared_storages(
+    py_func: Callable[..., Any],
+) -> Tuple[List[Optional[str]], Optional[str]]:
+    """Return how the datetimes and timedeltas that `py_func` takes and
+    returns are stored in SQLite, and how the tuples it returns are encoded.
+
+    The storage of each parameter is `None` if it isn't a datetime or
+    timedelta, and the storage of the return value is `None` if it isn't a
+    datetime, timedelta or tuple.
+    """
+    type_hints = typing.get_type_hints(py_func, include_extras=True)
+    parameters = inspect.signature(py_func).parameters
+    return_hint = type_hints.get("return")
+    return (
+        [declared_storage(type_hints.get(name)) for name in parameters],
+        declared_storage(return_hint) or declared_encoding(return_hint),
+    )
+
+
+def storage_class(argtype: types.Type, storage: Optional[str] = None) -> int:
+    """Return the SQLite storage class that values of `argtype` come from.
+
+    Datetimes and timedeltas come from the storage class of their `storage`.
+    """
+    if is_blob_type(argtype):
+        return SQLITE_BLOB
+    if is_datetime_type(argtype):
+        assert storage is not None, "datetimes and timedeltas declare a storage"
+        return DATETIME_STORAGE_CLASSES[storage]
+    return SQLITE3_STORAGE_CLASSES[getattr(argtype, "type", argtype)]
+
+
+def accepts_return_type(declared_type: types.Type, return_type: types.Type) -> bool:
+    """Return whether a function declared to return `declared_type` can
+    return values of `return_type`.
+
+    Arrays only have to match the dtype they're declared with, and a bare
+    `numpy.ndarray` return type accepts arrays of any dtype.
+    """
+    if isinstance(declared_type, types.Optional):
+        if return_type == types.none:
+            return True
+        declared_type = declared_type.type
+        if isinstance(return_type, types.Optional):
+            return_type = return_type.type
+
+    if isinstance(declared_type, types.Buffer):
+        return isinstance(return_type, types.Buffer) and (
+            declared_type == BLOB_ARRAY_TYPE or return_type.dtype == declared_type.dtype
+        )
+    return return_type == declared_type
+
+
+def is_heap_type(typ: types.Type) -> bool:
+    """Return whether values of `typ` own memory allocated by numba that an
+    aggregate has to release once it's done with them."""
+    return isinstance(typ, (types.UnicodeType, types.ListType, types.DictType))
+
+
+def _heap_fields(inst_typ: types.ClassInstanceType) -> List[Tuple[str, types.Type]]:
+    return [(name, typ) for name, typ in inst_typ.struct.items() if is_heap_type(typ)]
+
+
+@extending.intrinsic  # type: ignore[misc, untyped-decorator]
+def release_state(
+    typingctx: Context, inst_typ: types.ClassInstanceType
 ) -> Tuple[
     Signature, Callable[[BaseContext, IRBuilder, Signature, Tuple[Value]], None]
 ]:
-    """Reset the user data when `finalize` is called.
-
-    This call ensures that the constructor is called the next time the `step`
-    method is invoked.
+    """Release the strings, lists and dicts held by the fields of an
+    aggregate's state, and reset the fields.
 
+    SQLite frees the state itself, but has no idea that fields point to memory
+    owned by numba.
     """
-    if isinstance(user_data, types.Integer):
-        sig = types.void(types.voidptr)
+    if isinstance(inst_typ, types.ClassInstanceType):
+        sig = types.void(inst_typ)
 
         def codegen(
             context: BaseContext,
@@ -207,300 +653,2165 @@ def reset_init(
             signature: Signature,
             args: Tuple[Value],
         ) -> None:
-            (user_data,) = args
-            # cast the user defined data structure, (which is current a pointer
-            # to a boolean indicating whether the constructor has been called)
-            # to a pointer to bool
-            #
-            # void pointer is the typical way to customize end-user data
-            # structures in C
-            raw = builder.bitcast(user_data, cgutils.bool_t.as_pointer())
-            builder.store(context.get_constant(types.boolean, False), raw)
+            (instance,) = args
+            fields = _heap_fields(inst_typ)
+            if not fields or not context.enable_nrt:
+                return
+
+            keep_reference_counting(builder)
+            data_pointer = context.make_helper(builder, inst_typ, value=instance).data
+            data = context.make_data_helper(
+                builder, inst_typ.get_data_type(), ref=data_pointer
+            )
+            for name, typ in fields:
+                attr = _mangle_attr(name)
+                context.nrt.decref(builder, typ, getattr(data, attr))
+                # releasing twice is harmless
+                setattr(data, attr, context.get_constant_null(typ))
 
         return sig, codegen
 
-    raise TypeError(f"Unable to uninitialize flag of type `{user_data}`")
+    raise TypeError(f"Unable to release the state of type `{inst_typ}`")
 
 
-@extending.intrinsic  # type: ignore[misc]
-def safe_decref(
-    typingctx: Context,
-    pyobject_type: types.RawPointer,
-) -> Tuple[
-    Signature, Callable[[BaseContext, IRBuilder, Signature, Tuple[Value]], None]
-]:
-    """Safely decrement the reference count of a Python object.
+def heap_size(value: Any) -> int:
+    raise NotImplementedError(type(value))
 
-    Notes
-    -----
-    This function holds the GIL.
 
-    There is no cause for concerns about performance here: this function is
-    only called when the SQLite user data blob is destroyed, which happens when
-    a database connection is closed.
+def _itemsize(typ: types.Type) -> int:
+    context = cpu_target.target_context
+    return context.get_abi_sizeof(context.get_data_type(typ))
 
-    Additionally the GIL is only held if the user data is not a null pointer.
-    """
-    if isinstance(pyobject_type, types.RawPointer):
-        sig = types.void(types.voidptr)
+
+@extending.overload(heap_size)  # type: ignore[misc]
+def ol_heap_size(value):  # type: ignore[no-untyped-def]
+    """Approximate the number of bytes of memory owned by `value`."""
+    if isinstance(value, types.UnicodeType):
+        return lambda value: len(value) * value._kind
+    if isinstance(value, types.ListType):
+        itemsize = _itemsize(value.item_type)
+        if not is_heap_type(value.item_type):
+            return lambda value: len(value) * itemsize
+
+        def list_size(value):  # type: ignore[no-untyped-def]
+            size = len(value) * itemsize
+            for item in value:
+                size += heap_size(item)
+            return size
+
+        return list_size
+    if isinstance(value, types.DictType):
+        itemsize = _itemsize(value.key_type) + _itemsize(value.value_type)
+        if not (is_heap_type(value.key_type) or is_heap_type(value.value_type)):
+            return lambda value: len(value) * itemsize
+
+        def dict_size(value):  # type: ignore[no-untyped-def]
+            size = len(value) * itemsize
+            for key, item in value.items():
+                size += heap_size(key) + heap_size(item)
+            return size
+
+        return dict_size
+    return lambda value: 0
+
+
+def _heap_size(value):  # type: ignore[no-untyped-def]
+    return heap_size(value)
+
+
+@extending.intrinsic  # type: ignore[misc, untyped-decorator]
+def state_size(
+    typingctx: Context, inst_typ: types.ClassInstanceType
+) -> Tuple[
+    Signature, Callable[[BaseContext, IRBuilder, Signature, Tuple[Value]], Value]
+]:
+    """Approximate the number of bytes of memory held by the strings, lists
+    and dicts in the fields of an aggregate's state."""
+    if isinstance(inst_typ, types.ClassInstanceType):
+        sig = types.intp(inst_typ)
 
         def codegen(
             context: BaseContext,
             builder: IRBuilder,
             signature: Signature,
             args: Tuple[Value],
-        ) -> None:
-            (user_data,) = args
-            pyapi = context.get_python_api(builder)
-            # check whether the pyobject is null, (likely not)
-            with cgutils.if_likely(builder, cgutils.is_not_null(builder, user_data)):
-                # we can't call decref safely without holding the GIL
-                with gil(pyapi):
-                    pyapi.decref(user_data)
+        ) -> Value:
+            (instance,) = args
+            data_pointer = context.make_helper(builder, inst_typ, value=instance).data
+            data = context.make_data_helper(
+                builder, inst_typ.get_data_type(), ref=data_pointer
+            )
+            size = context.get_constant(types.intp, 0)
+            for name, typ in _heap_fields(inst_typ):
+                field_size = context.compile_internal(
+                    builder,
+                    _heap_size,
+                    types.intp(typ),
+                    [getattr(data, _mangle_attr(name))],
+                )
+                size = builder.add(size, field_size)
+            return size
 
         return sig, codegen
 
-    raise TypeError(
-        f"Unable to decrement the reference count of type `{pyobject_type}`"
-    )
+    raise TypeError(f"Unable to compute the size of the state of type `{inst_typ}`")
 
 
-@extending.intrinsic  # type: ignore[misc]
-def make_arg_tuple(
-    typingctx: Context, func: types.Callable, argv: types.CPointer
+@extending.intrinsic  # type: ignore[misc, untyped-decorator]
+def sqlite3_result_error(
+    typingctx: Context, ctx: types.RawPointer, message: types.UnicodeType
 ) -> Tuple[
     Signature,
-    Callable[
-        [BaseContext, IRBuilder, Signature, Tuple[Value, Value]],
-        InsertValue,
-    ],
+    Callable[[BaseContext, IRBuilder, Signature, Tuple[Value, Value]], None],
 ]:
-    """Construct a typed argument tuple to pass to a user-defined function."""
-    (func_type,), _ = func.get_call_signatures()
-    first_arg, *_ = args = func_type.args
+    """Make a UDF call fail with an ASCII error `message`."""
+    if isinstance(message, types.UnicodeType):
+        sig = types.void(ctx, message)
 
-    # skip the first argument if `func` is a method call
-    first_argument_position = int(isinstance(first_arg, types.ClassInstanceType))
-    argtypes = args[first_argument_position:]
-    tuple_type = types.Tuple(argtypes)
-    sig = tuple_type(func, types.CPointer(types.voidptr))
+        def codegen(
+            context: BaseContext,
+            builder: IRBuilder,
+            signature: Signature,
+            args: Tuple[Value, Value],
+        ) -> None:
+            ctx, message = args
+            uni_str = cgutils.create_struct_proxy(signature.args[1])(
+                context, builder, value=message
+            )
+            call_external(
+                context,
+                builder,
+                sqlite3_result_error_external,
+                [
+                    ctx,
+                    uni_str.data,
+                    builder.trunc(uni_str.length, context.get_value_type(types.intc)),
+                ],
+            )
 
-    def codegen(
-        context: BaseContext,
-        builder: IRBuilder,
-        signature: Signature,
-        args: Tuple[Value, Value],
-    ) -> InsertValue:
-        # first argument is the instance, and we don't need it here
-        _, argv = args
+        return sig, codegen
+
+    raise TypeError(f"Unable to report an error of type `{message}`")
 
-        # initialize a list to hold the converted function arguments
-        converted_args = []
 
-        # grab the python API object, which we use in the case of encountering
-        # asn unexpected null value
-        pyapi = context.get_python_api(builder)
+def extract_value(
+    context: BaseContext,
+    builder: IRBuilder,
+    valtype: types.Type,
+    sqlite3_value: Value,
+    *,
+    borrow_text: bool = True,
+    storage: Optional[str] = None,
+) -> Value:
+    """Convert a SQLite value that isn't NULL to a numba value of `valtype`.
 
-        # make the SQLITE_NULL value type constant available
-        sqlite_null = context.get_constant(types.int32, SQLITE_NULL)
+    ASCII text is viewed in place if `borrow_text` is true, and copied
+    otherwise. Datetimes and timedeltas are converted from their `storage`.
+    """
+    if isinstance(valtype, types.Buffer):
+        return map_sqlite_blob_to_numba_array(
+            context, builder, valtype, sqlite3_value=sqlite3_value
+        )
+    if is_datetime_type(valtype):
+        return map_sqlite_value_to_datetime(
+            context, builder, valtype, sqlite3_value=sqlite3_value, storage=storage
+        )
 
-        # get a pointer to the sqlite3_value_type C function
-        sqlite3_value_type_numba = context.get_constant_generic(
-            builder,
-            ctypes_utils.make_function_type(sqlite3_value_type),
-            sqlite3_value_type,
+    if isinstance(valtype, types.UnicodeType):
+        return map_sqlite_string_to_numba_uni_str(
+            context, builder, sqlite3_value=sqlite3_value, borrow=borrow_text
+        )
+    if valtype == types.uint64:
+        return map_sqlite_number_to_uint64(
+            context, builder, sqlite3_value=sqlite3_value
         )
 
-        for i, argtype in enumerate(argtypes):
-            # get a pointer to the ith argument
-            sqlite3_value_pointer = cgutils.gep(builder, argv, i, inbounds=True)
+    extractor = SQLITE3_VALUE_EXTRACTORS[valtype]
+    raw = call_external(context, builder, extractor, [sqlite3_value])
 
-            # deref that pointer
-            sqlite3_value = builder.load(sqlite3_value_pointer)
+    # integers that don't fit in a narrower type keep their low bits, like
+    # sqlite3_value_int does, and nonzero integers are true
+    return context.cast(builder, raw, extractor.sig.return_type, valtype)
 
-            # the previous two instructions are equivalent to the following C code:
-            #
-            # sqlite3_value** args; // this is passed in
-            # args[i] // or *(args + i)
 
-            # call the SQLite C API to get the value type
-            value_type = builder.call(sqlite3_value_type_numba, [sqlite3_value])
+def map_sqlite_number_to_uint64(
+    context: BaseContext,
+    builder: IRBuilder,
+    *,
+    sqlite3_value: Value,
+) -> Value:
+    """Convert a SQLite value to a numba uint64.
+
+    INTEGERs are reinterpreted as unsigned. REALs, which is how `uint64`
+    results larger than SQLite's INTEGERs are stored, are truncated and
+    clamped to the range of uint64, with NaN converted to zero. SQLite
+    converts any other value to an INTEGER.
+    """
+    uint64_type = context.get_value_type(types.uint64)
+    value_type = call_external(context, builder, sqlite3_value_type, [sqlite3_value])
+    result = cgutils.alloca_once(builder, uint64_type)
+    with builder.if_else(
+        builder.icmp_signed("==", value_type, value_type.type(SQLITE_FLOAT))
+    ) as (then, otherwise):
+        with then:
+            number = call_external(
+                context, builder, SQLITE3_VALUE_EXTRACTORS[float64], [sqlite3_value]
+            )
+            builder.store(
+                builder.select(
+                    builder.fcmp_ordered(">=", number, number.type(2.0**64)),
+                    uint64_type(np.iinfo(np.uint64).max),
+                    builder.select(
+                        builder.fcmp_ordered(">", number, number.type(0.0)),
+                        builder.fptoui(number, uint64_type),
+                        uint64_type(0),
+                    ),
+                ),
+                result,
+            )
+        with otherwise:
+            builder.store(
+                call_external(
+                    context, builder, SQLITE3_VALUE_EXTRACTORS[int64], [sqlite3_value]
+                ),
+                result,
+            )
+    return builder.load(result)
+
 
-            # check whether the value is equal to SQLITE_NULL
-            is_not_sqlite_null = builder.icmp_signed("!=", value_type, sqlite_null)
+def extract_args(
+    context: BaseContext,
+    builder: IRBuilder,
+    argtypes: Sequence[types.Type],
+    argv: Value,
+    *,
+    missing: Value,
+    borrow_text: bool = True,
+    storages: Optional[Sequence[Optional[str]]] = None,
+) -> List[Value]:
+    """Convert the SQLite values in `argv` to numba values of `argtypes`.
+
+    ASCII text is viewed in place if `borrow_text` is true, and copied
+    otherwise. Datetimes and timedeltas are converted from the matching
+    element of `storages`. True is stored in `missing` if a value that isn't
+    optional is NULL.
+    """
+    if storages is None:
+        storages = [None] * len(argtypes)
+
+    # initialize a list to hold the converted function arguments
+    converted_args = []
+
+    for i, (argtype, storage) in enumerate(zip(argtypes, storages)):
+        # get a pointer to the ith argument
+        sqlite3_value_pointer = cgutils.gep(builder, argv, i, inbounds=True)
+
+        # deref that pointer
+        sqlite3_value = builder.load(sqlite3_value_pointer)
+
+        # the previous two instructions are equivalent to the following C code:
+        #
+        # sqlite3_value** args; // this is passed in
+        # args[i] // or *(args + i)
+        converted_args.append(
+            extract_arg(
+                context,
+                builder,
+                argtype,
+                sqlite3_value,
+                missing=missing,
+                borrow_text=borrow_text,
+                storage=storage,
+            )
+        )
 
-            # get the appropriate ctypes extraction routine
-            ctypes_function = SQLITE3_VALUE_EXTRACTORS[argtype]
+    return converted_args
 
-            # create a numba function type for the converter
-            converter = ctypes_utils.make_function_type(ctypes_function)
 
-            # get the function pointer instruction out
-            fn = context.get_constant_generic(builder, converter, ctypes_function)
+def extract_arg(
+    context: BaseContext,
+    builder: IRBuilder,
+    argtype: types.Type,
+    sqlite3_value: Value,
+    *,
+    missing: Value,
+    borrow_text: bool = True,
+    storage: Optional[str] = None,
+) -> Value:
+    """Convert a SQLite value, which may be NULL, to a numba value of
+    `argtype`.
+
+    If `argtype` isn't optional and the value is NULL, true is stored in
+    `missing` and the converted value is zeroed.
+    """
+    # make the SQLITE_NULL value type constant available
+    sqlite_null = context.get_constant(types.int32, SQLITE_NULL)
 
-            # if the argument is an optional type then pull out the underlying
-            # type and make an optional value with it
-            #
-            # otherwise the raw value is the argument
-            raw = builder.call(fn, [sqlite3_value])
-            out_type = context.get_value_type(argtype)
-            instr = cgutils.alloca_once(builder, out_type)
-            underlying_type = getattr(argtype, "type", argtype)
-
-            if isinstance(argtype, types.Optional):
-                # branch to handle null values
-                with builder.if_else(is_not_sqlite_null) as (then, otherwise):
-                    with then:
-                        # you _must_ put code that only executes in this block,
-                        # in the part of the context manager that will execute
-                        # it, otherwise the code outside of the block can be
-                        # executed unconditionally, leading to sadness
-                        #
-                        # in this case, we put string wrapping here so that
-                        # strlen isn't called on invalid data
-                        value = context.make_optional_value(
-                            builder,
-                            underlying_type,
-                            (
-                                raw
-                                if not isinstance(underlying_type, types.UnicodeType)
-                                else map_sqlite_string_to_numba_uni_str(
-                                    context,
-                                    builder,
-                                    data=builder.inttoptr(raw, sqlite3_value.type),
-                                )
-                            ),
-                        )
-                        builder.store(value, instr)
+    # call the SQLite C API to get the value type
+    value_type = call_external(context, builder, sqlite3_value_type, [sqlite3_value])
 
-                    with otherwise:
-                        # create a none value, because we encounted a NULL
-                        none = context.make_optional_none(builder, underlying_type)
-                        builder.store(none, instr)
-            else:
-                # raise an exception if the value is NULL, because the input
-                # type is not optional and therefore cannot handle NULLs
+    # check whether the value is equal to SQLITE_NULL
+    is_not_sqlite_null = builder.icmp_signed("!=", value_type, sqlite_null)
+
+    # if the argument is an optional type then pull out the underlying
+    # type and make an optional value with it
+    #
+    # otherwise the extracted value is the argument
+    out_type = context.get_value_type(argtype)
+    instr = cgutils.alloca_once(builder, out_type, zfill=True)
+    underlying_type = getattr(argtype, "type", argtype)
+
+    if isinstance(argtype, types.Optional):
+        # branch to handle null values
+        with builder.if_else(is_not_sqlite_null) as (then, otherwise):
+            with then:
+                # you _must_ put code that only executes in this block,
+                # in the part of the context manager that will execute
+                # it, otherwise the code outside of the block can be
+                # executed unconditionally, leading to sadness
                 #
-                # favor the branch where the value isn't null, since it's
-                # an error condition to accept null values without an option type
-                with builder.if_else(is_not_sqlite_null, likely=True) as (
-                    then,
-                    otherwise,
-                ):
-                    with then:
-                        value = (
-                            raw
-                            if not isinstance(underlying_type, types.UnicodeType)
-                            else map_sqlite_string_to_numba_uni_str(
-                                context,
-                                builder,
-                                data=builder.inttoptr(raw, sqlite3_value.type),
-                            )
-                        )
+                # in this case, we put extraction here so that for
+                # example text isn't decoded from invalid data
+                value = context.make_optional_value(
+                    builder,
+                    underlying_type,
+                    extract_value(
+                        context,
+                        builder,
+                        underlying_type,
+                        sqlite3_value,
+                        borrow_text=borrow_text,
+                        storage=storage,
+                    ),
+                )
+                builder.store(value, instr)
+
+            with otherwise:
+                # create a none value, because we encounted a NULL
+                none = context.make_optional_none(builder, underlying_type)
+                builder.store(none, instr)
+    else:
+        # raise an exception if the value is NULL, because the input
+        # type is not optional and therefore cannot handle NULLs
+        #
+        # favor the branch where the value isn't null, since it's
+        # an error condition to accept null values without an option type
+        with builder.if_else(is_not_sqlite_null, likely=True) as (
+            then,
+            otherwise,
+        ):
+            with then:
+                value = extract_value(
+                    context,
+                    builder,
+                    underlying_type,
+                    sqlite3_value,
+                    borrow_text=borrow_text,
+                    storage=storage,
+                )
+                builder.store(value, instr)
+
+            with otherwise:
+                # the caller decides what to do about the NULL, without
+                # touching the GIL
+                builder.store(cgutils.true_bit, missing)
+
+    # instr is a pointer, so we need to dereference it to use it later
+    return builder.load(instr)
+
+
+class VariadicArguments(types.IterableType):
+    """The type of the arguments that a user-defined function collects with
+    `*args`, which are all of type `dtype`.
+
+    The arguments are SQLite values that are only converted when they're
+    accessed.
+    """
 
-                        builder.store(value, instr)
+    def __init__(
+        self, dtype: types.Type, *, func_name: str, storage: Optional[str] = None
+    ) -> None:
+        self.dtype = dtype
+        self.func_name = func_name
+        self.storage = storage
+        super().__init__(
+            name=(
+                f"VariadicArguments({dtype}, func_name={func_name!r}, "
+                f"storage={storage})"
+            )
+        )
 
-                    with otherwise:
-                        # without the GIL here we're deep in undefined behavior
-                        # land
-                        with gil(pyapi):
-                            pyapi.err_set_string(
-                                "PyExc_ValueError",
-                                (
-                                    "encountered unexpected NULL in call to "
-                                    "user-defined numba function "
-                                    f"{func.dispatcher.py_func.__name__!r}"
-                                ),
-                            )
+    @property
+    def iterator_type(self) -> VariadicArgumentsIterator:
+        return VariadicArgumentsIterator(self)
 
-            # instr is a pointer, so we need to dereference it to use it later
-            # in the argument tuple
-            converted_args.append(builder.load(instr))
 
-        # construct a tuple of arguments (fixed length and known types)
-        arg_tuple = context.make_tuple(builder, tuple_type, converted_args)
-        return imputils.impl_ret_untracked(context, builder, tuple_type, arg_tuple)
+class VariadicArgumentsIterator(types.SimpleIteratorType):
+    """The type of an iterator over `VariadicArguments`."""
 
-    return sig, codegen
+    def __init__(self, arguments_type: VariadicArguments) -> None:
+        self.arguments_type = arguments_type
+        super().__init__(f"iter({arguments_type})", arguments_type.dtype)
 
 
-def map_sqlite_string_to_numba_uni_str(
+@extending.register_model(VariadicArguments)
+class VariadicArgumentsModel(extending.models.StructModel):
+    def __init__(self, dmm: Any, fe_type: VariadicArguments) -> None:
+        members = [("argc", types.intp), ("argv", types.CPointer(types.voidptr))]
+        super().__init__(dmm, fe_type, members)
+
+
+@extending.register_model(VariadicArgumentsIterator)
+class VariadicArgumentsIteratorModel(extending.models.StructModel):
+    def __init__(self, dmm: Any, fe_type: VariadicArgumentsIterator) -> None:
+        members = [
+            ("index", types.EphemeralPointer(types.intp)),
+            ("arguments", fe_type.arguments_type),
+        ]
+        super().__init__(dmm, fe_type, members)
+
+
+def make_variadic_arguments(
     context: BaseContext,
     builder: IRBuilder,
+    arguments_type: VariadicArguments,
     *,
-    data: Value,
-) -> LoadInstr:
-    """Construct a Numba string from a raw C string coming from SQLite.
+    argc: Value,
+    argv: Value,
+    start: int,
+) -> Value:
+    """Construct the `VariadicArguments` made of the SQLite values in `argv`
+    from position `start` on."""
+    arguments = cgutils.create_struct_proxy(arguments_type)(context, builder)
+    intp_type = context.get_value_type(types.intp)
+    arguments.argc = builder.sub(builder.sext(argc, intp_type), intp_type(start))
+    arguments.argv = cgutils.gep(builder, argv, start, inbounds=True)
+    return arguments._getvalue()
+
+
+def get_variadic_argument(
+    context: BaseContext,
+    builder: IRBuilder,
+    arguments_type: VariadicArguments,
+    arguments: Value,
+    index: Value,
+) -> Value:
+    """Convert the SQLite value at `index`, which is known to be in bounds, to
+    a numba value."""
+    proxy = cgutils.create_struct_proxy(arguments_type)(
+        context, builder, value=arguments
+    )
+    sqlite3_value = builder.load(builder.gep(proxy.argv, [index], inbounds=True))
+    # `call_udf` checks for NULLs before the user-defined function is called
+    missing = cgutils.alloca_once_value(builder, cgutils.false_bit)
+    return extract_arg(
+        context,
+        builder,
+        arguments_type.dtype,
+        sqlite3_value,
+        missing=missing,
+        storage=arguments_type.storage,
+    )
 
-    There's no way this implementation is correct.
 
-    Notes
-    -----
-    This implementation is probably FULL of undefined behavior
+@extending.intrinsic  # type: ignore[misc, untyped-decorator]
+def variadic_argc(
+    typingctx: Context, arguments: VariadicArguments
+) -> Tuple[
+    Signature,
+    Callable[[BaseContext, IRBuilder, Signature, Tuple[Value]], Value],
+]:
+    """Return the number of arguments collected by `*args`."""
+    sig = types.intp(arguments)
 
-    We tell numba to treat a const unsigned char* coming from SQLite as a
-    numba-unmanaged unicode string.
-    """
-    # construct a numba-aware struct wrapper for a string
-    uni_str = cgutils.create_struct_proxy(types.string)(context, builder)
+    def codegen(
+        context: BaseContext,
+        builder: IRBuilder,
+        signature: Signature,
+        args: Tuple[Value],
+    ) -> Value:
+        (arguments,) = args
+        return cgutils.create_struct_proxy(signature.args[0])(
+            context, builder, value=arguments
+        ).argc
 
-    # point it at the SQLite string data
-    uni_str.data = data
+    return sig, codegen
 
-    # compute the length of the string
-    uni_str.length = builder.call(
-        context.get_constant_generic(
-            builder,
-            ctypes_utils.make_function_type(strlen),
-            strlen,
-        ),
-        [data],
+
+@extending.intrinsic  # type: ignore[misc, untyped-decorator]
+def variadic_getitem(
+    typingctx: Context, arguments: VariadicArguments, index: types.Integer
+) -> Tuple[
+    Signature,
+    Callable[[BaseContext, IRBuilder, Signature, Tuple[Value, Value]], Value],
+]:
+    """Convert the argument at `index`, which must be in bounds, to a numba
+    value."""
+    sig = arguments.dtype(arguments, types.intp)
+
+    def codegen(
+        context: BaseContext,
+        builder: IRBuilder,
+        signature: Signature,
+        args: Tuple[Value, Value],
+    ) -> Value:
+        arguments, index = args
+        value = get_variadic_argument(
+            context, builder, signature.args[0], arguments, index
+        )
+        # text that isn't ASCII is decoded into a new string
+        return imputils.impl_ret_new_ref(context, builder, signature.return_type, value)
+
+    return sig, codegen
+
+
+@extending.overload(len)  # type: ignore[misc]
+def ol_variadic_len(arguments):  # type: ignore[no-untyped-def]
+    if isinstance(arguments, VariadicArguments):
+        return lambda arguments: variadic_argc(arguments)
+    return None
+
+
+@extending.overload(operator.getitem)  # type: ignore[misc]
+def ol_variadic_getitem(arguments, index):  # type: ignore[no-untyped-def]
+    if isinstance(arguments, VariadicArguments) and isinstance(index, types.Integer):
+
+        def getitem(arguments, index):  # type: ignore[no-untyped-def]
+            argc = variadic_argc(arguments)
+            if index < 0:
+                index += argc
+            if not 0 <= index < argc:
+                raise IndexError("argument index out of range")
+            return variadic_getitem(arguments, index)
+
+        return getitem
+    return None
+
+
+@extending.lower_builtin("getiter", VariadicArguments)  # type: ignore[misc, untyped-decorator]
+def variadic_getiter(
+    context: BaseContext,
+    builder: IRBuilder,
+    signature: Signature,
+    args: Tuple[Value],
+) -> Value:
+    (arguments,) = args
+    iterator = cgutils.create_struct_proxy(signature.return_type)(context, builder)
+    index = cgutils.alloca_once_value(builder, context.get_constant(types.intp, 0))
+    iterator.index = index
+    iterator.arguments = arguments
+    return imputils.impl_ret_borrowed(
+        context, builder, signature.return_type, iterator._getvalue()
     )
 
-    # This is the Python string kind, which numba will use in various string
-    # algorithms.
-    #
-    # TODO: figure out how this maps to the different SQLite text types.
-    # XXX: Is this actually alway valid?
-    uni_str.kind = uni_str.kind.type(numba.cpython.unicode.PY_UNICODE_1BYTE_KIND)
-
-    # SQLite strings are never guaranteed to be anything really, and most
-    # certainly not ASCII.
-    uni_str.is_ascii = builder.zext(
-        context.get_constant(types.boolean, False), uni_str.is_ascii.type
+
+@extending.lower_builtin("iternext", VariadicArgumentsIterator)  # type: ignore[misc, untyped-decorator]
+@imputils.iternext_impl(imputils.RefType.NEW)  # type: ignore[misc, untyped-decorator]
+def variadic_iternext(
+    context: BaseContext,
+    builder: IRBuilder,
+    signature: Signature,
+    args: Tuple[Value],
+    result: imputils._IternextResult,
+) -> None:
+    (iterator_type,) = signature.args
+    (iterator_value,) = args
+    iterator = cgutils.create_struct_proxy(iterator_type)(
+        context, builder, value=iterator_value
+    )
+    arguments_type = iterator_type.arguments_type
+    arguments = cgutils.create_struct_proxy(arguments_type)(
+        context, builder, value=iterator.arguments
     )
 
-    # Tell numba to forget about owning the data, because SQLite owns it.
-    uni_str.meminfo = cgutils.get_null_value(uni_str.meminfo.type)
+    index = builder.load(iterator.index)
+    is_valid = builder.icmp_signed("<", index, arguments.argc)
+    result.set_valid(is_valid)
+    with builder.if_then(is_valid):
+        result.yield_(
+            get_variadic_argument(
+                context, builder, arguments_type, iterator.arguments, index
+            )
+        )
+        builder.store(builder.add(index, index.type(1)), iterator.index)
 
-    # Cribbed from numba string construction code
-    #
-    # Set hash to -1 to indicate that it should be computed.
-    #
-    # We cannot bake in the hash value because of hashseed
-    # randomization.
-    uni_str.hash = uni_str.hash.type(-1)
-    return uni_str._getvalue()
 
+@extending.intrinsic  # type: ignore[misc, untyped-decorator]
+def make_arg_tuple(
+    typingctx: Context, func: types.Callable, argv: types.CPointer
+) -> Tuple[
+    Signature,
+    Callable[
+        [BaseContext, IRBuilder, Signature, Tuple[Value, Value]],
+        Value,
+    ],
+]:
+    """Construct a typed argument tuple to pass to a user-defined function.
 
-def sqlite3_result(ctx: types.Integer, value: Any):  # type: ignore[no-untyped-def]
-    raise NotImplementedError(type(value))
+    Returns whether an argument that isn't optional is NULL, in which case the
+    function must not be called, along with the tuple.
+    """
+    (func_type,), _ = func.get_call_signatures()
+    first_arg, *_ = args = func_type.args
 
+    # skip the first argument if `func` is a method call
+    is_method = isinstance(first_arg, types.ClassInstanceType)
+    argtypes = args[int(is_method) :]
+    storages, _ = declared_storages(func.dispatcher.py_func)
+    storages = storages[int(is_method) :]
+
+    # views of SQLite's text must not outlive the call, so copy any text that
+    # the instance might hold on to
+    borrow_text = not (is_method and _heap_fields(first_arg))
+    tuple_type = types.Tuple(argtypes)
+    result_type = types.Tuple((types.boolean, tuple_type))
+    sig = result_type(func, types.CPointer(types.voidptr))
 
-@extending.overload(sqlite3_result)  # type: ignore[misc]
-def ol_sqlite3_result(ctx, value):  # type: ignore[no-untyped-def]
-    func = SQLITE3_RESULT_SETTERS[value]
-    return lambda ctx, value: func(ctx, value)
+    def codegen(
+        context: BaseContext,
+        builder: IRBuilder,
+        signature: Signature,
+        args: Tuple[Value, Value],
+    ) -> Value:
+        # first argument is the instance, and we don't need it here
+        _, argv = args
+
+        missing = cgutils.alloca_once_value(builder, cgutils.false_bit)
+        converted_args = extract_args(
+            context,
+            builder,
+            argtypes,
+            argv,
+            missing=missing,
+            borrow_text=borrow_text,
+            storages=storages,
+        )
+
+        # construct a tuple of arguments (fixed length and known types)
+        arg_tuple = context.make_tuple(builder, tuple_type, converted_args)
+        result = context.make_tuple(
+            builder, result_type, [builder.load(missing), arg_tuple]
+        )
+        # text arguments may be decoded into new strings
+        return imputils.impl_ret_new_ref(context, builder, result_type, result)
+
+    return sig, codegen
+
+
+def _set_result(ctx, result):  # type: ignore[no-untyped-def]
+    if result is None:
+        sqlite3_result_null(ctx)
+    else:
+        sqlite3_result(ctx, result)
+
+
+def _set_datetime_result(ctx, result, storage):  # type: ignore[no-untyped-def]
+    if result is None:
+        sqlite3_result_null(ctx)
+    else:
+        sqlite3_result_datetime(ctx, result, storage)
+
+
+def _set_structured_result(ctx, result, encoding):  # type: ignore[no-untyped-def]
+    if result is None:
+        sqlite3_result_null(ctx)
+    else:
+        sqlite3_result_structured(ctx, result, encoding)
+
+
+def set_result(
+    context: BaseContext,
+    builder: IRBuilder,
+    ctx: Value,
+    result_type: types.Type,
+    result: Value,
+    *,
+    storage: Optional[str],
+) -> None:
+    """Set the result of `ctx` to `result`, or to NULL if it's None.
+
+    Datetimes and timedeltas are stored as `storage`, and tuples are encoded
+    as `storage`, JSON by default.
+    """
+    if is_datetime_type(result_type):
+        context.compile_internal(
+            builder,
+            _set_datetime_result,
+            types.void(types.voidptr, result_type, types.literal(storage)),
+            [ctx, result, context.get_dummy_value()],
+        )
+    elif is_tuple_type(result_type):
+        context.compile_internal(
+            builder,
+            _set_structured_result,
+            types.void(types.voidptr, result_type, types.literal(storage or "json")),
+            [ctx, result, context.get_dummy_value()],
+        )
+    else:
+        context.compile_internal(
+            builder, _set_result, types.void(types.voidptr, result_type), [ctx, result]
+        )
+
+
+def report_error(
+    context: BaseContext, builder: IRBuilder, ctx: Value, message: str
+) -> None:
+    """Make the SQLite call of `ctx` fail with `message`."""
+    data = message.encode("utf8")
+    call_external(
+        context,
+        builder,
+        sqlite3_result_error_external,
+        [
+            ctx,
+            context.insert_const_bytes(builder.module, data),
+            context.get_constant(types.intc, len(data)),
+        ],
+    )
+
+
+def null_error(func_name: str) -> str:
+    """Return the error reported when a NULL is passed to an argument of
+    `func_name` that isn't optional."""
+    return (
+        "encountered unexpected NULL in call to user-defined numba function "
+        f"{func_name!r}"
+    )
+
+
+def call_compiled(
+    context: BaseContext,
+    builder: IRBuilder,
+    ctx: Value,
+    dispatcher: Any,
+    argtypes: Sequence[types.Type],
+    args: Sequence[Value],
+) -> Tuple[Value, Value]:
+    """Call the specialization of `dispatcher` compiled for `argtypes`.
+
+    An exception raised by the call makes the SQLite call of `ctx` fail,
+    instead of being raised in Python, so the GIL is never needed. Returns
+    whether the call failed, and its result, which is only valid if it didn't.
+    """
+    compile_result = dispatcher.overloads[tuple(argtypes)]
+    context.add_linking_libs([compile_result.library])
+    call_signature = compile_result.signature
+    raised = (
+        f"user-defined function {dispatcher.py_func.__name__!r} raised an exception"
+    )
+    # functions are registered with the slot of their connection's interrupt
+    # state as user data, which `check_interrupt` reads, so only functions
+    # that call it pay for publishing it on every call
+    slot = None
+    if checks_interrupt(compile_result.library):
+        slot = call_external(context, builder, sqlite3_user_data, [ctx])
+        generate_set_current_slot(builder, slot)
+    status, result = context.call_internal_no_propagate(
+        builder, compile_result.fndesc, call_signature, args
+    )
+    with builder.if_then(status.is_error, likely=False):
+        if slot is None:
+            report_error(context, builder, ctx, raised)
+        else:
+            with builder.if_else(generate_is_interrupted(builder, slot)) as (
+                interrupted,
+                otherwise,
+            ):
+                with interrupted:
+                    # most likely `check_interrupt`, so fail like SQLite does
+                    report_error(context, builder, ctx, "interrupted")
+                with otherwise:
+                    report_error(context, builder, ctx, raised)
+    result = imputils.fix_returning_optional(
+        context, builder, call_signature, status, result
+    )
+    return status.is_error, result
+
+
+@extending.intrinsic  # type: ignore[misc, untyped-decorator]
+def call_or_fail(
+    typingctx: Context,
+    ctx: types.RawPointer,
+    func: types.Dispatcher,
+    args: types.BaseTuple,
+) -> Tuple[
+    Signature,
+    Callable[[BaseContext, IRBuilder, Signature, Tuple[Value, Value, Value]], Value],
+]:
+    """Call `func` with the arguments in the tuple `args`, ignoring its
+    result, and return whether the call raised an exception.
+
+    An exception makes the SQLite call of `ctx` fail.
+    """
+    call_signature = typingctx.resolve_function_type(func, tuple(args), {})
+    sig = types.boolean(ctx, func, args)
+
+    def codegen(
+        context: BaseContext,
+        builder: IRBuilder,
+        signature: Signature,
+        llargs: Tuple[Value, Value, Value],
+    ) -> Value:
+        ctx, _, arg_tuple = llargs
+        failed, result = call_compiled(
+            context,
+            builder,
+            ctx,
+            func.dispatcher,
+            call_signature.args,
+            cgutils.unpack_tuple(builder, arg_tuple, len(args)),
+        )
+        if context.enable_nrt:
+            keep_reference_counting(builder)
+            with builder.if_then(builder.not_(failed)):
+                context.nrt.decref(builder, call_signature.return_type, result)
+        return failed
+
+    return sig, codegen
+
+
+@extending.intrinsic  # type: ignore[misc, untyped-decorator]
+def sqlite3_result_of(
+    typingctx: Context,
+    ctx: types.RawPointer,
+    func: types.Dispatcher,
+    args: types.BaseTuple,
+) -> Tuple[
+    Signature,
+    Callable[[BaseContext, IRBuilder, Signature, Tuple[Value, Value, Value]], None],
+]:
+    """Set the result of `ctx` to the value `func` returns when called with
+    the arguments in the tuple `args`, or to NULL if it's None.
+
+    Datetimes and timedeltas are stored the way `func` declares. An exception
+    makes the SQLite call of `ctx` fail.
+    """
+    call_signature = typingctx.resolve_function_type(func, tuple(args), {})
+    _, storage = declared_storages(func.dispatcher.py_func)
+    sig = types.void(ctx, func, args)
+
+    def codegen(
+        context: BaseContext,
+        builder: IRBuilder,
+        signature: Signature,
+        llargs: Tuple[Value, Value, Value],
+    ) -> None:
+        ctx, _, arg_tuple = llargs
+        failed, result = call_compiled(
+            context,
+            builder,
+            ctx,
+            func.dispatcher,
+            call_signature.args,
+            cgutils.unpack_tuple(builder, arg_tuple, len(args)),
+        )
+        return_type = call_signature.return_type
+        with builder.if_then(builder.not_(failed)):
+            set_result(context, builder, ctx, return_type, result, storage=storage)
+            if context.enable_nrt:
+                keep_reference_counting(builder)
+                context.nrt.decref(builder, return_type, result)
+
+    return sig, codegen
+
+
+@extending.intrinsic  # type: ignore[misc, untyped-decorator]
+def call_udf(
+    typingctx: Context,
+    ctx: types.RawPointer,
+    func: types.Dispatcher,
+    argc: types.Integer,
+    argv: types.CPointer,
+    null_policy: types.StringLiteral,
+) -> Optional[
+    Tuple[
+        Signature,
+        Callable[
+            [
+                BaseContext,
+                IRBuilder,
+                Signature,
+                Tuple[Value, Value, Value, Value, Value],
+            ],
+            None,
+        ],
+    ]
+]:
+    """Call a user-defined function with the `argc` arguments in `argv` and set
+    the result of `ctx` to its return value.
+
+    `func` has one compiled specialization for every combination of its
+    argument types. The specialization to call is chosen from the storage
+    classes of the arguments: each argument picks the first of its types that
+    it can be extracted as without conversion, or that's optional if the
+    argument is NULL, falling back to the first of its types.
+
+    If the last argument of `func` is `VariadicArguments`, it collects the
+    arguments that follow the others.
+
+    A NULL argument that isn't optional fails the call if `null_policy` is
+    ``"error"``, and sets the result to NULL without calling `func` if it's
+    ``"return_null"``. Exceptions raised by `func` fail the call.
+    """
+    # the policy has to be known when compiling
+    if not isinstance(null_policy, types.StringLiteral):
+        return None
+
+    dispatcher = func.dispatcher
+    overloads = dispatcher.overloads
+    signatures = dispatcher.nopython_signatures
+
+    # the types of each argument, in the order they were declared
+    alternatives = [
+        list(dict.fromkeys(signature.args[i] for signature in signatures))
+        for i in range(len(signatures[0].args))
+    ]
+    storages, result_storage = declared_storages(dispatcher.py_func)
+    func_name = dispatcher.py_func.__name__
+    return_null = null_policy.literal_value == "return_null"
+    sig = types.void(ctx, func, argc, argv, null_policy)
+
+    def codegen(
+        context: BaseContext,
+        builder: IRBuilder,
+        signature: Signature,
+        args: Tuple[Value, Value, Value, Value, Value],
+    ) -> None:
+        ctx, _, argc, argv, _ = args
+
+        # the results of user-defined functions are released here
+        keep_reference_counting(builder)
+
+        done = builder.append_basic_block("call_udf.done")
+
+        # SQLite passes any number of arguments to functions registered as
+        # variadic, which may be fewer than the ones that come before `*args`
+        *fixed_alternatives, last_alternatives = alternatives or [[]]
+        missing = cgutils.alloca_once_value(builder, cgutils.false_bit)
+        if any(isinstance(typ, VariadicArguments) for typ in last_alternatives):
+            num_fixed = len(fixed_alternatives)
+            with builder.if_then(
+                builder.icmp_signed("<", argc, argc.type(num_fixed)), likely=False
+            ):
+                report_error(
+                    context,
+                    builder,
+                    ctx,
+                    f"{func_name}() takes at least {num_fixed:d} "
+                    f"argument{'s' * (num_fixed != 1)}",
+                )
+                builder.branch(done)
+
+            # the arguments collected by `*args` are only converted once the
+            # function has been called, so look for NULLs ahead of time
+            (variadic_type,) = last_alternatives
+            if not isinstance(variadic_type.dtype, types.Optional):
+                start = context.get_constant(types.intp, num_fixed)
+                stop = builder.sext(argc, start.type)
+                step = context.get_constant(types.intp, 1)
+                with cgutils.for_range_slice(builder, start, stop, step) as (i, _):
+                    sqlite3_value = builder.load(builder.gep(argv, [i], inbounds=True))
+                    value_type = call_external(
+                        context, builder, sqlite3_value_type, [sqlite3_value]
+                    )
+                    with builder.if_then(
+                        builder.icmp_signed(
+                            "==", value_type, value_type.type(SQLITE_NULL)
+                        ),
+                        likely=False,
+                    ):
+                        builder.store(cgutils.true_bit, missing)
+
+        index_type = context.get_value_type(types.intp)
+        index = context.get_constant(types.intp, 0)
+        stride = 1
+
+        # compute the position of the specialization to call in the product
+        # of the alternatives, where the last argument varies fastest
+        for i, choices in reversed(list(enumerate(alternatives))):
+            if len(choices) > 1:
+                sqlite3_value = builder.load(
+                    cgutils.gep(builder, argv, i, inbounds=True)
+                )
+                value_type = call_external(
+                    context, builder, sqlite3_value_type, [sqlite3_value]
+                )
+                choice = context.get_constant(types.intp, 0)
+
+                # visit the alternatives in reverse so the first match wins
+                for j, argtype in reversed(list(enumerate(choices))):
+                    matches = builder.icmp_signed(
+                        "==",
+                        value_type,
+                        value_type.type(storage_class(argtype, storages[i])),
+                    )
+                    if isinstance(argtype, types.Optional):
+                        matches = builder.or_(
+                            matches,
+                            builder.icmp_signed(
+                                "==", value_type, value_type.type(SQLITE_NULL)
+                            ),
+                        )
+                    choice = builder.select(matches, index_type(j), choice)
+
+                index = builder.add(index, builder.mul(choice, index_type(stride)))
+            stride *= len(choices)
+
+        switch = builder.switch(index, done)
+        for position, argtypes in enumerate(itertools.product(*alternatives)):
+            block = builder.append_basic_block(f"call_udf.{position:d}")
+            switch.add_case(index_type(position), block)
+
+            with builder.goto_block(block):
+                is_variadic = bool(argtypes) and isinstance(
+                    argtypes[-1], VariadicArguments
+                )
+                fixed_argtypes = argtypes[:-1] if is_variadic else argtypes
+                converted_args = extract_args(
+                    context,
+                    builder,
+                    fixed_argtypes,
+                    argv,
+                    missing=missing,
+                    storages=storages,
+                )
+                if is_variadic:
+                    converted_args.append(
+                        make_variadic_arguments(
+                            context,
+                            builder,
+                            argtypes[-1],
+                            argc=argc,
+                            argv=argv,
+                            start=len(fixed_argtypes),
+                        )
+                    )
+
+                with builder.if_else(builder.load(missing), likely=False) as (
+                    then,
+                    otherwise,
+                ):
+                    with then:
+                        if return_null:
+                            call_external(context, builder, sqlite3_result_null, [ctx])
+                        else:
+                            report_error(context, builder, ctx, null_error(func_name))
+                    with otherwise:
+                        failed, result = call_compiled(
+                            context, builder, ctx, dispatcher, argtypes, converted_args
+                        )
+                        return_type = overloads[argtypes].signature.return_type
+                        with builder.if_then(builder.not_(failed), likely=True):
+                            set_result(
+                                context,
+                                builder,
+                                ctx,
+                                return_type,
+                                result,
+                                storage=result_storage,
+                            )
+                            if context.enable_nrt:
+                                context.nrt.decref(builder, return_type, result)
+
+                # text arguments that aren't ASCII are decoded into new
+                # strings, and arguments that are NULL are zeroed
+                if context.enable_nrt:
+                    for argtype, arg in zip(argtypes, converted_args):
+                        context.nrt.decref(builder, argtype, arg)
+                builder.branch(done)
+
+        builder.position_at_end(done)
+
+    return sig, codegen
+
+
+def map_sqlite_blob_to_numba_array(
+    context: BaseContext,
+    builder: IRBuilder,
+    arrtype: types.Array,
+    *,
+    sqlite3_value: Value,
+) -> Value:
+    """Construct a read-only numba array viewing the data of a SQLite BLOB.
+
+    The array doesn't own its data, which SQLite frees once the user-defined
+    function returns. Trailing bytes that don't make up a whole element are
+    left out.
+    """
+    # SQLite's documentation recommends calling sqlite3_value_blob before
+    # sqlite3_value_bytes, since the former may change the latter
+    data = call_external(context, builder, sqlite3_value_blob, [sqlite3_value])
+    nbytes = call_external(context, builder, sqlite3_value_bytes, [sqlite3_value])
+
+    intp_type = context.get_value_type(types.intp)
+    itemsize = context.get_abi_sizeof(context.get_data_type(arrtype.dtype))
+    length = builder.udiv(builder.sext(nbytes, intp_type), intp_type(itemsize))
+
+    array = context.make_array(arrtype)(context, builder)
+    context.populate_array(
+        array,
+        data=builder.bitcast(data, array.data.type),
+        shape=[length],
+        strides=[intp_type(itemsize)],
+        itemsize=intp_type(itemsize),
+        # SQLite owns the data
+        meminfo=None,
+    )
+    return array._getvalue()
+
+
+@extending.intrinsic  # type: ignore[misc, untyped-decorator]
+def borrow_ascii(
+    typingctx: Context, data: types.Array
+) -> Tuple[
+    Signature,
+    Callable[[BaseContext, IRBuilder, Signature, Tuple[Value]], Value],
+]:
+    """Construct a numba string viewing an array of ASCII characters.
+
+    The string doesn't own its data, so it must not outlive the array.
+    """
+    if data == BLOB_ARRAY_TYPE:
+        sig = string(data)
+
+        def codegen(
+            context: BaseContext,
+            builder: IRBuilder,
+            signature: Signature,
+            args: Tuple[Value],
+        ) -> Value:
+            (data,) = args
+            array = context.make_array(signature.args[0])(context, builder, data)
+
+            uni_str = cgutils.create_struct_proxy(string)(context, builder)
+            uni_str.data = builder.bitcast(array.data, uni_str.data.type)
+            uni_str.length = array.nitems
+
+            # ASCII strings take one byte per character, just like UTF-8
+            uni_str.kind = uni_str.kind.type(PY_UNICODE_1BYTE_KIND)
+            uni_str.is_ascii = uni_str.is_ascii.type(1)
+
+            # Tell numba to forget about owning the data, because SQLite owns it.
+            uni_str.meminfo = cgutils.get_null_value(uni_str.meminfo.type)
+
+            # Cribbed from numba string construction code
+            #
+            # Set hash to -1 to indicate that it should be computed.
+            #
+            # We cannot bake in the hash value because of hashseed
+            # randomization.
+            uni_str.hash = uni_str.hash.type(-1)
+            uni_str.parent = cgutils.get_null_value(uni_str.parent.type)
+            return imputils.impl_ret_untracked(
+                context, builder, signature.return_type, uni_str._getvalue()
+            )
+
+        return sig, codegen
+
+    raise TypeError(f"Unable to view an array of type `{data}` as a string")
+
+
+@njit(nogil=True)  # type: ignore[misc, untyped-decorator]
+def is_ascii(data: np.ndarray) -> bool:
+    """Return whether every byte of `data` is an ASCII character."""
+    # no early exit, so that the loop is vectorized
+    bits = np.uint8(0)
+    for byte in data:
+        bits |= byte
+    return bool(bits < 0x80)
+
+
+@njit(nogil=True)  # type: ignore[misc, untyped-decorator]
+def decode_code_point(data: np.ndarray, i: int) -> Tuple[int, int]:
+    """Decode the UTF-8 character starting at `data[i]`.
+
+    Returns the code point and the number of bytes it takes. Invalid bytes
+    decode to U+FFFD REPLACEMENT CHARACTER one at a time.
+    """
+    first = int(data[i])
+    if first < 0x80:
+        return first, 1
+    if 0xC2 <= first < 0xE0:
+        width, code_point, smallest = 2, first & 0x1F, 0x80
+    elif 0xE0 <= first < 0xF0:
+        width, code_point, smallest = 3, first & 0x0F, 0x800
+    elif 0xF0 <= first < 0xF5:
+        width, code_point, smallest = 4, first & 0x07, 0x10000
+    else:
+        return 0xFFFD, 1
+
+    if i + width > len(data):
+        return 0xFFFD, 1
+
+    for j in range(i + 1, i + width):
+        byte = int(data[j])
+        if byte & 0xC0 != 0x80:
+            return 0xFFFD, 1
+        code_point = (code_point << 6) | (byte & 0x3F)
+
+    # overlong encodings, surrogates and values past the end of Unicode
+    if code_point < smallest or 0xD800 <= code_point < 0xE000 or code_point > 0x10FFFF:
+        return 0xFFFD, 1
+    return code_point, width
+
+
+def _decode_text(data, borrow):  # type: ignore[no-untyped-def]
+    if is_ascii(data):
+        if borrow:
+            return borrow_ascii(data)
+
+        result = _empty_string(PY_UNICODE_1BYTE_KIND, len(data), 1)
+        for i in range(len(data)):
+            _set_code_point(result, i, data[i])
+        return result
+
+    # find the number of characters and the widest one, to pick the kind of
+    # the string
+    length = 0
+    widest = 0
+    i = 0
+    while i < len(data):
+        code_point, width = decode_code_point(data, i)
+        length += 1
+        widest = max(widest, code_point)
+        i += width
+
+    if widest < 0x100:
+        kind = PY_UNICODE_1BYTE_KIND
+    elif widest < 0x10000:
+        kind = PY_UNICODE_2BYTE_KIND
+    else:
+        kind = PY_UNICODE_4BYTE_KIND
+
+    result = _empty_string(kind, length)
+    i = 0
+    for j in range(length):
+        code_point, width = decode_code_point(data, i)
+        _set_code_point(result, j, code_point)
+        i += width
+    return result
+
+
+@njit(nogil=True)  # type: ignore[misc, untyped-decorator]
+def encode_utf8(value: str) -> np.ndarray:
+    """Encode a string as UTF-8.
+
+    Surrogates, which UTF-8 can't represent, are encoded as U+FFFD
+    REPLACEMENT CHARACTER.
+    """
+    nbytes = 0
+    for i in range(len(value)):
+        code_point = _get_code_point(value, i)
+        if code_point < 0x80:
+            nbytes += 1
+        elif code_point < 0x800:
+            nbytes += 2
+        elif code_point < 0x10000:
+            nbytes += 3
+        else:
+            nbytes += 4
+
+    result = np.empty(nbytes, dtype=np.uint8)
+    j = 0
+    for i in range(len(value)):
+        code_point = np.int64(_get_code_point(value, i))
+        if code_point < 0x80:
+            result[j] = code_point
+            j += 1
+        elif code_point < 0x800:
+            result[j] = 0xC0 | (code_point >> 6)
+            result[j + 1] = 0x80 | (code_point & 0x3F)
+            j += 2
+        elif code_point < 0x10000:
+            if 0xD800 <= code_point < 0xE000:
+                code_point = 0xFFFD
+            result[j] = 0xE0 | (code_point >> 12)
+            result[j + 1] = 0x80 | ((code_point >> 6) & 0x3F)
+            result[j + 2] = 0x80 | (code_point & 0x3F)
+            j += 3
+        else:
+            result[j] = 0xF0 | (code_point >> 18)
+            result[j + 1] = 0x80 | ((code_point >> 12) & 0x3F)
+            result[j + 2] = 0x80 | ((code_point >> 6) & 0x3F)
+            result[j + 3] = 0x80 | (code_point & 0x3F)
+            j += 4
+    return result
+
+
+def map_sqlite_string_to_numba_uni_str(
+    context: BaseContext,
+    builder: IRBuilder,
+    *,
+    sqlite3_value: Value,
+    borrow: bool = True,
+) -> Value:
+    """Construct a numba string from the UTF-8 text of a SQLite value.
+
+    ASCII text, the common case, is viewed without a copy if `borrow` is
+    true, and SQLite frees it once the user-defined function returns.
+    Anything else is decoded into a new string of the narrowest kind that
+    holds all of its characters.
+    """
+    return context.compile_internal(
+        builder,
+        _decode_text,
+        string(BLOB_ARRAY_TYPE, types.boolean),
+        [
+            view_sqlite_text(context, builder, sqlite3_value=sqlite3_value),
+            context.get_constant(types.boolean, borrow),
+        ],
+    )
+
+
+def view_sqlite_text(
+    context: BaseContext,
+    builder: IRBuilder,
+    *,
+    sqlite3_value: Value,
+) -> Value:
+    """Construct a read-only array of the bytes of the UTF-8 text of a SQLite
+    value, without its null terminator.
+
+    The array doesn't own its data, which SQLite frees once the user-defined
+    function returns.
+    """
+    # SQLite's documentation recommends calling sqlite3_value_text before
+    # sqlite3_value_bytes, since the former may change the latter
+    data = call_external(
+        context, builder, SQLITE3_VALUE_EXTRACTORS[string], [sqlite3_value]
+    )
+    nbytes = call_external(context, builder, sqlite3_value_bytes, [sqlite3_value])
+
+    intp_type = context.get_value_type(types.intp)
+    array = context.make_array(BLOB_ARRAY_TYPE)(context, builder)
+    context.populate_array(
+        array,
+        data=builder.bitcast(data, array.data.type),
+        shape=[builder.sext(nbytes, intp_type)],
+        strides=[intp_type(1)],
+        itemsize=intp_type(1),
+        meminfo=None,
+    )
+    return array._getvalue()
+
+
+def map_sqlite_value_to_datetime(
+    context: BaseContext,
+    builder: IRBuilder,
+    valtype: types.Type,
+    *,
+    sqlite3_value: Value,
+    storage: Optional[str],
+) -> Value:
+    """Convert a SQLite value to a numba datetime or timedelta of `valtype`.
+
+    INTEGERs are counts of the unit of `valtype`, since the Unix epoch for
+    datetimes. REALs are Julian day numbers for datetimes and numbers of days
+    for timedeltas. TEXT is parsed as ISO-8601 without decoding it first, and
+    text that isn't a valid datetime is NaT. SQLite converts values of any
+    other storage class to the declared one.
+    """
+    # datetimes and timedeltas are represented by a 64-bit count of their unit
+    if storage == "integer":
+        return call_external(
+            context, builder, SQLITE3_VALUE_EXTRACTORS[int64], [sqlite3_value]
+        )
+
+    units_per_day = context.get_constant(int64, UNITS_PER_DAY[valtype.unit])
+    if storage == "real":
+        days = call_external(
+            context, builder, SQLITE3_VALUE_EXTRACTORS[float64], [sqlite3_value]
+        )
+        convert = (
+            from_julian_day if isinstance(valtype, types.NPDatetime) else from_days
+        )
+        return context.compile_internal(
+            builder, convert.py_func, int64(float64, int64), [days, units_per_day]
+        )
+
+    return context.compile_internal(
+        builder,
+        parse_iso8601.py_func,
+        int64(BLOB_ARRAY_TYPE, int64),
+        [
+            view_sqlite_text(context, builder, sqlite3_value=sqlite3_value),
+            units_per_day,
+        ],
+    )
+
+
+# The fields of `NRT_MemInfo`, the header numba's runtime keeps for every
+# allocation it makes, in order. The struct is private to numba, so results
+# only rely on it with the versions of numba it has been checked against, and
+# once `_meminfo_layout_is_verified` has checked it against the runtime.
+_MEMINFO_FIELDS = (
+    "refct",
+    "dtor",
+    "dtor_info",
+    "data",
+    "size",
+    "external_allocator",
+)
+_MEMINFO_VERIFIED_VERSIONS = ((0, 53), (0, 61))
+
+# The most alignment padding numba's runtime puts between a meminfo and its
+# data, which is less than the alignment numba asks for
+_MAX_MEMINFO_PADDING = 64
+
+
+class _MemInfo(ctypes.Structure):
+    _fields_ = list(
+        zip(
+            _MEMINFO_FIELDS,
+            (
+                ctypes.c_size_t,
+                ctypes.c_void_p,
+                ctypes.c_void_p,
+                ctypes.c_void_p,
+                ctypes.c_size_t,
+                ctypes.c_void_p,
+            ),
+        )
+    )
+
+
+def _meminfo_layout_is_verified() -> bool:
+    """Return whether numba is a version whose meminfos are laid out as
+    `_MEMINFO_FIELDS` says, and whether the meminfos its runtime allocates
+    actually are."""
+    version = tuple(int(part) for part in numba.__version__.split(".")[:2])
+    oldest, newest = _MEMINFO_VERIFIED_VERSIONS
+    if not oldest <= version <= newest:
+        return False
+
+    from numba.core.runtime import _nrt_python
+
+    # the runtime is initialized along with the target context
+    cpu_target.target_context
+    helpers = _nrt_python.c_helpers
+    allocate = ctypes.CFUNCTYPE(ctypes.c_void_p, ctypes.c_size_t)(
+        helpers["MemInfo_alloc"]
+    )
+    allocate_aligned = ctypes.CFUNCTYPE(
+        ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint
+    )(helpers["MemInfo_alloc_aligned"])
+    data_of = ctypes.CFUNCTYPE(ctypes.c_void_p, ctypes.c_void_p)(
+        helpers["MemInfo_data"]
+    )
+    release = ctypes.CFUNCTYPE(None, ctypes.c_void_p)(helpers["MemInfo_release"])
+
+    size = 24
+    alignment = _MAX_MEMINFO_PADDING // 2
+    adjacent = allocate(size)
+    padded = allocate_aligned(size, alignment)
+    try:
+        if not adjacent or not padded:
+            return False
+        for meminfo in (adjacent, padded):
+            header = _MemInfo.from_address(meminfo)
+            if (
+                header.refct != 1
+                or header.data != data_of(meminfo)
+                or header.size != size
+                or header.external_allocator
+            ):
+                return False
+        end = ctypes.sizeof(_MemInfo)
+        padded_header = _MemInfo.from_address(padded)
+        offset = padded_header.data - (padded + end)
+        return (
+            _MemInfo.from_address(adjacent).data == adjacent + end
+            and 0 <= offset < _MAX_MEMINFO_PADDING
+            and padded_header.data % alignment == 0
+            and not padded_header.dtor
+            and not padded_header.dtor_info
+        )
+    finally:
+        for meminfo in (adjacent, padded):
+            if meminfo:
+                release(meminfo)
+
+
+# whether SQLite can take references to the text and BLOB results numba's
+# runtime allocated, instead of copying them
+_ZERO_COPY_RESULTS = _meminfo_layout_is_verified()
+
+
+def _meminfo_type(context: BaseContext) -> ir.LiteralStructType:
+    size_t = context.get_value_type(types.uintp)
+    return ir.LiteralStructType(
+        [
+            size_t,
+            cgutils.voidptr_t,
+            cgutils.voidptr_t,
+            cgutils.voidptr_t,
+            size_t,
+            cgutils.voidptr_t,
+        ]
+    )
+
+
+def _meminfo_field(builder: IRBuilder, header: Value, name: str) -> Value:
+    index = _MEMINFO_FIELDS.index(name)
+    return builder.load(cgutils.gep_inbounds(builder, header, 0, index))
+
+
+def _meminfo_slot(context: BaseContext, builder: IRBuilder, data: Value) -> Value:
+    """Return a pointer to the pointer-sized slot right before `data`."""
+    ptrsize = context.get_abi_sizeof(cgutils.voidptr_t)
+    return builder.bitcast(
+        cgutils.pointer_add(builder, data, -ptrsize), cgutils.voidptr_t.as_pointer()
+    )
+
+
+def _get_release_function(context: BaseContext, module: ir.Module) -> ir.Function:
+    """Define the destructor SQLite calls once it's done with a result whose
+    data is owned by numba.
+
+    SQLite passes nothing but the data pointer to the destructor, so the
+    meminfo owning the data is found from the data itself: the slot right
+    before the data holds either the meminfo's `external_allocator` field,
+    which is always NULL when the data directly follows the meminfo, or a
+    pointer to the meminfo written by `result_destructor` into the alignment
+    padding between the two.
+    """
+    fn = cgutils.get_or_insert_function(
+        module,
+        ir.FunctionType(ir.VoidType(), [cgutils.voidptr_t]),
+        "numbsql_release_result",
+    )
+    if fn.is_declaration:
+        # defined in every module that needs it, which is fine because every
+        # definition is the same
+        fn.linkage = "linkonce_odr"
+        builder = ir.IRBuilder(fn.append_basic_block())
+        (data,) = fn.args
+        meminfo_size = context.get_abi_sizeof(_meminfo_type(context))
+        stored = builder.load(_meminfo_slot(context, builder, data))
+        meminfo = builder.select(
+            cgutils.is_null(builder, stored),
+            cgutils.pointer_add(builder, data, -meminfo_size),
+            stored,
+        )
+        context.nrt.decref(builder, types.MemInfoPointer(types.voidptr), meminfo)
+        builder.ret_void()
+    return fn
+
+
+def result_destructor(
+    context: BaseContext, builder: IRBuilder, *, meminfo: Value, data: Value
+) -> Value:
+    """Return the destructor to pass to SQLite along with the `data` of a
+    text or BLOB result.
+
+    When `data` is the start of a buffer that numba's runtime allocated along
+    with `meminfo`, SQLite takes a reference to the buffer instead of copying
+    it, and releases that reference by calling the destructor. Anything else,
+    such as data owned by SQLite or a view into the middle of an array, is
+    copied by SQLite before the user-defined function returns, and so is
+    everything when the layout of numba's meminfos couldn't be verified.
+    """
+    intp_type = context.get_value_type(types.intp)
+    transient = builder.inttoptr(intp_type(SQLITE_TRANSIENT), cgutils.voidptr_t)
+    if not context.enable_nrt or not _ZERO_COPY_RESULTS:
+        return transient
+
+    destructor = cgutils.alloca_once_value(builder, transient)
+    with cgutils.if_likely(builder, cgutils.is_not_null(builder, meminfo)):
+        header = builder.bitcast(meminfo, _meminfo_type(context).as_pointer())
+        owns_data = builder.and_(
+            builder.icmp_unsigned("==", _meminfo_field(builder, header, "data"), data),
+            cgutils.is_null(
+                builder, _meminfo_field(builder, header, "external_allocator")
+            ),
+        )
+
+        # the number of bytes between the end of the meminfo and the data
+        offset = builder.sub(
+            builder.ptrtoint(data, intp_type),
+            builder.ptrtoint(builder.gep(header, [intp_type(1)]), intp_type),
+        )
+        is_adjacent = builder.icmp_signed("==", offset, intp_type(0))
+
+        # only the aligned allocations of numba's runtime pad their data, and
+        # those leave the meminfo's destructor unset or set its `dtor_info` to
+        # the size of the data
+        ptrsize = context.get_abi_sizeof(cgutils.voidptr_t)
+        size = _meminfo_field(builder, header, "size")
+        dtor_info = builder.ptrtoint(
+            _meminfo_field(builder, header, "dtor_info"), size.type
+        )
+        is_aligned_allocation = builder.or_(
+            builder.and_(
+                cgutils.is_null(builder, _meminfo_field(builder, header, "dtor")),
+                cgutils.is_null(builder, dtor_info),
+            ),
+            builder.and_(
+                cgutils.is_not_null(builder, size),
+                builder.icmp_unsigned("==", dtor_info, size),
+            ),
+        )
+        is_padded = functools.reduce(
+            builder.and_,
+            [
+                is_aligned_allocation,
+                builder.icmp_signed(">=", offset, intp_type(ptrsize)),
+                builder.icmp_signed("<", offset, intp_type(_MAX_MEMINFO_PADDING)),
+                cgutils.is_null(builder, builder.urem(offset, intp_type(ptrsize))),
+            ],
+        )
+
+        with builder.if_then(
+            builder.and_(owns_data, builder.or_(is_adjacent, is_padded))
+        ):
+            with builder.if_then(is_padded):
+                builder.store(meminfo, _meminfo_slot(context, builder, data))
+
+            # SQLite's reference, released by the destructor
+            keep_reference_counting(builder)
+            context.nrt.incref(builder, types.MemInfoPointer(types.voidptr), meminfo)
+            release = _get_release_function(context, builder.module)
+            builder.store(builder.bitcast(release, cgutils.voidptr_t), destructor)
+
+    return builder.load(destructor)
+
+
+@extending.intrinsic  # type: ignore[misc, untyped-decorator]
+def sqlite3_result_blob(
+    typingctx: Context,
+    ctx: types.RawPointer,
+    value: types.Buffer,
+) -> Tuple[
+    Signature,
+    Callable[[BaseContext, IRBuilder, Signature, Tuple[Value, Value]], None],
+]:
+    """Set the result of a UDF call to the bytes of a contiguous array."""
+    if isinstance(value, types.Buffer) and value.layout == "C":
+        sig = types.void(ctx, value)
+
+        def codegen(
+            context: BaseContext,
+            builder: IRBuilder,
+            signature: Signature,
+            args: Tuple[Value, Value],
+        ) -> None:
+            ctx, value = args
+            array = context.make_array(signature.args[1])(context, builder, value)
+            data = builder.bitcast(array.data, cgutils.voidptr_t)
+            call_external(
+                context,
+                builder,
+                sqlite3_result_blob64,
+                [
+                    ctx,
+                    data,
+                    builder.mul(array.nitems, array.itemsize),
+                    result_destructor(
+                        context, builder, meminfo=array.meminfo, data=data
+                    ),
+                ],
+            )
+
+        return sig, codegen
+
+    raise TypeError(f"Unable to set the result to a value of type `{value}`")
+
+
+@extending.intrinsic  # type: ignore[misc, untyped-decorator]
+def sqlite3_result_text(
+    typingctx: Context,
+    ctx: types.RawPointer,
+    value: types.Type,
+) -> Tuple[
+    Signature,
+    Callable[[BaseContext, IRBuilder, Signature, Tuple[Value, Value]], None],
+]:
+    """Set the result of a UDF call to an ASCII string, or to a contiguous
+    array of UTF-8 encoded bytes.
+
+    SQLite takes a reference to data allocated by numba instead of copying
+    it. Strings without a meminfo are either constants or borrowed from an
+    argument, and SQLite can't tell those apart, so they're copied.
+    """
+    if isinstance(value, types.UnicodeType) or value == types.Array(
+        types.uint8, 1, "C"
+    ):
+        sig = types.void(ctx, value)
+
+        def codegen(
+            context: BaseContext,
+            builder: IRBuilder,
+            signature: Signature,
+            args: Tuple[Value, Value],
+        ) -> None:
+            ctx, value = args
+            (_, value_type) = signature.args
+            if isinstance(value_type, types.UnicodeType):
+                uni_str = cgutils.create_struct_proxy(value_type)(
+                    context, builder, value=value
+                )
+                meminfo = uni_str.meminfo
+                data = uni_str.data
+                # the entire string, up to but not including the null byte
+                nbytes = uni_str.length
+            else:
+                array = context.make_array(value_type)(context, builder, value)
+                meminfo = array.meminfo
+                data = builder.bitcast(array.data, cgutils.voidptr_t)
+                nbytes = array.nitems
+
+            call_external(
+                context,
+                builder,
+                sqlite3_result_text64,
+                [
+                    ctx,
+                    data,
+                    nbytes,
+                    result_destructor(context, builder, meminfo=meminfo, data=data),
+                    context.get_constant(types.uint8, SQLITE_UTF8),
+                ],
+            )
+
+        return sig, codegen
+
+    raise TypeError(f"Unable to set the result to a value of type `{value}`")
+
+
+@extending.intrinsic  # type: ignore[misc, untyped-decorator]
+def unwrap_optional(
+    typingctx: Context, value: types.Optional
+) -> Tuple[
+    Signature,
+    Callable[[BaseContext, IRBuilder, Signature, Tuple[Value]], Value],
+]:
+    """Convert an optional value that isn't None to its underlying type."""
+    if isinstance(value, types.Optional):
+        sig = value.type(value)
+
+        def codegen(
+            context: BaseContext,
+            builder: IRBuilder,
+            signature: Signature,
+            args: Tuple[Value],
+        ) -> Value:
+            (value,) = args
+            (value_type,) = signature.args
+            result = context.cast(builder, value, value_type, signature.return_type)
+            return imputils.impl_ret_borrowed(
+                context, builder, signature.return_type, result
+            )
+
+        return sig, codegen
+
+    raise TypeError(f"`{value}` is not an optional type")
+
+
+@extending.intrinsic  # type: ignore[misc, untyped-decorator]
+def datetime_count(
+    typingctx: Context, value: types.Type
+) -> Tuple[
+    Signature,
+    Callable[[BaseContext, IRBuilder, Signature, Tuple[Value]], Value],
+]:
+    """Return the number of units of a datetime or timedelta, counted from
+    the Unix epoch for datetimes."""
+    if isinstance(value, (types.NPDatetime, types.NPTimedelta)):
+        sig = int64(value)
+
+        def codegen(
+            context: BaseContext,
+            builder: IRBuilder,
+            signature: Signature,
+            args: Tuple[Value],
+        ) -> Value:
+            # both are represented by a 64-bit integer
+            (value,) = args
+            return value
+
+        return sig, codegen
+
+    raise TypeError(f"`{value}` is not a datetime or timedelta type")
+
+
+def sqlite3_result_datetime(  # type: ignore[no-untyped-def]
+    ctx: types.Integer, value: Any, storage: str
+):
+    raise NotImplementedError(type(value))
+
+
+@extending.overload(sqlite3_result_datetime, prefer_literal=True)  # type: ignore[misc]
+def ol_sqlite3_result_datetime(ctx, value, storage):  # type: ignore[no-untyped-def]
+    # the storage has to be known when compiling
+    if not isinstance(storage, types.StringLiteral):
+        return None
+
+    if isinstance(value, types.Optional):
+        return lambda ctx, value, storage: sqlite3_result_datetime(
+            ctx, unwrap_optional(value), storage
+        )
+
+    units_per_day = UNITS_PER_DAY[value.unit]
+    digits = FRACTION_DIGITS[value.unit]
+
+    # NaT is the only value without a SQLite equivalent
+    if storage.literal_value == "integer":
+
+        def set_integer(ctx, value, storage):  # type: ignore[no-untyped-def]
+            count = datetime_count(value)
+            if count == NAT:
+                sqlite3_result_null(ctx)
+            else:
+                sqlite3_result_int64(ctx, count)
+
+        return set_integer
+
+    if storage.literal_value == "real":
+        convert = to_julian_day if isinstance(value, types.NPDatetime) else to_days
+
+        def set_real(ctx, value, storage):  # type: ignore[no-untyped-def]
+            count = datetime_count(value)
+            if count == NAT:
+                sqlite3_result_null(ctx)
+            else:
+                sqlite3_result_double(ctx, convert(count, units_per_day))
+
+        return set_real
+
+    def set_text(ctx, value, storage):  # type: ignore[no-untyped-def]
+        count = datetime_count(value)
+        if count == NAT:
+            sqlite3_result_null(ctx)
+        else:
+            sqlite3_result_text(ctx, format_iso8601(count, units_per_day, digits))
+
+    return set_text
+
+
+def write_json(buffer: np.ndarray, n: int, value: Any) -> Tuple[np.ndarray, int]:
+    """Append `value` as JSON to the first `n` bytes of `buffer`, and return
+    the buffer, which may have been reallocated, and the number of bytes used.
+    """
+    raise NotImplementedError(type(value))
+
+
+@functools.lru_cache(maxsize=None)
+def _tuple_writer(
+    num_fields: int, names: Optional[Tuple[str, ...]]
+) -> Callable[..., Any]:
+    """Generate a function that writes a tuple of `num_fields` fields as a JSON
+    array, or as a JSON object with keys `names`."""
+    # the separators and keys that come before each field, then the closing
+    # bracket
+    if names is None:
+        pieces = ["[", *([","] * (num_fields - 1)), "]"]
+        if not num_fields:
+            pieces = ["[]"]
+    else:
+        pieces = [
+            ("{" if i == 0 else ",") + json.dumps(name) + ":"
+            for i, name in enumerate(names)
+        ] + ["}"]
+        if not num_fields:
+            pieces = ["{}"]
+
+    namespace = {
+        "write_bytes": write_bytes,
+        "write_json": write_json,
+        **{
+            f"piece{i:d}": np.frombuffer(piece.encode("utf8"), dtype=np.uint8)
+            for i, piece in enumerate(pieces)
+        },
+    }
+    lines = ["def write_tuple(buffer, n, value):"]
+    for i in range(num_fields):
+        lines.append(f"    buffer, n = write_bytes(buffer, n, piece{i:d})")
+        lines.append(f"    buffer, n = write_json(buffer, n, value[{i:d}])")
+    lines.append(f"    return write_bytes(buffer, n, piece{len(pieces) - 1:d})")
+    exec("\n".join(lines), namespace)
+    return namespace["write_tuple"]  # type: ignore[no-any-return]
+
+
+@extending.overload(write_json)  # type: ignore[misc]
+def ol_write_json(buffer, n, value):  # type: ignore[no-untyped-def]
+    if isinstance(value, types.NoneType):
+        return lambda buffer, n, value: write_null(buffer, n)
+    if isinstance(value, types.Optional):
+
+        def write_optional(buffer, n, value):  # type: ignore[no-untyped-def]
+            if value is None:
+                return write_null(buffer, n)
+            return write_json(buffer, n, unwrap_optional(value))
+
+        return write_optional
+    if isinstance(value, types.Boolean):
+        return lambda buffer, n, value: write_boolean(buffer, n, value)
+    if isinstance(value, types.Integer):
+        if value.signed:
+            return lambda buffer, n, value: write_integer(buffer, n, np.int64(value))
+        return lambda buffer, n, value: write_unsigned(buffer, n, np.uint64(value))
+    if isinstance(value, types.Float):
+        return lambda buffer, n, value: write_float(buffer, n, np.float64(value))
+    if isinstance(value, types.UnicodeType):
+        return lambda buffer, n, value: write_string(buffer, n, value)
+    if isinstance(value, types.BaseTuple):
+        names = getattr(value, "fields", None)
+        return _tuple_writer(len(value), None if names is None else tuple(names))
+    raise TypeError(f"`{value}` values can't be encoded as JSON")
+
+
+@njit(nogil=True)  # type: ignore[misc, untyped-decorator]
+def encode_json(value: Any) -> np.ndarray:
+    """Encode `value` as UTF-8 JSON text."""
+    buffer, n = write_json(np.empty(64, dtype=np.uint8), 0, value)
+    return buffer[:n].copy()
+
+
+def pack(value: Any) -> np.ndarray:
+    """Pack the fields of a tuple of numbers and booleans into bytes laid out
+    like `packed_dtype`."""
+    raise NotImplementedError(type(value))
+
+
+@extending.overload(pack)  # type: ignore[misc]
+def ol_pack(value):  # type: ignore[no-untyped-def]
+    dtype = packed_dtype(value)
+    namespace = {"np": np}
+    lines = [
+        "def pack(value):",
+        f"    data = np.empty({dtype.itemsize:d}, dtype=np.uint8)",
+    ]
+    for i, name in enumerate(dtype.names):
+        field_dtype, offset = dtype.fields[name]
+        end = offset + field_dtype.itemsize
+        namespace[f"scalar{i:d}"] = field_dtype.type
+        lines.append(
+            f"    data[{offset:d}:{end:d}].view(scalar{i:d})[0] = value[{i:d}]"
+        )
+    lines.append("    return data")
+    exec("\n".join(lines), namespace)
+    return namespace["pack"]
+
+
+def sqlite3_result_structured(  # type: ignore[no-untyped-def]
+    ctx: types.Integer, value: Any, encoding: str
+):
+    raise NotImplementedError(type(value))
+
+
+@extending.overload(sqlite3_result_structured, prefer_literal=True)  # type: ignore[misc]
+def ol_sqlite3_result_structured(ctx, value, encoding):  # type: ignore[no-untyped-def]
+    # the encoding has to be known when compiling
+    if not isinstance(encoding, types.StringLiteral):
+        return None
+
+    if isinstance(value, types.Optional):
+        return lambda ctx, value, encoding: sqlite3_result_structured(
+            ctx, unwrap_optional(value), encoding
+        )
+
+    if encoding.literal_value == "blob":
+        return lambda ctx, value, encoding: sqlite3_result_blob(ctx, pack(value))
+
+    def set_json(ctx, value, encoding):  # type: ignore[no-untyped-def]
+        sqlite3_result_text(ctx, encode_json(value))
+        # the subtype has to be set after the value
+        sqlite3_result_subtype(ctx, JSON_SUBTYPE)
+
+    return set_json
+
+
+def sqlite3_result(ctx: types.Integer, value: Any):  # type: ignore[no-untyped-def]
+    raise NotImplementedError(type(value))
+
+
+@extending.overload(sqlite3_result)  # type: ignore[misc]
+def ol_sqlite3_result(ctx, value):  # type: ignore[no-untyped-def]
+    if is_blob_type(value):
+        if isinstance(value, types.Optional):
+            return lambda ctx, value: sqlite3_result(ctx, unwrap_optional(value))
+        if value.layout == "C":
+            return lambda ctx, value: sqlite3_result_blob(ctx, value)
+
+        # SQLite needs the bytes of the result in a single piece
+        if isinstance(value, types.Array):
+            return lambda ctx, value: sqlite3_result_blob(
+                ctx, np.ascontiguousarray(value)
+            )
+
+        dtype = value.dtype
+
+        def copy_result(ctx, value):  # type: ignore[no-untyped-def]
+            data = np.empty(len(value), dtype=dtype)
+            for i in range(len(value)):
+                data[i] = value[i]
+            sqlite3_result_blob(ctx, data)
+
+        return copy_result
+
+    if isinstance(value, types.Optional) and isinstance(value.type, types.UnicodeType):
+        return lambda ctx, value: sqlite3_result(ctx, unwrap_optional(value))
+
+    # the default storage of datetimes and timedeltas
+    if is_datetime_type(value):
+        if isinstance(getattr(value, "type", value), types.NPDatetime):
+            return lambda ctx, value: sqlite3_result_datetime(ctx, value, "text")
+        return lambda ctx, value: sqlite3_result_datetime(ctx, value, "integer")
+    # the default encoding of tuples
+    if is_tuple_type(value):
+        return lambda ctx, value: sqlite3_result_structured(ctx, value, "json")
+    if isinstance(value, types.UnicodeType):
+
+        def set_text(ctx, value):  # type: ignore[no-untyped-def]
+            # ASCII strings are already UTF-8
+            if value._is_ascii:
+                sqlite3_result_text(ctx, value)
+            else:
+                sqlite3_result_text(ctx, encode_utf8(value))
+
+        return set_text
+
+    return lambda ctx, value: sqlite3_result_number(ctx, value)
+
+
+def aggregate_state_layout(
+    context: BaseContext, class_type: types.ClassType
+) -> Tuple[int, Dict[str, int]]:
+    """Return the number of bytes taken by the state of an aggregate, and the
+    offset from the start of the state of each fixed-size array field.
+
+    The state is the data of a `jitclass` instance, followed by the elements
+    of its `types.NestedArray` fields. The fields themselves are arrays that
+    view those elements.
+    """
+    data_type = context.get_data_type(class_type.instance_type.get_data_type())
+    size = context.get_abi_sizeof(data_type)
+    offsets = {}
+    for name, typ in class_type.struct.items():
+        if isinstance(typ, types.NestedArray):
+            element_type = context.get_data_type(typ.dtype)
+            alignment = context.get_abi_alignment(element_type)
+            size += -size % alignment
+            offsets[name] = size
+            size += typ.nitems * context.get_abi_sizeof(element_type)
+    return size, offsets
+
+
+def init_inline_arrays(
+    context: BaseContext,
+    builder: IRBuilder,
+    inst_typ: types.ClassInstanceType,
+    instance: Value,
+) -> None:
+    """Point the fixed-size array fields of an aggregate's state at the
+    elements stored right after the instance data.
+
+    The arrays don't own their elements, which SQLite frees along with the
+    rest of the state.
+    """
+    _, offsets = aggregate_state_layout(context, inst_typ.class_type)
+    if not offsets:
+        return
+
+    data_pointer = context.make_helper(builder, inst_typ, value=instance).data
+    data = context.make_data_helper(builder, inst_typ.get_data_type(), ref=data_pointer)
+    start = builder.bitcast(data_pointer, cgutils.voidptr_t)
+    intp_type = context.get_value_type(types.intp)
+    for name, offset in offsets.items():
+        arrtype = inst_typ.struct[name]
+        itemsize = context.get_abi_sizeof(context.get_data_type(arrtype.dtype))
+        array = context.make_array(arrtype)(context, builder)
+        context.populate_array(
+            array,
+            data=builder.bitcast(
+                cgutils.pointer_add(builder, start, intp_type(offset)),
+                array.data.type,
+            ),
+            shape=[intp_type(extent) for extent in arrtype.shape],
+            strides=[
+                intp_type(itemsize * math.prod(arrtype.shape[axis + 1 :]))
+                for axis in range(arrtype.ndim)
+            ],
+            itemsize=intp_type(itemsize),
+            # SQLite owns the data
+            meminfo=None,
+        )
+        setattr(data, _mangle_attr(name), array._getvalue())
+
+
+@extending.intrinsic  # type: ignore[misc, untyped-decorator]
+def point_inline_arrays(
+    typingctx: Context, inst_typ: types.ClassInstanceType
+) -> Tuple[
+    Signature, Callable[[BaseContext, IRBuilder, Signature, Tuple[Value]], None]
+]:
+    """Point the fixed-size array fields of an aggregate's state at its own
+    elements, for example once the state has been copied."""
+    if isinstance(inst_typ, types.ClassInstanceType):
+        sig = types.void(inst_typ)
+
+        def codegen(
+            context: BaseContext,
+            builder: IRBuilder,
+            signature: Signature,
+            args: Tuple[Value],
+        ) -> None:
+            (instance,) = args
+            init_inline_arrays(context, builder, inst_typ, instance)
+
+        return sig, codegen
+
+    raise TypeError(f"Unable to point the arrays of type `{inst_typ}`")
+
+
+@extending.intrinsic  # type: ignore[misc, untyped-decorator]
+def sqlite3_result_copy(
+    typingctx: Context,
+    ctx: types.RawPointer,
+    data: types.Integer,
+    size: types.Integer,
+) -> Tuple[
+    Signature,
+    Callable[[BaseContext, IRBuilder, Signature, Tuple[Value, Value, Value]], None],
+]:
+    """Set the result of a UDF call to a BLOB of a copy of the `size` bytes at
+    address `data`."""
+    if isinstance(data, types.Integer) and isinstance(size, types.Integer):
+        sig = types.void(ctx, data, size)
+
+        def codegen(
+            context: BaseContext,
+            builder: IRBuilder,
+            signature: Signature,
+            args: Tuple[Value, Value, Value],
+        ) -> None:
+            ctx, data, size = args
+            intp_type = context.get_value_type(types.intp)
+            call_external(
+                context,
+                builder,
+                sqlite3_result_blob64,
+                [
+                    ctx,
+                    builder.inttoptr(data, cgutils.voidptr_t),
+                    context.cast(builder, size, signature.args[2], types.uint64),
+                    builder.inttoptr(intp_type(SQLITE_TRANSIENT), cgutils.voidptr_t),
+                ],
+            )
+
+        return sig, codegen
+
+    raise TypeError(f"Unable to copy `{size}` bytes at a `{data}` address")
 
 
-@extending.intrinsic  # type: ignore[misc]
+@extending.intrinsic  # type: ignore[misc, untyped-decorator]
 def sizeof(
     typingctx: Context, src: types.ClassType
 ) -> Tuple[
     Signature,
     Callable[[BaseContext, IRBuilder, Signature, Tuple[Value]], Constant],
 ]:
-    """Return the size in bytes of a type."""
+    """Return the size in bytes of the state of an aggregate."""
     if isinstance(src, types.ClassType):
         sig = types.int64(src)
 
@@ -510,16 +2821,15 @@ def sizeof(
             signature: Signature,
             args: Tuple[Value],
         ) -> Constant:
-            data_type = context.get_data_type(src.instance_type)
-            size_of_data_type = context.get_abi_sizeof(data_type)
-            return context.get_constant(sig.return_type, size_of_data_type)
+            size, _ = aggregate_state_layout(context, src)
+            return context.get_constant(sig.return_type, size)
 
         return sig, codegen
 
     raise TypeError(f"Cannot get ABI size of `{src}`")
 
 
-@extending.intrinsic  # type: ignore[misc]
+@extending.intrinsic  # type: ignore[misc, untyped-decorator]
 def is_not_null_pointer(
     typingctx: Context, raw_pointer_type: types.Integer
 ) -> Tuple[
@@ -0,0 +1,596 @@
+"""Run a query over partitions of a table, in parallel.
+
+A connection runs one statement at a time, so even functions compiled with
+``nogil=True`` only ever use one core per query. `parallel_execute` splits a
+scan of a table into partitions, runs the query on each partition with its
+own read-only connection in a thread pool, and combines the results. The
+`sqlite3` module releases the GIL while SQLite runs a statement, and the
+functions numbsql compiles don't take it back, so the partitions run
+concurrently.
+
+`parallel_aggregate` runs an aggregate with a `merge` method on the partitions
+of a table, returns the state of every group of every partition instead of its
+result, and merges the states of each group. `aggregate_partitions` does the
+same for the columns of partitions held in memory.
+
+Each connection hides the table behind a temporary view of the same name that
+only contains the rows of one partition, so the query is written as if it were
+run on the whole table. The connections share an `InterruptState`, so the
+partitions can be cancelled or time-boxed together.
+"""
+
+from __future__ import annotations
+
+import concurrent.futures
+import functools
+import itertools
+import os
+import sqlite3
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+import numba
+import numpy as np
+from numba import cfunc, njit
+from numba.types import ClassType, void, voidptr
+
+from .compiler import warmup
+from .exceptions import MissingAggregateMethod
+from .interrupt import InterruptState, set_progress_handler, state_pointer
+from .numbaext import (
+    AGGREGATE_CONTEXT_HEADER_SIZE,
+    init,
+    is_not_null_pointer,
+    point_inline_arrays,
+    release_state,
+    sizeof,
+    sqlite3_aggregate_context,
+    sqlite3_result_copy,
+    unsafe_cast,
+)
+from .register import (
+    UDFs,
+    collect_udfs,
+    create_functions,
+    function_flags,
+    num_params,
+)
+from .sqlite import (
+    SQLITE_OK,
+    destroyfunc,
+    finalizefunc,
+    get_sqlite_db,
+    scalarfunc,
+    sqlite3_create_function_v2,
+    sqlite3_errmsg,
+    stepfunc,
+)
+
+Row = Tuple[Any, ...]
+Combine = Callable[[List[List[Row]]], List[Row]]
+
+
+def _quote(identifier: str) -> str:
+    return '"{}"'.format(identifier.replace('"', '""'))
+
+
+def rowid_predicates(con: sqlite3.Connection, table: str, partitions: int) -> List[str]:
+    """Split the rows of `table` into at most `partitions` contiguous rowid
+    ranges of roughly the same width.
+
+    Returns a predicate selecting the rows of each range, in rowid order.
+    Views and ``WITHOUT ROWID`` tables have no rowids, so they raise
+    `ValueError`.
+    """
+    if partitions < 1:
+        raise ValueError(f"`partitions` must be at least 1, got {partitions}")
+    kinds = con.execute(
+        "SELECT type FROM sqlite_master WHERE name = ? COLLATE NOCASE", (table,)
+    ).fetchall()
+    if ("view",) in kinds:
+        raise ValueError(
+            f"`{table}` is a view, which has no rowids, so it can only be "
+            "partitioned by `predicates`"
+        )
+    try:
+        ((low, high),) = con.execute(
+            f"SELECT min(rowid), max(rowid) FROM {_quote(table)}"
+        ).fetchall()
+    except sqlite3.OperationalError as e:
+        if not str(e).startswith("no such column"):
+            raise
+        raise ValueError(
+            f"`{table}` is a WITHOUT ROWID table, so it can only be partitioned "
+            "by `predicates`"
+        ) from e
+    if low is None:
+        # the table is empty, but the query still has to run once, for example
+        # so that aggregates return a row
+        return ["1"]
+    width = -(-(high - low + 1) // partitions)
+    return [
+        f"rowid BETWEEN {start} AND {min(start + width - 1, high)}"
+        for start in range(low, high + 1, width)
+    ]
+
+
+def _execute_partition(
+    uri: str,
+    table: str,
+    predicate: str,
+    sql: str,
+    parameters: Sequence[Any],
+    functions: UDFs,
+    interrupt: Optional[InterruptState],
+    partial: Optional[ClassType],
+) -> List[Row]:
+    con = sqlite3.connect(uri, uri=True)
+    try:
+        set_progress_handler(con, state=interrupt)
+        create_functions(con, functions)
+        if partial is not None:
+            _create_partial(con, partial)
+        # unqualified names are looked up in the temp schema first
+        con.execute(
+            f"CREATE TEMP VIEW {_quote(table)} AS "
+            f"SELECT * FROM main.{_quote(table)} WHERE {predicate}"
+        )
+        return con.execute(sql, parameters).fetchall()
+    finally:
+        con.close()
+
+
+def concatenate(results: List[List[Row]]) -> List[Row]:
+    """Combine the results of partitions by concatenating their rows."""
+    return list(itertools.chain.from_iterable(results))
+
+
+def _run_partitions(
+    database: Union[str, os.PathLike[str]],
+    sql: str,
+    parameters: Sequence[Any],
+    table: str,
+    functions: UDFs,
+    partitions: Optional[int],
+    predicates: Optional[Sequence[str]],
+    interrupt: Optional[InterruptState],
+    partial: Optional[ClassType] = None,
+) -> List[List[Row]]:
+    """Run `sql` on every partition of `table`, and return the rows of each
+    partition in order."""
+    uri = f"{Path(database).resolve().as_uri()}?mode=ro"
+    udfs = collect_udfs(functions)
+    # compile lazy functions once, rather than in every thread
+    warmup(*udfs.values())
+
+    if predicates is not None and not predicates:
+        raise ValueError("`predicates` must have at least one predicate")
+    if predicates is None:
+        if partitions is None:
+            partitions = os.cpu_count() or 1
+        con = sqlite3.connect(uri, uri=True)
+        try:
+            predicates = rowid_predicates(con, table, partitions)
+        finally:
+            con.close()
+
+    with concurrent.futures.ThreadPoolExecutor(len(predicates)) as executor:
+        futures = [
+            executor.submit(
+                _execute_partition,
+                uri,
+                table,
+                predicate,
+                sql,
+                parameters,
+                udfs,
+                interrupt,
+                partial,
+            )
+            for predicate in predicates
+        ]
+        return [future.result() for future in futures]
+
+
+def parallel_execute(
+    database: Union[str, os.PathLike[str]],
+    sql: str,
+    parameters: Sequence[Any] = (),
+    *,
+    table: str,
+    combine: Combine,
+    functions: UDFs = (),
+    partitions: Optional[int] = None,
+    predicates: Optional[Sequence[str]] = None,
+    interrupt: Optional[InterruptState] = None,
+) -> List[Row]:
+    """Run `sql` on partitions of `table` in parallel, and combine the results.
+
+    Parameters
+    ----------
+    database : str or os.PathLike
+        The path to a SQLite database file. In-memory databases can't be
+        shared by connections, so they can't be queried in parallel.
+    sql : str
+        The query to run on each partition
+    parameters : Sequence
+        The parameters of `sql`
+    table : str
+        The table to partition. `sql` sees only the rows of one partition
+        when it refers to `table` without a schema name, and doesn't see the
+        table's rowid unless it has an ``INTEGER PRIMARY KEY`` column.
+    combine : callable
+        Combine the rows returned by each partition, in order, into the
+        result. Pass `concatenate` for queries that only filter and
+        transform the rows of `table`, or whose groups each belong to a
+        single partition. Aggregates, window functions, ``ORDER BY``,
+        ``DISTINCT``, ``LIMIT`` and compound queries apply to each partition
+        on its own, so their results need combining; `parallel_aggregate`
+        does that for aggregates with a `merge` method.
+    functions : module, mapping or iterable
+        The `sqlite_udf` functions and `sqlite_udaf` classes to register with
+        every connection: a module's functions, a mapping of names to
+        functions, or functions registered under their own names.
+    partitions : int, optional
+        The number of rowid ranges to split `table` into, by default the
+        number of CPUs
+    predicates : Sequence[str], optional
+        SQL expressions over the columns of `table` that select the rows of
+        each partition, instead of rowid ranges. Every row should match
+        exactly one of them.
+    interrupt : InterruptState, optional
+        The state given to the connection of every partition, through which
+        another thread can cancel or time-box the query
+
+    Examples
+    --------
+    >>> import os, sqlite3, tempfile
+    >>> from numbsql import sqlite_udf
+    >>> @sqlite_udf
+    ... def square(x: int) -> int:
+    ...     return x * x
+    ...
+    >>> path = os.path.join(tempfile.mkdtemp(), "numbers.db")
+    >>> con = sqlite3.connect(path)
+    >>> _ = con.execute("CREATE TABLE numbers (x INTEGER)")
+    >>> _ = con.executemany(
+    ...     "INSERT INTO numbers VALUES (?)", [(x,) for x in range(10)]
+    ... )
+    >>> con.commit()
+    >>> con.close()
+    >>> rows = parallel_execute(
+    ...     path,
+    ...     "SELECT sum(square(x)) FROM numbers",
+    ...     table="numbers",
+    ...     functions=[square],
+    ...     partitions=4,
+    ...     combine=lambda results: [(sum(rows[0][0] for rows in results),)],
+    ... )
+    >>> rows
+    [(285,)]
+    """
+    return combine(
+        _run_partitions(
+            database,
+            sql,
+            parameters,
+            table,
+            functions,
+            partitions,
+            predicates,
+            interrupt,
+        )
+    )
+
+
+# States are laid out like SQLite's aggregate contexts: a header, then the
+# instance data, then the elements of its fixed-size array fields.
+@functools.lru_cache(maxsize=None)
+def _state_functions(agg_class: ClassType) -> Tuple[Any, Any, Any, Any]:
+    @njit(nogil=True)  # type: ignore[misc]
+    def state_size():  # type: ignore[no-untyped-def]
+        return AGGREGATE_CONTEXT_HEADER_SIZE + sizeof(agg_class)
+
+    @njit(nogil=True)  # type: ignore[misc]
+    def state_of(buffer):  # type: ignore[no-untyped-def]
+        raw_pointer = buffer.ctypes.data
+        state = unsafe_cast(raw_pointer + AGGREGATE_CONTEXT_HEADER_SIZE, agg_class)
+        init(state, raw_pointer)
+        # states copied out of SQLite's aggregate contexts still point at them
+        point_inline_arrays(state)
+        return state
+
+    @njit(nogil=True)  # type: ignore[misc]
+    def step_all(buffer, columns):  # type: ignore[no-untyped-def]
+        state = state_of(buffer)
+        for row in zip(*columns):
+            state.step(*row)
+
+    @njit(nogil=True)  # type: ignore[misc]
+    def merge_all(buffers):  # type: ignore[no-untyped-def]
+        state = state_of(buffers[0])
+        for i in range(1, len(buffers)):
+            state.merge(state_of(buffers[i]))
+        return state.finalize()
+
+    @njit(nogil=True)  # type: ignore[misc]
+    def release_all(buffers):  # type: ignore[no-untyped-def]
+        for buffer in buffers:
+            # the header is only set once the state has been constructed
+            if buffer[0]:
+                release_state(state_of(buffer))
+
+    return state_size, step_all, merge_all, release_all
+
+
+def _column(values: Any) -> Any:
+    return values if isinstance(values, np.ndarray) else numba.typed.List(values)
+
+
+def _aggregate_partition(
+    step_all: Any, buffer: np.ndarray, columns: Sequence[Any]
+) -> None:
+    # typed lists of empty columns can't be typed, and there's nothing to step
+    if len(columns[0]):
+        step_all(buffer, tuple(map(_column, columns)))
+
+
+def aggregate_partitions(
+    agg_class: ClassType,
+    partitions: Sequence[Sequence[Any]],
+    *,
+    threads: Optional[int] = None,
+) -> Any:
+    """Aggregate each partition of the input in parallel, then merge their
+    states in order and return the result of `finalize`.
+
+    Parameters
+    ----------
+    agg_class : JitClass
+        A `sqlite_udaf` class with a `merge` method
+    partitions : Sequence[Sequence]
+        The columns of each partition, one for every argument of `step`.
+        Columns are NumPy arrays, or sequences of values that aren't NULL.
+    threads : int, optional
+        The most partitions to aggregate at the same time, by default the
+        number of CPUs
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> from numba.experimental import jitclass
+    >>> from numbsql import sqlite_udaf
+    >>> @sqlite_udaf
+    ... @jitclass
+    ... class Total:
+    ...     total: float
+    ...
+    ...     def __init__(self) -> None:
+    ...         self.total = 0.0
+    ...
+    ...     def step(self, value: float) -> None:
+    ...         self.total += value
+    ...
+    ...     def merge(self, other) -> None:
+    ...         self.total += other.total
+    ...
+    ...     def finalize(self) -> float:
+    ...         return self.total
+    ...
+    >>> values = np.arange(100.0)
+    >>> aggregate_partitions(Total, [(part,) for part in np.array_split(values, 4)])
+    4950.0
+    """
+    warmup(agg_class)
+    if "merge" not in agg_class.class_type.jit_methods:
+        raise MissingAggregateMethod(agg_class, "merge")
+    if not partitions:
+        raise ValueError("`partitions` must have at least one partition")
+
+    state_size, step_all, merge_all, release_all = _state_functions(agg_class)
+    # zero-filled, so that no state has been constructed yet
+    buffers = numba.typed.List(
+        np.zeros(state_size(), dtype=np.uint8) for _ in partitions
+    )
+    try:
+        with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+            list(
+                executor.map(
+                    functools.partial(_aggregate_partition, step_all),
+                    buffers,
+                    partitions,
+                )
+            )
+        return merge_all(buffers)
+    finally:
+        release_all(buffers)
+
+
+# the name of the aggregate that returns the states of the partitions of
+# `parallel_aggregate`
+_PARTIAL = "numbsql_partial"
+
+
+@functools.lru_cache(maxsize=None)
+def _partial_finalize(agg_class: ClassType) -> Any:
+    state_size, *_ = _state_functions(agg_class)
+
+    @cfunc(void(voidptr), nogil=True)  # type: ignore[misc, untyped-decorator]
+    def finalize(ctx):  # type: ignore[no-untyped-def]
+        # the state's strings, lists and dicts now belong to the copy, which
+        # releases them once it's merged
+        raw_pointer = sqlite3_aggregate_context(ctx, 0)
+        if is_not_null_pointer(raw_pointer):
+            sqlite3_result_copy(ctx, raw_pointer, state_size())
+
+    return finalize
+
+
+def _create_partial(con: sqlite3.Connection, agg_class: ClassType) -> None:
+    """Register an aggregate that steps like `agg_class`, but returns a copy
+    of its state as a BLOB instead of finalizing it."""
+    sqlite_db = get_sqlite_db(con)
+    if (
+        sqlite3_create_function_v2(
+            sqlite_db,
+            _PARTIAL.encode("utf8"),
+            num_params(agg_class),
+            function_flags(agg_class),
+            state_pointer(con),
+            scalarfunc(0),
+            stepfunc(agg_class.step.address),
+            finalizefunc(_partial_finalize(agg_class).address),
+            destroyfunc(0),
+        )
+        != SQLITE_OK
+    ):
+        raise sqlite3.OperationalError(sqlite3_errmsg(sqlite_db))
+
+
+def _merge_groups(agg_class: ClassType, results: List[List[Row]]) -> List[Row]:
+    state_size, _, merge_all, release_all = _state_functions(agg_class)
+    size = state_size()
+    # the states of each group, in the order the groups first appear
+    groups: Dict[Row, List[np.ndarray]] = {}
+    try:
+        for rows in results:
+            for *key, partial in rows:
+                states = groups.setdefault(tuple(key), [])
+                # NULL when the partition had no rows to aggregate
+                if partial is not None:
+                    buffer = np.empty(size, dtype=np.uint8)
+                    buffer[:] = np.frombuffer(partial, dtype=np.uint8)
+                    states.append(buffer)
+        return [
+            (*key, merge_all(numba.typed.List(states)) if states else None)
+            for key, states in groups.items()
+        ]
+    finally:
+        for states in groups.values():
+            if states:
+                release_all(numba.typed.List(states))
+
+
+def parallel_aggregate(
+    database: Union[str, os.PathLike[str]],
+    agg_class: ClassType,
+    arguments: Sequence[str],
+    parameters: Sequence[Any] = (),
+    *,
+    table: str,
+    group_by: Sequence[str] = (),
+    where: Optional[str] = None,
+    functions: UDFs = (),
+    partitions: Optional[int] = None,
+    predicates: Optional[Sequence[str]] = None,
+    interrupt: Optional[InterruptState] = None,
+) -> List[Row]:
+    """Aggregate the groups of `table` by partitions in parallel, then merge
+    the states of each group and return its result.
+
+    The aggregate runs in SQLite like `parallel_execute` runs a query, but
+    every partition returns the state of each of its groups rather than its
+    result, and the states of a group are merged in partition order before
+    `finalize` is called.
+
+    Parameters
+    ----------
+    database : str or os.PathLike
+        The path to a SQLite database file
+    agg_class : JitClass
+        A `sqlite_udaf` class with a `merge` method
+    arguments : Sequence[str]
+        SQL expressions over the columns of `table`, one for every argument
+        of `step`
+    parameters : Sequence
+        The parameters of `group_by`, `arguments` and `where`, in that order
+    table : str
+        The table to aggregate
+    group_by : Sequence[str]
+        SQL expressions over the columns of `table` whose values are the keys
+        of the groups. By default the whole table is one group.
+    where : str, optional
+        A SQL expression selecting the rows to aggregate
+    functions : module, mapping or iterable
+        The `sqlite_udf` functions and `sqlite_udaf` classes the expressions
+        call, as in `parallel_execute`
+    partitions : int, optional
+        The number of rowid ranges to split `table` into, by default the
+        number of CPUs
+    predicates : Sequence[str], optional
+        SQL expressions selecting the rows of each partition, as in
+        `parallel_execute`
+    interrupt : InterruptState, optional
+        The state given to the connection of every partition
+
+    Returns
+    -------
+    list of tuple
+        A row of the keys of each group followed by its result, in the order
+        the groups first appear in the partitions. The result of a table with
+        no rows to aggregate is NULL, like in SQLite.
+
+    Examples
+    --------
+    >>> import os, sqlite3, tempfile
+    >>> from numba.experimental import jitclass
+    >>> from numbsql import sqlite_udaf
+    >>> @sqlite_udaf
+    ... @jitclass
+    ... class Total:
+    ...     total: int
+    ...
+    ...     def __init__(self) -> None:
+    ...         self.total = 0
+    ...
+    ...     def step(self, value: int) -> None:
+    ...         self.total += value
+    ...
+    ...     def merge(self, other) -> None:
+    ...         self.total += other.total
+    ...
+    ...     def finalize(self) -> int:
+    ...         return self.total
+    ...
+    >>> path = os.path.join(tempfile.mkdtemp(), "numbers.db")
+    >>> con = sqlite3.connect(path)
+    >>> _ = con.execute("CREATE TABLE numbers (x INTEGER)")
+    >>> _ = con.executemany(
+    ...     "INSERT INTO numbers VALUES (?)", [(x,) for x in range(10)]
+    ... )
+    >>> con.commit()
+    >>> con.close()
+    >>> parallel_aggregate(
+    ...     path, Total, ["x"], table="numbers", group_by=["x % 2"], partitions=4
+    ... )
+    [(0, 20), (1, 25)]
+    """
+    warmup(agg_class)
+    if "merge" not in agg_class.class_type.jit_methods:
+        raise MissingAggregateMethod(agg_class, "merge")
+
+    # group by position, so that the parameters of the keys are only bound once
+    sql = "SELECT {} FROM {}".format(
+        ", ".join([*group_by, f"{_PARTIAL}({', '.join(arguments)})"]),
+        _quote(table),
+    )
+    if where is not None:
+        sql += f" WHERE {where}"
+    if group_by:
+        sql += " GROUP BY {}".format(
+            ", ".join(str(i) for i in range(1, len(group_by) + 1))
+        )
+    return _merge_groups(
+        agg_class,
+        _run_partitions(
+            database,
+            sql,
+            parameters,
+            table,
+            functions,
+            partitions,
+            predicates,
+            interrupt,
+            partial=agg_class,
+        ),
+    )
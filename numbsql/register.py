@@ -0,0 +1,276 @@
+"""Registration of compiled functions with SQLite connections."""
+
+from __future__ import annotations
+
+import inspect
+import sqlite3
+import typing
+from types import ModuleType
+from typing import Any, Callable, Dict, Iterable, Mapping, Union
+
+from numba.core.ccallback import CFunc
+from numba.types import ClassType
+
+from .compiler import is_pending, warmup
+from .exceptions import MissingAggregateMethod
+from .interrupt import state_pointer
+from .sqlite import (
+    SQLITE_DETERMINISTIC,
+    SQLITE_OK,
+    SQLITE_RESULT_SUBTYPE,
+    SQLITE_UTF8,
+    destroyfunc,
+    finalizefunc,
+    get_sqlite_db,
+    inversefunc,
+    scalarfunc,
+    sqlite3_create_function,
+    sqlite3_create_function_v2,
+    sqlite3_create_window_function,
+    sqlite3_errmsg,
+    stepfunc,
+    valuefunc,
+)
+from .structured import declared_encoding
+
+# the ways of passing several functions at once: a module's functions, a
+# mapping of names to functions, or functions named after themselves
+UDFs = Union[ModuleType, Mapping[str, Any], Iterable[Any]]
+
+
+def _result_flags(func: Callable[..., Any]) -> int:
+    """Return the flags that the results of `func` need.
+
+    Functions that return JSON give it SQLite's JSON subtype.
+    """
+    return_hint = typing.get_type_hints(func, include_extras=True).get("return")
+    return SQLITE_RESULT_SUBTYPE if declared_encoding(return_hint) == "json" else 0
+
+
+def function_flags(obj: Any, deterministic: bool = False) -> int:
+    """Return the flags to register the `sqlite_udf` function or `sqlite_udaf`
+    class `obj` with."""
+    if hasattr(obj, "class_type"):
+        func = obj.class_type.methods["finalize"]
+    else:
+        func = obj
+    return (
+        SQLITE_UTF8
+        | (SQLITE_DETERMINISTIC if deterministic else 0)
+        | _result_flags(func)
+    )
+
+
+def create_function(
+    con: sqlite3.Connection,
+    name: str,
+    num_params: int,
+    func: Callable[..., Any],
+    deterministic: bool = False,
+) -> None:
+    """Register a UDF with name `name` with the SQLite connection `con`.
+
+    Parameters
+    ----------
+    con : sqlite3.Connection
+        A connection to a SQLite database
+    name : str
+        The name of this function in the database, given as a UTF-8 encoded
+        string
+    num_params : int
+        The number of arguments this function takes, or -1 if `func` collects
+        any number of arguments with `*args`
+    func : cfunc
+        The sqlite_udf-decorated function to register. If `func` was defined
+        with `lazy=True` and hasn't been compiled yet, it's compiled here.
+    deterministic : bool
+        True if this function returns the same output given the same input.
+        Most functions are deterministic.
+
+    Examples
+    --------
+    >>> import sqlite3
+    >>> from numbsql import sqlite_udf
+    >>> from typing import Optional
+    >>> @sqlite_udf
+    ... def add_one(value: Optional[int]) -> Optional[int]:
+    ...     return value + 1 if value is not None else None
+    ...
+    >>> from numbsql import create_aggregate, create_function
+    >>> con = sqlite3.connect(":memory:")
+    >>> create_function(con, "add_one", 1, add_one)
+    >>> con.execute("SELECT add_one(1)").fetchall()
+    [(2,)]
+    >>> con.execute("SELECT add_one(NULL)").fetchall()
+    [(None,)]
+    >>> con.close()
+
+    """
+    warmup(func)
+    sqlite_db = get_sqlite_db(con)
+    if (
+        sqlite3_create_function(
+            sqlite_db,
+            name.encode("utf8"),
+            num_params,
+            function_flags(func, deterministic),
+            state_pointer(con),
+            scalarfunc(func.scalar.address),  # type: ignore[attr-defined]
+            stepfunc(0),
+            finalizefunc(0),
+        )
+        != SQLITE_OK
+    ):
+        raise sqlite3.OperationalError(sqlite3_errmsg(sqlite_db))
+
+
+def create_aggregate(
+    con: sqlite3.Connection,
+    name: str,
+    num_params: int,
+    agg_class: ClassType,
+    deterministic: bool = False,
+) -> None:
+    """Register an aggregate named `name` with the SQLite connection `con`.
+
+    Parameters
+    ----------
+    con : sqlite3.Connection
+        A connection to a SQLite database
+    name : str
+        The name of this function in the database, given as a UTF-8 encoded
+        string
+    num_params : int
+        The number of arguments this function takes
+    aggregate_class : JitClass
+       This class must be decorated with @sqlite_udaf for this function to
+       work. If this class has `value` and `inverse` attributes, it will be
+       registered as a window function. Window functions can also be used as
+       standard aggregate functions. If this class was defined with
+       `lazy=True` and hasn't been compiled yet, it's compiled here.
+    deterministic : bool
+        True if this function returns the same output given the same input.
+        Most functions are deterministic. `RANDOM()` is a notable exception.
+
+    """
+    warmup(agg_class)
+
+    try:
+        step_method = agg_class.step
+    except AttributeError as e:
+        raise MissingAggregateMethod(agg_class, "step") from e
+    else:
+        step_address = step_method.address
+
+    try:
+        finalize_method = agg_class.finalize
+    except AttributeError as e:
+        raise MissingAggregateMethod(agg_class, "finalize") from e
+    else:
+        finalize_address = finalize_method.address
+
+    value_address = getattr(getattr(agg_class, "value", None), "address", None)
+    inverse_address = getattr(getattr(agg_class, "inverse", None), "address", None)
+
+    namebytes = name.encode("utf8")
+    sqlite_db = get_sqlite_db(con)
+    flags = function_flags(agg_class, deterministic)
+    state_address = state_pointer(con)
+
+    if value_address is not None and inverse_address is not None:
+        rc = sqlite3_create_window_function(
+            sqlite_db,
+            namebytes,
+            num_params,
+            flags,
+            state_address,
+            stepfunc(step_address),
+            finalizefunc(finalize_address),
+            valuefunc(value_address),
+            inversefunc(inverse_address),
+            destroyfunc(0),
+        )
+    else:
+        rc = sqlite3_create_function_v2(
+            sqlite_db,
+            namebytes,
+            num_params,
+            flags,
+            state_address,
+            scalarfunc(0),
+            stepfunc(step_address),
+            finalizefunc(finalize_address),
+            destroyfunc(0),
+        )
+    if rc != SQLITE_OK:
+        raise sqlite3.OperationalError(sqlite3_errmsg(sqlite_db))
+
+
+def _is_udf(obj: Any) -> bool:
+    return (
+        is_pending(obj)
+        or isinstance(getattr(obj, "scalar", None), CFunc)
+        or isinstance(getattr(getattr(obj, "step", None), "trampoline", None), CFunc)
+    )
+
+
+def num_params(obj: Any) -> int:
+    """Return the number of arguments of a compiled `sqlite_udf` function or
+    `sqlite_udaf` class, or -1 if it takes any number."""
+    if hasattr(obj, "scalar"):
+        parameters = inspect.signature(obj).parameters.values()
+        # functions that collect `*args` take any number of arguments
+        if any(p.kind is inspect.Parameter.VAR_POSITIONAL for p in parameters):
+            return -1
+        return len(parameters)
+    # don't count `self`
+    return len(inspect.signature(obj.step).parameters) - 1
+
+
+def collect_udfs(udfs: UDFs) -> Dict[str, Any]:
+    """Return the functions in `udfs`, keyed by the names to register them
+    under."""
+    if isinstance(udfs, ModuleType):
+        return {
+            name: obj
+            for name, obj in vars(udfs).items()
+            if getattr(obj, "__module__", None) == udfs.__name__ and _is_udf(obj)
+        }
+    if isinstance(udfs, Mapping):
+        return dict(udfs)
+    return {obj.__name__: obj for obj in typing.cast(Iterable[Any], udfs)}
+
+
+def create_functions(con: sqlite3.Connection, udfs: UDFs) -> None:
+    """Register several `sqlite_udf` functions and `sqlite_udaf` classes with
+    the SQLite connection `con`.
+
+    Parameters
+    ----------
+    con : sqlite3.Connection
+        A connection to a SQLite database
+    udfs : module, mapping or iterable
+        The functions to register: the functions defined in a module, a
+        mapping of names to functions, or functions to register under their
+        own names
+
+    Examples
+    --------
+    >>> import sqlite3
+    >>> from numbsql import sqlite_udf
+    >>> @sqlite_udf
+    ... def add_one(value: int) -> int:
+    ...     return value + 1
+    ...
+    >>> con = sqlite3.connect(":memory:")
+    >>> create_functions(con, {"plus_one": add_one})
+    >>> con.execute("SELECT plus_one(1)").fetchall()
+    [(2,)]
+    >>> con.close()
+    """
+    for name, func in collect_udfs(udfs).items():
+        warmup(func)
+        if hasattr(func, "scalar"):
+            create_function(con, name, num_params(func), func)
+        else:
+            create_aggregate(con, name, num_params(func), func)
@@ -0,0 +1,76 @@
+"""Load precompiled numbsql functions without numba.
+
+Importing numba and llvmlite takes time and memory that processes which only
+run queries don't need. Build the functions they use into an extension with
+`numbsql.extension` ahead of time, and load it at runtime with
+`load_extension`, which only needs `ctypes`.
+"""
+
+from __future__ import annotations
+
+import ctypes
+import os
+import sqlite3
+from typing import Optional, Union
+
+from .sqlite import (
+    SQLITE_DBCONFIG_ENABLE_LOAD_EXTENSION,
+    SQLITE_OK,
+    get_sqlite_db,
+    sqlite3_db_config,
+    sqlite3_errmsg,
+    sqlite3_free,
+    sqlite3_load_extension,
+)
+
+
+def load_extension(
+    con: sqlite3.Connection,
+    path: Union[str, os.PathLike[str]],
+    entry_point: Optional[str] = None,
+) -> None:
+    """Load the SQLite extension at `path` into `con`.
+
+    Unlike `sqlite3.Connection.load_extension`, this works whether or not
+    Python's `sqlite3` module was built with support for extensions, and
+    doesn't enable the SQL `load_extension()` function.
+
+    Parameters
+    ----------
+    con
+        A connection to a SQLite database
+    path
+        The path to the extension.
+    entry_point
+        The name of the function that SQLite calls to load the extension.
+        Defaults to SQLite's choice of name.
+    """
+    sqlite_db = get_sqlite_db(con)
+    sqlite3_db_config(
+        ctypes.c_void_p(sqlite_db),
+        ctypes.c_int(SQLITE_DBCONFIG_ENABLE_LOAD_EXTENSION),
+        ctypes.c_int(1),
+        ctypes.c_void_p(None),
+    )
+    errmsg = ctypes.c_void_p()
+    try:
+        rc = sqlite3_load_extension(
+            sqlite_db,
+            os.fsencode(path),
+            entry_point.encode("utf8") if entry_point is not None else None,
+            ctypes.byref(errmsg),
+        )
+    finally:
+        sqlite3_db_config(
+            ctypes.c_void_p(sqlite_db),
+            ctypes.c_int(SQLITE_DBCONFIG_ENABLE_LOAD_EXTENSION),
+            ctypes.c_int(0),
+            ctypes.c_void_p(None),
+        )
+
+    if rc != SQLITE_OK:
+        if errmsg.value is None:
+            raise sqlite3.OperationalError(sqlite3_errmsg(sqlite_db))
+        message = ctypes.string_at(errmsg.value).decode("utf8")
+        sqlite3_free(errmsg)
+        raise sqlite3.OperationalError(message)
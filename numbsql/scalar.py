@@ -1,21 +1,62 @@
 from __future__ import annotations
 
 import functools
+import inspect
+import itertools
+import types as pytypes
 import typing
-from typing import Any, Callable, Optional
+from typing import Any, Callable, Optional, Union
 
-from numba import cfunc, njit
+import numpy as np
+from numba import njit, types
 from numba.core.ccallback import CFunc
-from numba.extending import as_numba_type
 from numba.types import CPointer, intc, void, voidptr
 
-from .numbaext import make_arg_tuple, sqlite3_result
-from .sqlite import sqlite3_result_null
+from .cache import fingerprint, trampoline
+from .compiler import defer
+from .numbaext import (
+    SCALAR_NULL_POLICIES,
+    accepts_return_type,
+    as_numba_type,
+    call_udf,
+    is_blob_type,
+    type_hint_alternatives,
+    variadic_arguments_type,
+)
+from .structured import declared_encoding, packed_dtype
+
+
+def _collect_varargs(func: Callable[..., Any]) -> Callable[..., Any]:
+    """Return a copy of `func` that takes the arguments it collects with
+    `*args` as a single, last positional argument.
+
+    The copy shares the code of `func`, in which `args` is already a local
+    variable that follows the positional arguments.
+    """
+    code = func.__code__
+    collected = pytypes.FunctionType(
+        code.replace(
+            co_flags=code.co_flags & ~inspect.CO_VARARGS,
+            co_argcount=code.co_argcount + 1,
+        ),
+        func.__globals__,
+        func.__name__,
+        func.__defaults__,
+        func.__closure__,
+    )
+    collected.__qualname__ = func.__qualname__
+    collected.__module__ = func.__module__
+    collected.__annotations__ = func.__annotations__
+    collected.__doc__ = func.__doc__
+    return collected
 
 
 def sqlite_udf(
     func: Optional[Callable[..., Any]] = None,
     nogil: bool = True,
+    cache: bool = False,
+    lazy: bool = False,
+    null_policy: str = "error",
     **njit_kwargs: Any,
 ) -> Callable[[Callable[..., Any]], CFunc]:
     """Define a custom scalar function.
@@ -26,9 +67,51 @@ def sqlite_udf(
         A user-defined function.
     nogil
         Whether to release the GIL.
+    cache
+        Whether to cache the compiled function on disk. Later processes
+        defining the same function load the compiled code from the cache
+        instead of compiling it.
+    lazy
+        Whether to defer compilation until the function is registered with
+        `create_function` or passed to `warmup`.
+    null_policy
+        What to do when a NULL is passed to an argument that isn't optional:
+        ``"error"`` fails the query, and ``"return_null"`` returns NULL
+        without calling `func`.
     njit_kwargs
         Any additional keyword arguments supported by numba's `njit` decorator.
 
+    Notes
+    -----
+    Arguments annotated with a union of types, such as `Union[int, float]`,
+    compile a specialization of `func` for every combination of argument
+    types. Each call runs the specialization that matches the types of the
+    values SQLite passes in, so that for example integers stay integers. When
+    the return type is a union, each specialization's return type is
+    inferred, and must be one of the members of the union.
+
+    Functions annotated to return `numpy.ndarray` or `bytes` return BLOBs
+    made of the bytes of any contiguous array or bytes object. Arrays
+    allocated by the function are handed to SQLite without copying them.
+    Functions annotated to return `numpy.typing.NDArray[dtype]` must return
+    arrays of `dtype`.
+
+    Functions that collect their trailing arguments with `*args`, which must
+    all have the same type, are registered with `num_params=-1`. `args` is a
+    sequence that supports `len`, indexing and iteration, and converts each
+    argument when it's accessed.
+
+    `numpy.datetime64` and `numpy.timedelta64` arguments and results are
+    annotated with their unit and how SQLite stores them, as in
+    `Annotated[numpy.datetime64, "s", "integer"]`. See `numbsql.timestamps`.
+
+    Functions annotated to return a `typing.Tuple` or a `typing.NamedTuple`
+    return JSON with SQLite's JSON subtype, or packed BLOBs whose fields
+    `unpacker` extracts when annotated with ``"blob"``, as in
+    `Annotated[Tuple[int, float], "blob"]`. See `numbsql.structured`.
+
+    Exceptions raised by `func` fail the query with a `sqlite3.Error`.
+
     Examples
     --------
     >>> import sqlite3
@@ -42,27 +125,196 @@ def sqlite_udf(
     2
     >>> add_one(None) is None
     True
+    >>> from typing import Union
+    >>> @sqlite_udf
+    ... def double(value: Union[int, float]) -> Union[int, float]:
+    ...     return value * 2
+    ...
+    >>> double(2)
+    4
+    >>> double(2.5)
+    5.0
     """
     if func is None:
-        return functools.partial(sqlite_udf, nogil=nogil, **njit_kwargs)
-
-    python_signature = typing.get_type_hints(func)
-    return_type = as_numba_type(python_signature.pop("return"))
-    argument_types = map(as_numba_type, python_signature.values())
-    numba_signature = return_type(*argument_types)
-    compiled_func = njit(numba_signature, nogil=nogil, **njit_kwargs)(func)
-
-    @cfunc(void(voidptr, intc, CPointer(voidptr)))  # type: ignore[misc]
-    def scalar(  # type: ignore[no-untyped-def]
-        ctx, argc: int, argv
-    ):  # pragma: no cover
-        args = make_arg_tuple(compiled_func, argv)
-        result = compiled_func(*args)
-        if result is None:
-            sqlite3_result_null(ctx)
-        else:
-            sqlite3_result(ctx, result)
-
-    setattr(func, "scalar", scalar)
+        return functools.partial(
+            sqlite_udf,
+            nogil=nogil,
+            cache=cache,
+            lazy=lazy,
+            null_policy=null_policy,
+            **njit_kwargs,
+        )
+
+    if null_policy not in SCALAR_NULL_POLICIES:
+        raise ValueError(
+            f"`{null_policy}` isn't a NULL policy of scalar functions, expected "
+            f"one of {list(SCALAR_NULL_POLICIES)}"
+        )
+
+    parameters = inspect.signature(func).parameters.values()
+    variadic_names = [
+        parameter.name
+        for parameter in parameters
+        if parameter.kind is inspect.Parameter.VAR_POSITIONAL
+    ]
+    if variadic_names and any(
+        parameter.kind
+        in (inspect.Parameter.KEYWORD_ONLY, inspect.Parameter.VAR_KEYWORD)
+        for parameter in parameters
+    ):
+        raise TypeError(
+            f"`{func.__name__}` can't take keyword arguments along with `*args`"
+        )
+
+    python_signature = typing.get_type_hints(func, include_extras=True)
+    return_types = type_hint_alternatives(python_signature.pop("return"))
+    argument_types = [
+        [variadic_arguments_type(type_hint, func_name=func.__name__)]
+        if name in variadic_names
+        else type_hint_alternatives(type_hint)
+        for name, type_hint in python_signature.items()
+    ]
+    # leave the return type out to have numba infer it when it's a union, or
+    # an array, whose declared type doesn't pin down its exact numba type
+    infer_return_type = len(return_types) > 1 or is_blob_type(return_types[0])
+    numba_signatures = [
+        args if infer_return_type else return_types[0](*args)
+        for args in itertools.product(*argument_types)
+    ]
+
+    def compile_scalar(cache: bool = cache) -> None:
+        compiled_func = njit(nogil=nogil, **njit_kwargs)(
+            _collect_varargs(func) if variadic_names else func
+        )
+
+        def compile_func() -> None:
+            for numba_signature in numba_signatures:
+                compiled_func.compile(numba_signature)
+            compiled_func.disable_compile()
+
+            for signature in compiled_func.nopython_signatures:
+                return_type = signature.return_type
+                if not any(
+                    accepts_return_type(declared_type, return_type)
+                    for declared_type in return_types
+                ):
+                    raise TypeError(
+                        f"`{func.__name__}` returns `{return_type}` when called "
+                        f"with `{signature.args}`, expected one of {return_types}"
+                    )
 
+        @trampoline(  # type: ignore[misc]
+            void(voidptr, intc, CPointer(voidptr)),
+            fingerprint=fingerprint(
+                "scalar",
+                func.__module__,
+                func,
+                numba_signatures,
+                nogil,
+                null_policy,
+                sorted(njit_kwargs.items()),
+            ),
+            cache=cache,
+            prepare=compile_func,
+        )
+        def scalar(  # type: ignore[no-untyped-def]
+            ctx, argc: int, argv
+        ):  # pragma: no cover
+            call_udf(ctx, compiled_func, argc, argv, null_policy)
+
+        setattr(func, "scalar", scalar)
+
+    defer(func, compile_scalar, lazy=lazy)
     return func
+
+
+def unpacker(
+    func: Callable[..., Any],
+    field: Union[int, str],
+    cache: bool = False,
+    lazy: bool = False,
+) -> Callable[..., Any]:
+    """Define a scalar function that extracts a field of the packed BLOBs
+    returned by `func`.
+
+    Parameters
+    ----------
+    func
+        A user-defined function annotated to return tuples encoded as
+        ``"blob"``.
+    field
+        The index of the field, or its name if `func` returns named tuples.
+    cache
+        Whether to cache the compiled function on disk.
+    lazy
+        Whether to defer compilation until the function is registered with
+        `create_function` or passed to `warmup`.
+
+    Notes
+    -----
+    The function returns NULL for NULL and for BLOBs of the wrong size.
+
+    Examples
+    --------
+    >>> import sqlite3
+    >>> from typing import Annotated, Tuple
+    >>> from numbsql import create_function, sqlite_udf, unpacker
+    >>> @sqlite_udf
+    ... def divmod_(x: int, y: int) -> Annotated[Tuple[int, int], "blob"]:
+    ...     return x // y, x % y
+    ...
+    >>> con = sqlite3.connect(":memory:")
+    >>> create_function(con, "divmod", 2, divmod_)
+    >>> create_function(con, "quotient", 1, unpacker(divmod_, 0))
+    >>> create_function(con, "remainder", 1, unpacker(divmod_, 1))
+    >>> con.execute(
+    ...     "SELECT quotient(d), remainder(d) FROM (SELECT divmod(7, 2) AS d)"
+    ... ).fetchall()
+    [(3, 1)]
+    >>> con.close()
+    """
+    return_hint = typing.get_type_hints(func, include_extras=True)["return"]
+    if declared_encoding(return_hint) != "blob":
+        raise TypeError(f"`{func.__name__}` doesn't return tuples packed as BLOBs")
+    record_type = as_numba_type(return_hint)
+    if isinstance(record_type, types.Optional):
+        record_type = record_type.type
+
+    dtype = packed_dtype(record_type)
+    names = dtype.names or ()
+    if isinstance(field, int):
+        if not 0 <= field < len(names):
+            raise TypeError(
+                f"`{func.__name__}` returns tuples without a field {field:d}"
+            )
+        name = names[field]
+    else:
+        name = field
+    if dtype.fields is None or name not in dtype.fields:
+        raise TypeError(f"`{func.__name__}` returns tuples without a `{name}` field")
+    field_dtype, offset = dtype.fields[name][:2]
+
+    # the layout is part of the code, which keys the on-disk cache
+    namespace = {"scalar": field_dtype.type}
+    exec(
+        "\n".join(
+            [
+                "def unpack(data):",
+                f"    if data is None or len(data) != {dtype.itemsize:d}:",
+                "        return None",
+                "    # copy the field, which may not be aligned",
+                f"    value = data[{offset:d}:{offset + field_dtype.itemsize:d}]",
+                "    return value.copy().view(scalar)[0]",
+            ]
+        ),
+        namespace,
+    )
+    unpack = namespace["unpack"]
+    unpack.__name__ = f"{func.__name__}_{name}"
+    unpack.__qualname__ = f"{func.__qualname__}.{name}"
+    unpack.__module__ = func.__module__
+    unpack.__annotations__ = {
+        "data": Optional[np.ndarray],
+        "return": Optional[field_dtype.type],
+    }
+    return sqlite_udf(unpack, cache=cache, lazy=lazy)
@@ -0,0 +1,348 @@
+"""Encodings of tuple results, which SQLite has no type for.
+
+A function annotated to return a tuple, either as `typing.Tuple[...]` or as a
+`typing.NamedTuple` class, returns all of its fields in a single value, so
+that related values computed in one pass don't need a separate function call
+each. The encoding is declared with `typing.Annotated`::
+
+    Annotated[Tuple[int, float], "blob"]
+
+``"json"``, the default, encodes tuples as JSON arrays and named tuples as
+JSON objects, with SQLite's JSON subtype so that JSON functions and the
+``->`` and ``->>`` operators consume them directly. Fields can be numbers,
+booleans, strings, None and nested tuples.
+
+``"blob"`` packs fields that are numbers or booleans one after another,
+without padding, in native byte order, which is the layout of
+`packed_dtype`.
+"""
+
+from __future__ import annotations
+
+import math
+import types as pytypes
+import typing
+from typing import Any, Callable, List, Optional, Tuple
+
+import numpy as np
+from llvmlite import ir
+from numba import extending, njit, types
+from numba.core import cgutils
+from numba.core.base import BaseContext
+from numba.core.typing.context import Context
+from numba.core.typing.templates import Signature
+from numba.cpython.unicode import _get_code_point
+from numba.np.numpy_support import as_dtype
+
+if typing.TYPE_CHECKING:
+    from llvmlite.ir.builder import IRBuilder
+    from llvmlite.ir.instructions import Value
+
+ENCODINGS = ("json", "blob")
+
+# the subtype SQLite's JSON functions give to their results, and look for in
+# their arguments
+JSON_SUBTYPE = ord("J")
+
+
+def is_tuple_hint(type_hint: Any) -> bool:
+    """Return whether `type_hint` is a `typing.Tuple` or a `typing.NamedTuple`
+    class."""
+    return typing.get_origin(type_hint) is tuple or (
+        isinstance(type_hint, type)
+        and issubclass(type_hint, tuple)
+        and hasattr(type_hint, "_fields")
+    )
+
+
+def declared_encoding(type_hint: Any) -> Optional[str]:
+    """Return how the tuples allowed by `type_hint`, optional or not, are
+    encoded.
+
+    Returns `None` if `type_hint` doesn't allow tuples.
+    """
+    members: Tuple[Any, ...] = (type_hint,)
+    if typing.get_origin(type_hint) in (typing.Union, pytypes.UnionType):
+        members = typing.get_args(type_hint)
+    for member in members:
+        metadata: List[Any] = []
+        if typing.get_origin(member) is typing.Annotated:
+            member, *metadata = typing.get_args(member)
+        if not is_tuple_hint(member):
+            continue
+
+        encoding = ENCODINGS[0]
+        for value in metadata:
+            if value not in ENCODINGS:
+                raise TypeError(
+                    f"`{value!r}` isn't an encoding of tuples, expected one of "
+                    f"{list(ENCODINGS)}"
+                )
+            encoding = value
+        return encoding
+    return None
+
+
+def packed_dtype(record_type: types.BaseTuple) -> np.dtype:
+    """Return the NumPy dtype of the packed BLOBs that tuples of
+    `record_type` are encoded as."""
+    names = getattr(record_type, "fields", None) or [
+        f"f{i:d}" for i in range(len(record_type))
+    ]
+    formats = []
+    for field_type in record_type:
+        if not isinstance(field_type, (types.Boolean, types.Integer, types.Float)):
+            raise TypeError(
+                f"Tuples with `{field_type}` fields can't be packed, only numbers "
+                "and booleans can"
+            )
+        formats.append(as_dtype(field_type))
+    return np.dtype({"names": list(names), "formats": formats}, align=False)
+
+
+# JSON tokens, as UTF-8
+_TRUE = np.frombuffer(b"true", dtype=np.uint8)
+_FALSE = np.frombuffer(b"false", dtype=np.uint8)
+_NULL = np.frombuffer(b"null", dtype=np.uint8)
+# the letters of the short escapes of control characters, such as \n, or zero
+# for control characters that are escaped as \u00XX
+_SHORT_ESCAPES = np.frombuffer(b"\0" * 8 + b"btn\0fr" + b"\0" * 18, dtype=np.uint8)
+# SQLite's JSON functions render infinities as numbers too large to be finite
+_INFINITY = np.frombuffer(b"9e999", dtype=np.uint8)
+_NEGATIVE_INFINITY = np.frombuffer(b"-9e999", dtype=np.uint8)
+
+# large enough for any double formatted with %.17g, and its null terminator
+_DOUBLE_BUFFER_SIZE = 32
+
+
+@extending.intrinsic  # type: ignore[misc, untyped-decorator]
+def format_double(
+    typingctx: Context,
+    buffer: types.Array,
+    start: types.Integer,
+    value: types.Float,
+    precision: types.Integer,
+) -> Tuple[
+    Signature,
+    Callable[[BaseContext, IRBuilder, Signature, Tuple[Value, ...]], Value],
+]:
+    """Format `value` with `precision` significant digits like `%.*g` at
+    position `start` of `buffer`, followed by a null terminator, and return
+    the number of characters written.
+
+    `buffer` must have room for `_DOUBLE_BUFFER_SIZE` bytes from `start` on.
+    """
+    sig = types.intp(buffer, types.intp, types.float64, types.intc)
+
+    def codegen(
+        context: BaseContext,
+        builder: IRBuilder,
+        signature: Signature,
+        args: Tuple[Value, ...],
+    ) -> Value:
+        buffer, start, value, precision = args
+        data = context.make_array(signature.args[0])(context, builder, buffer).data
+        pointer = builder.gep(data, [start])
+
+        # snprintf is variadic, which ExternalFunction can't express
+        intc_type = context.get_value_type(types.intc)
+        snprintf = cgutils.get_or_insert_function(
+            builder.module,
+            ir.FunctionType(
+                intc_type,
+                [cgutils.voidptr_t, context.get_value_type(types.uintp)],
+                var_arg=True,
+            ),
+            "snprintf",
+        )
+        fmt = context.insert_const_string(builder.module, "%.*g")
+        length = builder.call(
+            snprintf,
+            [
+                builder.bitcast(pointer, cgutils.voidptr_t),
+                context.get_constant(types.uintp, _DOUBLE_BUFFER_SIZE),
+                fmt,
+                precision,
+                value,
+            ],
+        )
+        return builder.sext(length, context.get_value_type(types.intp))
+
+    return sig, codegen
+
+
+@extending.intrinsic  # type: ignore[misc, untyped-decorator]
+def parse_double(
+    typingctx: Context, buffer: types.Array, start: types.Integer
+) -> Tuple[
+    Signature,
+    Callable[[BaseContext, IRBuilder, Signature, Tuple[Value, Value]], Value],
+]:
+    """Parse the null-terminated number at position `start` of `buffer`."""
+    sig = types.float64(buffer, types.intp)
+
+    def codegen(
+        context: BaseContext,
+        builder: IRBuilder,
+        signature: Signature,
+        args: Tuple[Value, Value],
+    ) -> Value:
+        buffer, start = args
+        data = context.make_array(signature.args[0])(context, builder, buffer).data
+        pointer = builder.bitcast(builder.gep(data, [start]), cgutils.voidptr_t)
+        strtod = cgutils.get_or_insert_function(
+            builder.module,
+            ir.FunctionType(
+                context.get_value_type(types.float64),
+                [cgutils.voidptr_t, cgutils.voidptr_t],
+            ),
+            "strtod",
+        )
+        return builder.call(strtod, [pointer, cgutils.voidptr_t(None)])
+
+    return sig, codegen
+
+
+@njit(nogil=True)  # type: ignore[misc, untyped-decorator]
+def reserve(buffer: np.ndarray, n: int, extra: int) -> np.ndarray:
+    """Return `buffer`, or a larger copy of its first `n` bytes, with room for
+    `extra` more bytes after them."""
+    if n + extra <= len(buffer):
+        return buffer
+    grown = np.empty(max(2 * len(buffer), n + extra), dtype=np.uint8)
+    grown[:n] = buffer[:n]
+    return grown
+
+
+@njit(nogil=True)  # type: ignore[misc, untyped-decorator]
+def write_bytes(buffer: np.ndarray, n: int, data: np.ndarray) -> Tuple[np.ndarray, int]:
+    """Append `data` to the first `n` bytes of `buffer`."""
+    buffer = reserve(buffer, n, len(data))
+    buffer[n : n + len(data)] = data
+    return buffer, n + len(data)
+
+
+@njit(nogil=True)  # type: ignore[misc, untyped-decorator]
+def write_byte(buffer: np.ndarray, n: int, byte: int) -> Tuple[np.ndarray, int]:
+    """Append a single byte to the first `n` bytes of `buffer`."""
+    buffer = reserve(buffer, n, 1)
+    buffer[n] = byte
+    return buffer, n + 1
+
+
+@njit(nogil=True)  # type: ignore[misc, untyped-decorator]
+def write_null(buffer: np.ndarray, n: int) -> Tuple[np.ndarray, int]:
+    """Append JSON's null."""
+    return write_bytes(buffer, n, _NULL)
+
+
+@njit(nogil=True)  # type: ignore[misc, untyped-decorator]
+def write_boolean(buffer: np.ndarray, n: int, value: bool) -> Tuple[np.ndarray, int]:
+    """Append a boolean as JSON's true or false."""
+    return write_bytes(buffer, n, _TRUE if value else _FALSE)
+
+
+@njit(nogil=True)  # type: ignore[misc, untyped-decorator]
+def write_unsigned(
+    buffer: np.ndarray, n: int, value: np.uint64
+) -> Tuple[np.ndarray, int]:
+    """Append the decimal digits of `value`."""
+    # mixing unsigned and signed integers would wrap values above the largest
+    # int64 around to negative ones
+    ten = np.uint64(10)
+    num_digits = 1
+    rest = value // ten
+    while rest:
+        num_digits += 1
+        rest //= ten
+
+    buffer = reserve(buffer, n, num_digits)
+    for i in range(n + num_digits - 1, n - 1, -1):
+        buffer[i] = 0x30 + np.uint8(value % ten)
+        value //= ten
+    return buffer, n + num_digits
+
+
+@njit(nogil=True)  # type: ignore[misc, untyped-decorator]
+def write_integer(buffer: np.ndarray, n: int, value: int) -> Tuple[np.ndarray, int]:
+    """Append a signed 64-bit integer as a JSON number."""
+    if value < 0:
+        buffer, n = write_byte(buffer, n, 0x2D)
+        # the magnitude of the smallest integer doesn't fit in an int64
+        return write_unsigned(buffer, n, np.uint64(-(value + 1)) + np.uint64(1))
+    return write_unsigned(buffer, n, np.uint64(value))
+
+
+@njit(nogil=True)  # type: ignore[misc, untyped-decorator]
+def write_float(buffer: np.ndarray, n: int, value: float) -> Tuple[np.ndarray, int]:
+    """Append a double as the shortest JSON number of at most 17 significant
+    digits that reads back as the same double."""
+    if math.isnan(value):
+        return write_null(buffer, n)
+    if math.isinf(value):
+        return write_bytes(buffer, n, _INFINITY if value > 0 else _NEGATIVE_INFINITY)
+
+    buffer = reserve(buffer, n, _DOUBLE_BUFFER_SIZE)
+    length = format_double(buffer, n, value, 15)
+    if parse_double(buffer, n) != value:
+        length = format_double(buffer, n, value, 17)
+
+    # keep a fraction, so that the number reads back as a REAL
+    for i in range(n, n + length):
+        if buffer[i] == 0x2E or buffer[i] == 0x65:
+            return buffer, n + length
+    buffer[n + length] = 0x2E
+    buffer[n + length + 1] = 0x30
+    return buffer, n + length + 2
+
+
+@njit(nogil=True)  # type: ignore[misc, untyped-decorator]
+def write_string(buffer: np.ndarray, n: int, value: str) -> Tuple[np.ndarray, int]:
+    """Append a string as a JSON string, encoded as UTF-8."""
+    # every character takes at most 6 bytes, escaped or encoded
+    buffer = reserve(buffer, n, 6 * len(value) + 2)
+    buffer[n] = 0x22
+    n += 1
+    for i in range(len(value)):
+        code_point = int(_get_code_point(value, i))
+        if code_point == 0x22 or code_point == 0x5C:
+            buffer[n] = 0x5C
+            buffer[n + 1] = code_point
+            n += 2
+        elif code_point < 0x20 and _SHORT_ESCAPES[code_point]:
+            buffer[n] = 0x5C
+            buffer[n + 1] = _SHORT_ESCAPES[code_point]
+            n += 2
+        elif code_point < 0x20:
+            # \u00XX
+            low = code_point & 0xF
+            buffer[n] = 0x5C
+            buffer[n + 1] = 0x75
+            buffer[n + 2] = 0x30
+            buffer[n + 3] = 0x30
+            buffer[n + 4] = 0x30 + (code_point >> 4)
+            buffer[n + 5] = low + (0x30 if low < 10 else 0x57)
+            n += 6
+        elif code_point < 0x80:
+            buffer[n] = code_point
+            n += 1
+        elif code_point < 0x800:
+            buffer[n] = 0xC0 | (code_point >> 6)
+            buffer[n + 1] = 0x80 | (code_point & 0x3F)
+            n += 2
+        elif code_point < 0x10000:
+            # surrogates can't be encoded as UTF-8
+            if 0xD800 <= code_point < 0xE000:
+                code_point = 0xFFFD
+            buffer[n] = 0xE0 | (code_point >> 12)
+            buffer[n + 1] = 0x80 | ((code_point >> 6) & 0x3F)
+            buffer[n + 2] = 0x80 | (code_point & 0x3F)
+            n += 3
+        else:
+            buffer[n] = 0xF0 | (code_point >> 18)
+            buffer[n + 1] = 0x80 | ((code_point >> 12) & 0x3F)
+            buffer[n + 2] = 0x80 | ((code_point >> 6) & 0x3F)
+            buffer[n + 3] = 0x80 | (code_point & 0x3F)
+            n += 4
+    buffer[n] = 0x22
+    return buffer, n + 1
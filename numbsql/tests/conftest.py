@@ -117,6 +117,8 @@ def large_con(
         "INSERT INTO large_t (key, dense_key, string_key, value) VALUES (?, ?, ?, ?)",
         rows,
     )
+    # let other connections read the table
+    con.commit()
     yield con
     con.execute("DROP TABLE large_t")
     con.close()
@@ -1,14 +1,20 @@
 from __future__ import annotations
 
 import sqlite3
-from typing import List, Optional, Tuple
+from typing import Annotated, List, Optional, Tuple
 
+import numba
+import numpy as np
 import pytest
+from numba import float32, types
+from numba.core.runtime import _nrt_python as nrt
+from numba.core.runtime import rtsys
 from numba.experimental import jitclass
+from numpy.typing import NDArray
 from packaging.version import parse as parse_version
 from pytest_benchmark.fixture import BenchmarkFixture
 
-from numbsql import create_aggregate, sqlite_udaf
+from numbsql import create_aggregate, sqlite_udaf, warmup
 from numbsql.exceptions import UnsupportedAggregateTypeError
 from numbsql.sqlite import SQLITE_VERSION
 
@@ -200,32 +206,100 @@ def con(con: sqlite3.Connection) -> sqlite3.Connection:
     return con
 
 
-def test_aggregates_with_string_fields_fail() -> None:
+def test_aggregates_with_unsupported_fields_fail() -> None:
     with pytest.raises(
         UnsupportedAggregateTypeError,
-        match=r"Aggregates with field type `unicode_type` are not yet implemented",
+        match=r"Aggregates with field type `complex128` are not yet implemented",
     ):
 
         @sqlite_udaf
         @jitclass
-        class StringJoin:
-            joined: str
-            count: int
+        class ComplexSum:
+            total: complex
 
             def __init__(self) -> None:
-                self.joined = ""
-                self.count = 0
+                self.total = 0j
+
+            def step(self, value: float) -> None:
+                self.total += value
+
+            def finalize(self) -> float:
+                return self.total.real
+
+
+def test_aggregates_with_string_fields() -> None:
+    @sqlite_udaf
+    @jitclass
+    class StringJoin:  # pragma: no cover
+        joined: str
+        count: int
+
+        def __init__(self) -> None:
+            self.joined = ""
+            self.count = 0
+
+        def step(self, value: Optional[str], sep: Optional[str]) -> None:
+            if value is not None and sep is not None:
+                if not self.count:
+                    self.joined = value
+                else:
+                    self.joined += sep + value
+                self.count += 1
+
+        def finalize(self) -> Optional[str]:
+            return self.joined if self.count else None
+
+    con = sqlite3.connect(":memory:")
+    create_aggregate(con, "string_join", 2, StringJoin)
+    con.execute("CREATE TABLE t (g INTEGER, x TEXT)")
+    con.executemany(
+        "INSERT INTO t VALUES (?, ?)",
+        [(1, "a"), (1, "é"), (1, None), (2, "日本"), (3, None)],
+    )
+
+    nrt.memsys_enable_stats()
+    try:
+        before = rtsys.get_allocation_stats()
+        result = con.execute(
+            "SELECT g, string_join(x, '-') FROM t GROUP BY g ORDER BY g"
+        ).fetchall()
+        after = rtsys.get_allocation_stats()
+    finally:
+        nrt.memsys_disable_stats()
+        con.close()
+
+    assert result == [(1, "a-é"), (2, "日本"), (3, None)]
+    # the strings in the state of each group are released
+    assert after.alloc - before.alloc == after.free - before.free
+
+
+def test_lazy_aggregate_warmup() -> None:
+    @sqlite_udaf(lazy=True)
+    @jitclass
+    class LazyCount:  # pragma: no cover
+        count: int
+
+        def __init__(self) -> None:
+            self.count = 0
+
+        def step(self, value: Optional[int]) -> None:
+            if value is not None:
+                self.count += 1
+
+        def finalize(self) -> int:
+            return self.count
 
-            def step(self, value: Optional[str], sep: Optional[str]) -> None:
-                if value is not None and sep is not None:
-                    if not self.count:
-                        self.joined = value
-                    else:
-                        self.joined += sep + value
-                    self.count += 1
+    assert not hasattr(LazyCount.step, "address")
 
-            def finalize(self) -> Optional[str]:
-                return self.joined if self.count else None
+    warmup(LazyCount)
+    assert hasattr(LazyCount.step, "address")
+
+    con = sqlite3.connect(":memory:")
+    create_aggregate(con, "lazy_count", 1, LazyCount)
+    assert con.execute(
+        "SELECT lazy_count(x) FROM (SELECT 1 AS x UNION ALL SELECT NULL)"
+    ).fetchall() == [(1,)]
+    con.close()
 
 
 def test_constructor(con: sqlite3.Connection) -> None:
@@ -362,3 +436,481 @@ def test_window_bench(
     large_con: sqlite3.Connection, benchmark: BenchmarkFixture, func: str
 ) -> None:
     assert benchmark(run_agg_partition_by, large_con, func)
+
+
+def test_blob_arguments() -> None:
+    @sqlite_udaf
+    @jitclass
+    class TotalOfBlobs:  # pragma: no cover
+        total: float
+
+        def __init__(self) -> None:
+            self.total = 0.0
+
+        def step(self, value: Optional[NDArray[np.float64]]) -> None:
+            if value is not None:
+                self.total += value.sum()
+
+        def finalize(self) -> float:
+            return self.total
+
+    con = sqlite3.connect(":memory:")
+    create_aggregate(con, "total_of_blobs", 1, TotalOfBlobs)
+    con.execute("CREATE TABLE t (x BLOB)")
+    con.executemany(
+        "INSERT INTO t VALUES (?)",
+        [(np.arange(3, dtype=np.float64).tobytes(),), (None,), (np.ones(2).tobytes(),)],
+    )
+    assert con.execute("SELECT total_of_blobs(x) FROM t").fetchall() == [(5.0,)]
+    con.close()
+
+
+def test_blob_results() -> None:
+    @sqlite_udaf
+    @jitclass
+    class Counts:  # pragma: no cover
+        count: int
+
+        def __init__(self) -> None:
+            self.count = 0
+
+        def step(self, value: Optional[int]) -> None:
+            if value is not None:
+                self.count += 1
+
+        def finalize(self) -> NDArray[np.int64]:
+            return np.full(3, self.count, dtype=np.int64)
+
+    con = sqlite3.connect(":memory:")
+    create_aggregate(con, "counts", 1, Counts)
+    ((result,),) = con.execute(
+        "SELECT counts(x) FROM (SELECT 1 AS x UNION ALL SELECT NULL UNION ALL SELECT 2)"
+    ).fetchall()
+    np.testing.assert_array_equal(np.frombuffer(result, dtype=np.int64), [2, 2, 2])
+    con.close()
+
+
+def test_text_arguments() -> None:
+    @sqlite_udaf
+    @jitclass
+    class TotalLength:  # pragma: no cover
+        total: int
+
+        def __init__(self) -> None:
+            self.total = 0
+
+        def step(self, value: Optional[str]) -> None:
+            if value is not None:
+                self.total += len(value)
+
+        def finalize(self) -> int:
+            return self.total
+
+    con = sqlite3.connect(":memory:")
+    create_aggregate(con, "total_length", 1, TotalLength)
+    con.execute("CREATE TABLE t (x TEXT)")
+    con.executemany(
+        "INSERT INTO t VALUES (?)", [("héllo",), (None,), ("日本",), ("ab",)]
+    )
+    assert con.execute("SELECT total_length(x) FROM t").fetchall() == [(9,)]
+    con.close()
+
+
+def test_narrow_types() -> None:
+    @sqlite_udaf
+    @jitclass
+    class Float32Sum:  # pragma: no cover
+        total: float32
+        seen: bool
+
+        def __init__(self) -> None:
+            self.total = np.float32(0)
+            self.seen = False
+
+        def step(self, value: np.float32) -> None:
+            self.total += value
+            self.seen = True
+
+        def finalize(self) -> Optional[np.float32]:
+            return self.total if self.seen else None
+
+    con = sqlite3.connect(":memory:")
+    create_aggregate(con, "float32_sum", 1, Float32Sum)
+    assert con.execute(
+        "SELECT float32_sum(x) FROM (SELECT 0.5 AS x UNION ALL SELECT 0.25)"
+    ).fetchall() == [(0.75,)]
+    assert con.execute("SELECT float32_sum(1.0) WHERE 0").fetchall() == [(None,)]
+    con.close()
+
+
+def test_datetimes() -> None:
+    @sqlite_udaf
+    @jitclass
+    class Latest:  # pragma: no cover
+        latest: types.NPDatetime("s")  # type: ignore[valid-type]
+        seen: bool
+
+        def __init__(self) -> None:
+            self.seen = False
+
+        def step(self, value: Annotated[np.datetime64, "s"]) -> None:
+            if not self.seen or value > self.latest:
+                self.latest = value
+                self.seen = True
+
+        def finalize(self) -> Optional[Annotated[np.datetime64, "s", "integer"]]:
+            return self.latest if self.seen else None
+
+    con = sqlite3.connect(":memory:")
+    create_aggregate(con, "latest", 1, Latest)
+    con.execute("CREATE TABLE t (x TEXT)")
+    con.executemany(
+        "INSERT INTO t VALUES (?)",
+        [("2024-01-01",), ("2025-06-01T10:00:00Z",), ("2023-01-01 12:00",)],
+    )
+    assert con.execute(
+        "SELECT latest(x) = unixepoch('2025-06-01 10:00') FROM t"
+    ).fetchall() == [(1,)]
+    assert con.execute("SELECT latest(x) FROM t WHERE 0").fetchall() == [(None,)]
+    con.close()
+
+
+def test_fixed_size_array_fields() -> None:
+    @sqlite_udaf
+    @jitclass
+    class Spread:  # pragma: no cover
+        counts: types.NestedArray(types.int64, (4,))  # type: ignore[valid-type]
+        extremes: types.NestedArray(types.float64, (2, 2))  # type: ignore[valid-type]
+        count: int
+
+        def __init__(self) -> None:
+            self.counts[:] = 0
+            self.extremes[0, :] = np.inf
+            self.extremes[1, :] = -np.inf
+            self.count = 0
+
+        def step(self, value: int) -> None:
+            self.counts[value % 4] += 1
+            parity = value % 2
+            self.extremes[0, parity] = min(self.extremes[0, parity], value)
+            self.extremes[1, parity] = max(self.extremes[1, parity], value)
+            self.count += 1
+
+        def finalize(self) -> float:
+            return (
+                self.counts.argmax()
+                + self.extremes[1].sum()
+                - self.extremes[0].sum()
+                + self.count / 100
+            )
+
+    con = sqlite3.connect(":memory:")
+    create_aggregate(con, "spread", 1, Spread)
+    con.execute("CREATE TABLE t (g INTEGER, x INTEGER)")
+    con.executemany(
+        "INSERT INTO t VALUES (?, ?)", [(g, x) for g in range(3) for x in range(g + 5)]
+    )
+    query = "SELECT g, spread(x) FROM t GROUP BY g ORDER BY g"
+
+    nrt.memsys_enable_stats()
+    try:
+        before = rtsys.get_allocation_stats()
+        result = con.execute(query).fetchall()
+        after = rtsys.get_allocation_stats()
+    finally:
+        nrt.memsys_disable_stats()
+        con.close()
+
+    assert result == [(0, 6.05), (1, 8.06), (2, 10.07)]
+    # the state of each group is allocated by SQLite
+    assert after.alloc == before.alloc
+
+
+@sqlite_udaf
+@jitclass
+class WinMedian:  # pragma: no cover
+    values: types.ListType(types.float64)  # type: ignore[valid-type]
+
+    def __init__(self) -> None:
+        self.values = numba.typed.List.empty_list(types.float64)
+
+    def step(self, value: Optional[float]) -> None:
+        if value is not None:
+            self.values.append(value)
+
+    def finalize(self) -> Optional[float]:
+        return np.median(np.asarray(self.values)) if len(self.values) else None
+
+    def value(self) -> Optional[float]:
+        return self.finalize()
+
+    def inverse(self, value: Optional[float]) -> None:
+        if value is not None:
+            self.values.remove(value)
+
+
+def test_aggregates_with_list_fields() -> None:
+    con = sqlite3.connect(":memory:")
+    create_aggregate(con, "win_median", 1, WinMedian)
+    con.execute("CREATE TABLE t (g INTEGER, x REAL)")
+    con.executemany(
+        "INSERT INTO t VALUES (?, ?)",
+        [(1, 3.0), (1, 1.0), (1, 2.0), (2, 5.0), (2, None)],
+    )
+
+    nrt.memsys_enable_stats()
+    try:
+        before = rtsys.get_allocation_stats()
+        aggregated = con.execute(
+            "SELECT g, win_median(x) FROM t GROUP BY g ORDER BY g"
+        ).fetchall()
+        windowed = con.execute(
+            """
+            SELECT win_median(x) OVER (
+                PARTITION BY g ORDER BY x ROWS BETWEEN 1 PRECEDING AND CURRENT ROW
+            )
+            FROM t
+            """
+        ).fetchall()
+        after = rtsys.get_allocation_stats()
+    finally:
+        nrt.memsys_disable_stats()
+        con.close()
+
+    assert aggregated == [(1, 2.0), (2, 5.0)]
+    assert windowed == [(1.0,), (1.5,), (2.5,), (None,), (5.0,)]
+    assert after.alloc - before.alloc == after.free - before.free
+
+
+def test_max_memory() -> None:
+    @sqlite_udaf(max_memory=100)
+    @jitclass
+    class Distinct:  # pragma: no cover
+        seen: types.DictType(types.int64, types.boolean)  # type: ignore[valid-type]
+
+        def __init__(self) -> None:
+            self.seen = numba.typed.Dict.empty(types.int64, types.boolean)
+
+        def step(self, value: int) -> None:
+            self.seen[value] = True
+
+        def finalize(self) -> int:
+            return len(self.seen)
+
+    con = sqlite3.connect(":memory:")
+    create_aggregate(con, "count_distinct", 1, Distinct)
+    con.execute("CREATE TABLE t (x INTEGER)")
+    con.executemany("INSERT INTO t VALUES (?)", [(x % 5,) for x in range(100)])
+    assert con.execute("SELECT count_distinct(x) FROM t").fetchall() == [(5,)]
+
+    con.executemany("INSERT INTO t VALUES (?)", [(x,) for x in range(100)])
+    with pytest.raises(
+        sqlite3.OperationalError,
+        match="the state of aggregate `Distinct` takes more than 100 bytes",
+    ):
+        con.execute("SELECT count_distinct(x) FROM t").fetchall()
+    con.close()
+
+
+def test_null_policy() -> None:
+    @jitclass
+    class Product:  # pragma: no cover
+        total: int
+
+        def __init__(self) -> None:
+            self.total = 1
+
+        def step(self, value: int) -> None:
+            self.total *= value
+
+        def finalize(self) -> int:
+            return self.total
+
+    con = sqlite3.connect(":memory:")
+    create_aggregate(con, "product", 1, sqlite_udaf(Product))
+    create_aggregate(
+        con, "product_of_values", 1, sqlite_udaf(null_policy="skip_row")(Product)
+    )
+    con.execute("CREATE TABLE t (x INTEGER)")
+    con.executemany("INSERT INTO t VALUES (?)", [(2,), (None,), (3,)])
+    assert con.execute("SELECT product_of_values(x) FROM t").fetchall() == [(6,)]
+    with pytest.raises(sqlite3.OperationalError, match="unexpected NULL"):
+        con.execute("SELECT product(x) FROM t").fetchall()
+    con.close()
+
+
+def test_exceptions_fail_the_query() -> None:
+    @sqlite_udaf
+    @jitclass
+    class Mean:  # pragma: no cover
+        total: float
+        count: int
+
+        def __init__(self) -> None:
+            self.total = 0.0
+            self.count = 0
+
+        def step(self, value: float) -> None:
+            if value < 0:
+                raise ValueError("negative")
+            self.total += value
+            self.count += 1
+
+        def finalize(self) -> float:
+            if self.count < 2:
+                raise ZeroDivisionError("too few values")
+            return self.total / self.count
+
+    con = sqlite3.connect(":memory:")
+    create_aggregate(con, "mean", 1, Mean)
+    con.execute("CREATE TABLE t (x REAL)")
+    con.executemany("INSERT INTO t VALUES (?)", [(1.0,), (2.0,)])
+    assert con.execute("SELECT mean(x) FROM t").fetchall() == [(1.5,)]
+    with pytest.raises(sqlite3.OperationalError, match="'finalize' raised"):
+        con.execute("SELECT mean(x) FROM t WHERE x > 1").fetchall()
+
+    con.execute("INSERT INTO t VALUES (-1.0)")
+    with pytest.raises(sqlite3.OperationalError, match="'step' raised"):
+        con.execute("SELECT mean(x) FROM t").fetchall()
+    con.close()
+
+
+def test_null_policy_must_exist() -> None:
+    with pytest.raises(ValueError, match="isn't a NULL policy"):
+        sqlite_udaf(null_policy="return_null")(Avg)
+
+
+@sqlite_udaf
+@jitclass
+class MergeableAvg:  # pragma: no cover
+    total: float
+    count: int
+
+    def __init__(self) -> None:
+        self.total = 0.0
+        self.count = 0
+
+    def step(self, value: float) -> None:
+        self.total += value
+        self.count += 1
+
+    def merge(self, other: MergeableAvg) -> None:
+        self.total += other.total
+        self.count += other.count
+
+    def finalize(self) -> Optional[float]:
+        if not self.count:
+            return None
+        return self.total / self.count
+
+
+def test_merge() -> None:
+    left = MergeableAvg()
+    left.step(1.0)
+    right = MergeableAvg()
+    right.step(2.0)
+    right.step(6.0)
+    left.merge(right)
+    assert left.finalize() == 3.0
+
+    # merge doesn't change how the aggregate runs in SQLite
+    con = sqlite3.connect(":memory:")
+    create_aggregate(con, "mavg", 1, MergeableAvg)
+    assert con.execute(
+        "SELECT mavg(x) FROM (SELECT 1.0 AS x UNION ALL SELECT 2.0)"
+    ).fetchall() == [(1.5,)]
+    con.close()
+
+
+def test_merge_must_take_one_argument() -> None:
+    @jitclass
+    class Bad:  # pragma: no cover
+        total: float
+
+        def __init__(self) -> None:
+            self.total = 0.0
+
+        def step(self, value: float) -> None:
+            self.total += value
+
+        def merge(self, other: Bad, another: Bad) -> None:
+            self.total += other.total + another.total
+
+        def finalize(self) -> float:
+            return self.total
+
+    with pytest.raises(TypeError, match="exactly one argument"):
+        sqlite_udaf(Bad)
+
+
+def test_merge_must_not_return() -> None:
+    @jitclass
+    class Bad:  # pragma: no cover
+        total: float
+
+        def __init__(self) -> None:
+            self.total = 0.0
+
+        def step(self, value: float) -> None:
+            self.total += value
+
+        def merge(self, other: Bad) -> float:
+            self.total += other.total
+            return self.total
+
+        def finalize(self) -> float:
+            return self.total
+
+    with pytest.raises(TypeError, match="returns `float64`, expected `none`"):
+        sqlite_udaf(Bad)
+
+
+@sqlite_udaf
+@jitclass
+class WinProduct:  # pragma: no cover
+    product: int
+
+    def __init__(self) -> None:
+        # the state isn't all zeros, so skipping the constructor shows
+        self.product = 1
+
+    def step(self, value: int) -> None:
+        self.product *= value
+
+    def finalize(self) -> int:
+        return self.product
+
+    def value(self) -> int:
+        return self.product
+
+    def inverse(self, value: int) -> None:
+        self.product //= value
+
+
+def test_live_contexts_are_initialized_separately() -> None:
+    con = sqlite3.connect(":memory:")
+    create_aggregate(con, "product", 1, WinProduct)
+    con.execute("CREATE TABLE t (key TEXT, x INTEGER)")
+    con.executemany(
+        "INSERT INTO t VALUES (?, ?)",
+        [("a", 2), ("a", 3), ("b", 5), ("b", 7)],
+    )
+
+    # the subquery's contexts start and finish while the outer one is live
+    assert con.execute(
+        """
+        SELECT key, product(x * (SELECT product(x) FROM t AS u WHERE u.key = t.key))
+        FROM t
+        GROUP BY key
+        ORDER BY key
+        """
+    ).fetchall() == [("a", 2 * 6 * 3 * 6), ("b", 5 * 35 * 7 * 35)]
+
+    # interleaving two cursors interleaves their window contexts
+    query = "SELECT product(x) OVER (ORDER BY rowid) FROM t"
+    first = con.execute(query)
+    second = con.execute(query)
+    rows = [(first.fetchone(), second.fetchone()) for _ in range(4)]
+    expected = [(2,), (6,), (30,), (210,)]
+    assert rows == list(zip(expected, expected))
+    con.close()
@@ -0,0 +1,164 @@
+from __future__ import annotations
+
+import asyncio
+import time
+
+import numpy as np
+import pytest
+from numba.experimental import jitclass
+
+from numbsql import AsyncConnection, check_interrupt, sqlite_udaf, sqlite_udf
+
+# runs until it's interrupted
+FOREVER = """
+WITH RECURSIVE counter(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM counter)
+SELECT count(*) FROM counter
+"""
+
+
+@sqlite_udf
+def busy(seconds: float) -> float:
+    # keeps the connection's thread busy without the GIL
+    total = 0.0
+    for i in range(int(seconds * 200_000_000)):
+        total += i % 7
+    return total
+
+
+@sqlite_udf
+def spin(n: int) -> int:
+    i = 0
+    while i < n:
+        check_interrupt()
+        i += 1
+    return i
+
+
+@sqlite_udaf
+@jitclass
+class Count:
+    count: int
+
+    def __init__(self) -> None:
+        self.count = 0
+
+    def step(self, value: int) -> None:
+        self.count += 1
+
+    def finalize(self) -> int:
+        return self.count
+
+
+def test_queries() -> None:
+    async def main() -> None:
+        async with await AsyncConnection.connect(
+            ":memory:", functions={"how_many": Count}
+        ) as con:
+            await con.execute("CREATE TABLE t (x INTEGER, y TEXT)")
+            await con.executemany(
+                "INSERT INTO t VALUES (?, ?)", [(1, "a"), (2, None), (3, "c")]
+            )
+            await con.commit()
+            assert await con.fetchall("SELECT how_many(x) FROM t") == [(3,)]
+
+            await con.register([busy])
+            assert await con.fetchall("SELECT busy(?)", (0.0,)) == [(0.0,)]
+
+            columns = await con.fetch_numpy("SELECT x, y FROM t WHERE x > ?", (0,))
+            assert list(columns) == ["x", "y"]
+            np.testing.assert_array_equal(columns["x"], np.array([1, 2, 3]))
+            assert columns["y"].dtype == np.dtype(object)
+            assert columns["y"].tolist() == ["a", None, "c"]
+
+            empty = await con.fetch_numpy("SELECT x FROM t WHERE x < 0")
+            assert len(empty["x"]) == 0
+
+            texts = await con.fetch_numpy("SELECT 'a' UNION ALL SELECT 'b'")
+            assert texts["'a'"].dtype == np.dtype(object)
+            assert texts["'a'"].tolist() == ["a", "b"]
+
+    asyncio.run(main())
+
+
+def test_fetch_blobs_ending_in_nul() -> None:
+    async def main() -> None:
+        async with await AsyncConnection.connect(":memory:") as con:
+            columns = await con.fetch_numpy(
+                "SELECT ? AS b UNION ALL SELECT ?", (b"ab\x00", b"\x00")
+            )
+            assert columns["b"].dtype == np.dtype(object)
+            assert columns["b"].tolist() == [b"ab\x00", b"\x00"]
+
+    asyncio.run(main())
+
+
+def test_event_loop_is_not_blocked() -> None:
+    async def tick(ticks: list[float], stop: asyncio.Event) -> None:
+        while not stop.is_set():
+            ticks.append(time.monotonic())
+            await asyncio.sleep(0.01)
+
+    async def main() -> None:
+        async with await AsyncConnection.connect(":memory:", functions=[busy]) as con:
+            await con.fetchall("SELECT busy(0.0)")
+            ticks: list[float] = []
+            stop = asyncio.Event()
+            ticker = asyncio.create_task(tick(ticks, stop))
+            start = time.monotonic()
+            await con.fetchall("SELECT busy(1.0)")
+            elapsed = time.monotonic() - start
+            stop.set()
+            await ticker
+
+        # the ticker kept running while the query ran
+        assert elapsed > 0.1
+        assert len(ticks) > elapsed / 0.01 / 4
+        assert max(np.diff(ticks)) < elapsed / 2
+
+    asyncio.run(main())
+
+
+def test_cancelling_interrupts_the_query() -> None:
+    async def main() -> None:
+        async with await AsyncConnection.connect(":memory:") as con:
+            task = asyncio.create_task(con.fetchall(FOREVER))
+            await asyncio.sleep(0.1)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+            assert await con.fetchall("SELECT 1") == [(1,)]
+
+    asyncio.run(main())
+
+
+def test_cancelling_interrupts_the_function() -> None:
+    async def main() -> None:
+        async with await AsyncConnection.connect(":memory:", functions=[spin]) as con:
+            task = asyncio.create_task(con.fetchall("SELECT spin(9223372036854775807)"))
+            await asyncio.sleep(0.1)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+            assert await con.fetchall("SELECT spin(10)") == [(10,)]
+
+    asyncio.run(main())
+
+
+def test_cancelling_a_queued_call() -> None:
+    async def main() -> None:
+        async with await AsyncConnection.connect(":memory:", functions=[busy]) as con:
+            await con.execute("CREATE TABLE t (x INTEGER)")
+            running = asyncio.create_task(con.fetchall("SELECT busy(2)"))
+            await asyncio.sleep(0.1)
+            queued = asyncio.create_task(con.execute("INSERT INTO t VALUES (1)"))
+            await asyncio.sleep(0.1)
+            queued.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await queued
+
+            # the running query isn't interrupted, and the insert never runs
+            ((total,),) = await running
+            assert total > 0
+            assert await con.fetchall("SELECT count(*) FROM t") == [(0,)]
+
+    asyncio.run(main())
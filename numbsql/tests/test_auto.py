@@ -0,0 +1,177 @@
+from __future__ import annotations
+
+import concurrent.futures
+import ctypes
+import sqlite3
+from pathlib import Path
+from typing import Generator, Optional
+
+import pytest
+from numba.experimental import jitclass
+
+from numbsql import auto_register, auto_unregister, sqlite_udaf, sqlite_udf
+
+
+@sqlite_udf
+def auto_double(value: Optional[int]) -> Optional[int]:
+    return value * 2 if value is not None else None
+
+
+@sqlite_udaf
+@jitclass
+class AutoSum:
+    total: int
+
+    def __init__(self) -> None:
+        self.total = 0
+
+    def step(self, value: int) -> None:
+        self.total += value
+
+    def finalize(self) -> int:
+        return self.total
+
+    def value(self) -> int:
+        return self.total
+
+    def inverse(self, value: int) -> None:
+        self.total -= value
+
+
+@pytest.fixture
+def registered() -> Generator[None, None, None]:
+    auto_register([auto_double, AutoSum], deterministic=True)
+    try:
+        yield
+    finally:
+        auto_unregister("auto_double", "AutoSum")
+
+
+@pytest.mark.usefixtures("registered")
+def test_new_connections() -> None:
+    con = sqlite3.connect(":memory:")
+    con.execute("CREATE TABLE t (x INTEGER)")
+    con.executemany("INSERT INTO t VALUES (?)", [(1,), (2,), (3,), (None,)])
+    assert con.execute("SELECT auto_double(x) FROM t").fetchall() == [
+        (2,),
+        (4,),
+        (6,),
+        (None,),
+    ]
+    assert con.execute("SELECT AutoSum(x) FROM t WHERE x IS NOT NULL").fetchall() == [
+        (6,)
+    ]
+    assert con.execute(
+        """
+        SELECT AutoSum(x) OVER (ORDER BY x ROWS BETWEEN 1 PRECEDING AND CURRENT ROW)
+        FROM t
+        WHERE x IS NOT NULL
+        """
+    ).fetchall() == [(1,), (3,), (5,)]
+
+
+@pytest.mark.usefixtures("registered")
+def test_connections_in_threads() -> None:
+    def query(value: int) -> int:
+        con = sqlite3.connect(":memory:")
+        try:
+            ((result,),) = con.execute("SELECT auto_double(?)", (value,)).fetchall()
+        finally:
+            con.close()
+        return result
+
+    with concurrent.futures.ThreadPoolExecutor(4) as executor:
+        assert list(executor.map(query, range(100))) == [
+            value * 2 for value in range(100)
+        ]
+
+
+@pytest.mark.usefixtures("registered")
+def test_indexes_and_generated_columns(tmp_path: Path) -> None:
+    path = tmp_path / "auto.db"
+    con = sqlite3.connect(path)
+    con.execute(
+        "CREATE TABLE t (x INTEGER, y INTEGER GENERATED ALWAYS AS (auto_double(x)))"
+    )
+    con.execute("CREATE INDEX t_double ON t (auto_double(x))")
+    con.executemany("INSERT INTO t (x) VALUES (?)", [(1,), (2,), (3,)])
+    con.commit()
+    con.close()
+
+    # the schema can only be used by connections that have the function
+    con = sqlite3.connect(path)
+    try:
+        assert con.execute("SELECT x, y FROM t ORDER BY x").fetchall() == [
+            (1, 2),
+            (2, 4),
+            (3, 6),
+        ]
+        ((plan,),) = [
+            row[-1:]
+            for row in con.execute(
+                "EXPLAIN QUERY PLAN SELECT x FROM t WHERE auto_double(x) = 4"
+            )
+        ]
+        assert "t_double" in plan
+        assert con.execute("SELECT x FROM t WHERE auto_double(x) = 4").fetchall() == [
+            (2,)
+        ]
+    finally:
+        con.close()
+
+
+def test_not_deterministic() -> None:
+    auto_register([auto_double])
+    try:
+        con = sqlite3.connect(":memory:")
+        con.execute("CREATE TABLE t (x INTEGER)")
+        with pytest.raises(sqlite3.OperationalError, match="non-deterministic"):
+            con.execute("CREATE INDEX t_double ON t (auto_double(x))")
+    finally:
+        auto_unregister("auto_double")
+
+
+def test_unregister() -> None:
+    auto_register({"auto_renamed": auto_double})
+    con = sqlite3.connect(":memory:")
+    auto_unregister("auto_renamed")
+    # connections keep the functions they were opened with
+    assert con.execute("SELECT auto_renamed(1)").fetchall() == [(2,)]
+
+    with pytest.raises(sqlite3.OperationalError, match="no such function"):
+        sqlite3.connect(":memory:").execute("SELECT auto_renamed(1)")
+
+
+def test_tables_keep_their_registrations() -> None:
+    from numbsql import auto
+
+    auto_register({"auto_replaced": auto_double, "auto_sum": AutoSum})
+    try:
+        for table, registrations in auto._tables:
+            (count, *rows) = table
+            names = {ctypes.addressof(name) for name, *_ in registrations}
+            callbacks = {
+                callback.address
+                for *_, callbacks in registrations
+                for callback in callbacks
+                if callback is not None
+            }
+            for i in range(count):
+                name, _, _, *addresses = rows[i * auto._ROW_SIZE :][: auto._ROW_SIZE]
+                assert name in names
+                assert set(addresses) - {0} <= callbacks
+    finally:
+        auto_unregister("auto_replaced", "auto_sum")
+
+
+def test_replaced_tables_are_freed() -> None:
+    from numbsql import auto
+
+    for _ in range(3):
+        auto_register({"auto_replaced": auto_double})
+    auto_unregister("auto_replaced")
+    # no connection was being opened, so only the current table is kept
+    assert len(auto._tables) == 1
+    ((table, registrations),) = auto._tables
+    assert auto._REGISTRY.value == ctypes.addressof(table)
+    assert table[0] == len(registrations)
@@ -0,0 +1,204 @@
+from __future__ import annotations
+
+import os
+import sqlite3
+import subprocess
+import sys
+import textwrap
+from pathlib import Path
+
+import pytest
+from numba.core import config
+from numba.experimental import jitclass
+
+from numbsql import (
+    compile_all,
+    create_aggregate,
+    create_function,
+    sqlite_udaf,
+    sqlite_udf,
+)
+
+SCRIPT = """
+import sqlite3
+from typing import Optional
+
+from numba.experimental import jitclass
+
+from numbsql import create_aggregate, create_function, sqlite_udaf, sqlite_udf
+
+
+@sqlite_udf(cache=True)
+def add_one(x: Optional[int]) -> Optional[int]:
+    return x + 1 if x is not None else None
+
+
+@sqlite_udaf(cache=True)
+@jitclass
+class WinAvg:
+    total: float
+    count: int
+
+    def __init__(self) -> None:
+        self.total = 0.0
+        self.count = 0
+
+    def step(self, value: Optional[float]) -> None:
+        if value is not None:
+            self.total += value
+            self.count += 1
+
+    def finalize(self) -> Optional[float]:
+        return self.total / self.count if self.count else None
+
+    def value(self) -> Optional[float]:
+        return self.finalize()
+
+    def inverse(self, value: Optional[float]) -> None:
+        if value is not None:
+            self.total -= value
+            self.count -= 1
+
+
+con = sqlite3.connect(":memory:")
+create_function(con, "add_one", 1, add_one)
+create_aggregate(con, "winavg", 1, WinAvg)
+con.execute("CREATE TABLE t (x INTEGER, y TEXT)")
+con.execute("INSERT INTO t VALUES (1, 'a'), (2, 'a'), (3, 'b')")
+assert con.execute("SELECT add_one(1), add_one(NULL)").fetchall() == [(2, None)]
+assert con.execute("SELECT winavg(x) OVER (PARTITION BY y) FROM t").fetchall() == [
+    (1.5,),
+    (1.5,),
+    (3.0,),
+]
+print(add_one.scalar._cache_hits)
+"""
+
+
+def test_cache_is_reused_across_processes(tmp_path: Path) -> None:
+    script = tmp_path / "udfs.py"
+    script.write_text(textwrap.dedent(SCRIPT))
+    cache_dir = tmp_path / "cache"
+    env = {
+        **os.environ,
+        "NUMBA_CACHE_DIR": str(cache_dir),
+        "PYTHONPATH": os.pathsep.join(sys.path),
+    }
+
+    def run() -> str:
+        return subprocess.check_output(
+            [sys.executable, str(script)], env=env, text=True
+        ).strip()
+
+    def cache_files() -> dict[Path, int]:
+        return {path: path.stat().st_mtime_ns for path in cache_dir.rglob("*")}
+
+    assert run() == "0"
+    cold = cache_files()
+    assert cold
+
+    # nothing is compiled, so nothing is written
+    assert run() == "1"
+    assert cache_files() == cold
+
+
+GLOBALS_SCRIPT = """
+import os
+import sqlite3
+
+from numba import njit
+
+from numbsql import create_function, sqlite_udf
+
+K = int(os.environ["K"])
+SCALE = int(os.environ["SCALE"])
+
+
+@njit
+def scale(x: int) -> int:
+    return x * SCALE
+
+
+@sqlite_udf(cache=True)
+def add_k(x: int) -> int:
+    return scale(x) + K
+
+
+con = sqlite3.connect(":memory:")
+create_function(con, "add_k", 1, add_k)
+print(con.execute("SELECT add_k(1)").fetchall()[0][0], add_k.scalar._cache_hits)
+"""
+
+
+def test_cache_is_keyed_by_globals(tmp_path: Path) -> None:
+    script = tmp_path / "globals_udfs.py"
+    script.write_text(textwrap.dedent(GLOBALS_SCRIPT))
+    env = {
+        **os.environ,
+        "NUMBA_CACHE_DIR": str(tmp_path / "cache"),
+        "PYTHONPATH": os.pathsep.join(sys.path),
+    }
+
+    def run(k: int, scale: int = 1) -> str:
+        return subprocess.check_output(
+            [sys.executable, str(script)],
+            env={**env, "K": str(k), "SCALE": str(scale)},
+            text=True,
+        ).strip()
+
+    assert run(1) == "2 0"
+    assert run(100) == "101 0"
+    assert run(1) == "2 1"
+    # jitted helpers are compiled into the trampoline, along with the globals
+    # they read
+    assert run(1, scale=10) == "11 0"
+
+    # so is everything in an edited source file
+    script.write_text(textwrap.dedent(GLOBALS_SCRIPT).replace("+ K", "- K"))
+    assert run(1) == "0 0"
+
+
+def test_compile_all(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(config, "CACHE_DIR", str(tmp_path))
+
+    @sqlite_udf(lazy=True)
+    def times_two(x: int) -> int:
+        return x * 2
+
+    @sqlite_udf(lazy=True)
+    def times_three(x: int) -> int:
+        return x * 3
+
+    @sqlite_udaf(lazy=True)
+    @jitclass
+    class Total:
+        total: int
+
+        def __init__(self) -> None:
+            self.total = 0
+
+        def step(self, value: int) -> None:
+            self.total += value
+
+        def finalize(self) -> int:
+            return self.total
+
+    assert compile_all([times_two, times_three, Total]) == [
+        times_two,
+        times_three,
+        Total,
+    ]
+
+    # compiled in the workers, loaded from the cache here
+    assert times_two.scalar._cache_hits
+    assert times_three.scalar._cache_hits
+    assert list(tmp_path.rglob("*.nbi"))
+
+    con = sqlite3.connect(":memory:")
+    create_function(con, "times_two", 1, times_two)
+    create_function(con, "times_three", 1, times_three)
+    create_aggregate(con, "total", 1, Total)
+    assert con.execute("SELECT times_two(2), times_three(2)").fetchall() == [(4, 6)]
+    assert con.execute(
+        "SELECT total(x) FROM (SELECT 1 AS x UNION ALL SELECT 2)"
+    ).fetchall() == [(3,)]
@@ -0,0 +1,197 @@
+from __future__ import annotations
+
+import concurrent.futures
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import textwrap
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import pytest
+from numba.experimental import jitclass
+
+from numbsql import check_interrupt, load_extension, sqlite_udaf, sqlite_udf
+from numbsql.extension import build_extension
+
+pytestmark = pytest.mark.skipif(
+    shutil.which(os.environ.get("CC", "cc")) is None
+    or shutil.which(os.environ.get("CXX", "c++")) is None,
+    reason="building extensions requires a C and a C++ compiler",
+)
+
+
+@sqlite_udf
+def add_one(x: Optional[int]) -> Optional[int]:
+    return x + 1 if x is not None else None
+
+
+@sqlite_udf
+def shout(x: Optional[str]) -> Optional[str]:
+    return x.upper() + "!" if x is not None else None
+
+
+@sqlite_udf
+def total(*values: int) -> int:
+    result = 0
+    for value in values:
+        result += value
+    return result
+
+
+@sqlite_udaf
+@jitclass
+class WinSum:
+    total: int
+
+    def __init__(self) -> None:
+        self.total = 0
+
+    def step(self, value: Optional[int]) -> None:
+        if value is not None:
+            self.total += value
+
+    def finalize(self) -> int:
+        return self.total
+
+    def value(self) -> int:
+        return self.total
+
+    def inverse(self, value: Optional[int]) -> None:
+        if value is not None:
+            self.total -= value
+
+
+def test_build_extension(tmp_path: Path) -> None:
+    path = build_extension(
+        tmp_path / "udfs.so",
+        {"add_one": add_one, "shout": shout, "total": total, "winsum": WinSum},
+    )
+
+    con = sqlite3.connect(":memory:")
+    load_extension(con, path)
+    assert con.execute(
+        "SELECT add_one(1), add_one(NULL), shout('a'), total(), total(1, 2, 3)"
+    ).fetchall() == [(2, None, "A!", 0, 6)]
+    assert con.execute(
+        """
+        SELECT winsum(x) OVER (ORDER BY x ROWS 1 PRECEDING), winsum(x) OVER ()
+        FROM (SELECT 1 AS x UNION ALL SELECT 2 UNION ALL SELECT 3)
+        """
+    ).fetchall() == [(1, 6), (3, 6), (5, 6)]
+
+
+def test_load_extension_on_several_threads(tmp_path: Path) -> None:
+    path = build_extension(tmp_path / "udfs.so", [shout, countdown])
+
+    def load(_: int) -> List[Tuple[str, int]]:
+        con = sqlite3.connect(":memory:")
+        try:
+            load_extension(con, path)
+            return con.execute("SELECT shout('a'), countdown(1000)").fetchall()
+        finally:
+            con.close()
+
+    with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        assert list(executor.map(load, range(32))) == [[("A!", 0)]] * 32
+
+
+def test_load_extension_error(tmp_path: Path) -> None:
+    con = sqlite3.connect(":memory:")
+    with pytest.raises(sqlite3.OperationalError):
+        load_extension(con, tmp_path / "missing.so")
+
+
+MODULE = """
+from numbsql import sqlite_udf
+
+
+@sqlite_udf(lazy=True)
+def times_two(x: int) -> int:
+    return x * 2
+"""
+
+
+def test_command_line(tmp_path: Path) -> None:
+    (tmp_path / "cli_udfs.py").write_text(textwrap.dedent(MODULE))
+    path = tmp_path / "extension.so"
+    subprocess.check_call(
+        [sys.executable, "-m", "numbsql.extension", "cli_udfs", "-o", str(path)],
+        env={
+            **os.environ,
+            "PYTHONPATH": os.pathsep.join([str(tmp_path), *sys.path]),
+        },
+    )
+
+    con = sqlite3.connect(":memory:")
+    load_extension(con, path)
+    assert con.execute("SELECT times_two(21)").fetchall() == [(42,)]
+
+
+RUNTIME = """
+import sqlite3
+import sys
+
+from numbsql import load_extension
+
+con = sqlite3.connect(":memory:")
+load_extension(con, sys.argv[1])
+assert con.execute("SELECT add_one(41)").fetchall() == [(42,)]
+assert "numba" not in sys.modules
+assert "llvmlite" not in sys.modules
+"""
+
+
+def test_runtime_does_not_import_numba(tmp_path: Path) -> None:
+    path = build_extension(tmp_path / "udfs.so", [add_one])
+    subprocess.check_call(
+        [sys.executable, "-c", RUNTIME, str(path)],
+        env={**os.environ, "PYTHONPATH": os.pathsep.join(sys.path)},
+    )
+
+
+@sqlite_udf
+def countdown(n: int) -> int:
+    while n > 0:
+        check_interrupt()
+        n -= 1
+    return n
+
+
+def test_check_interrupt(tmp_path: Path) -> None:
+    path = build_extension(tmp_path / "udfs.so", [countdown])
+
+    con = sqlite3.connect(":memory:")
+    load_extension(con, path)
+    assert con.execute("SELECT countdown(10)").fetchall() == [(0,)]
+
+
+@sqlite_udf
+def bounds(x: int) -> Tuple[int, int]:
+    return x - 1, x + 1
+
+
+def test_function_flags(tmp_path: Path) -> None:
+    path = build_extension(tmp_path / "udfs.so", [add_one, bounds], deterministic=True)
+
+    con = sqlite3.connect(":memory:")
+    load_extension(con, path)
+    con.execute(
+        "CREATE TABLE t (x INTEGER, y INTEGER GENERATED ALWAYS AS (add_one(x)))"
+    )
+    con.execute("INSERT INTO t (x) VALUES (1)")
+    assert con.execute("SELECT x, y FROM t").fetchall() == [(1, 2)]
+    # the results of functions returning JSON have the JSON subtype
+    assert con.execute("SELECT json_array(bounds(x)) FROM t").fetchall() == [
+        ("[[0,2]]",)
+    ]
+
+    path = build_extension(tmp_path / "nondeterministic.so", [add_one])
+    con = sqlite3.connect(":memory:")
+    load_extension(con, path)
+    with pytest.raises(sqlite3.OperationalError, match="non-deterministic"):
+        con.execute(
+            "CREATE TABLE t (x INTEGER, y INTEGER GENERATED ALWAYS AS (add_one(x)))"
+        )
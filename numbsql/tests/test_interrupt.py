@@ -0,0 +1,260 @@
+from __future__ import annotations
+
+import sqlite3
+import threading
+from typing import Generator, Optional
+
+import pytest
+from numba import njit
+from numba.experimental import jitclass
+
+from numbsql import (
+    check_interrupt,
+    create_aggregate,
+    create_function,
+    set_progress_handler,
+    sqlite_udaf,
+    sqlite_udf,
+)
+from numbsql.interrupt import InterruptState, interrupt_state
+
+# runs until it's interrupted
+FOREVER = """
+WITH RECURSIVE counter(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM counter)
+SELECT count(*) FROM counter
+"""
+
+# runs long enough for the progress handler to be called
+COUNT = """
+WITH RECURSIVE counter(x) AS (
+    SELECT 1 UNION ALL SELECT x + 1 FROM counter WHERE x < 1000
+)
+SELECT count(*) FROM counter
+"""
+
+
+@pytest.fixture  # type: ignore[misc]
+def interruptible() -> Generator[sqlite3.Connection, None, None]:
+    con = sqlite3.connect(":memory:")
+    set_progress_handler(con, 100)
+    try:
+        yield con
+    finally:
+        con.close()
+
+
+@sqlite_udf
+def spin(n: int) -> int:
+    i = 0
+    while i < n:
+        check_interrupt()
+        i += 1
+    return i
+
+
+@sqlite_udaf
+@jitclass
+class SpinSum:
+    total: int
+
+    def __init__(self) -> None:
+        self.total = 0
+
+    def step(self, n: int) -> None:
+        for _ in range(n):
+            check_interrupt()
+            self.total += 1
+
+    def finalize(self) -> Optional[int]:
+        return self.total
+
+
+def test_cancel(interruptible: sqlite3.Connection) -> None:
+    state = interrupt_state(interruptible)
+    state.cancel()
+    assert state.is_interrupted()
+    with pytest.raises(sqlite3.OperationalError, match="interrupted"):
+        interruptible.execute(COUNT).fetchall()
+
+    state.reset()
+    assert not state.is_interrupted()
+    assert interruptible.execute(COUNT).fetchall() == [(1000,)]
+
+
+def test_cancel_from_another_thread(interruptible: sqlite3.Connection) -> None:
+    timer = threading.Timer(0.1, interrupt_state(interruptible).cancel)
+    timer.start()
+    try:
+        with pytest.raises(sqlite3.OperationalError, match="interrupted"):
+            interruptible.execute(FOREVER).fetchall()
+    finally:
+        timer.join()
+
+
+def test_deadline(interruptible: sqlite3.Connection) -> None:
+    state = interrupt_state(interruptible)
+    with pytest.raises(sqlite3.OperationalError, match="interrupted"):
+        with state.deadline(0.1):
+            interruptible.execute(FOREVER).fetchall()
+
+    assert not state.is_interrupted()
+    with state.deadline(60):
+        assert interruptible.execute(COUNT).fetchall() == [(1000,)]
+
+
+def test_remove_progress_handler(interruptible: sqlite3.Connection) -> None:
+    set_progress_handler(interruptible, 0).cancel()
+    assert interruptible.execute(COUNT).fetchall() == [(1000,)]
+
+
+def test_cancel_one_connection(interruptible: sqlite3.Connection) -> None:
+    other = sqlite3.connect(":memory:")
+    try:
+        other_state = set_progress_handler(other, 100)
+        assert other_state is not interrupt_state(interruptible)
+        create_function(other, "spin", 1, spin)
+
+        interrupt_state(interruptible).cancel()
+        with pytest.raises(sqlite3.OperationalError, match="interrupted"):
+            interruptible.execute(COUNT).fetchall()
+        assert other.execute(COUNT).fetchall() == [(1000,)]
+        assert other.execute("SELECT spin(10)").fetchall() == [(10,)]
+    finally:
+        other.close()
+
+
+def test_shared_state() -> None:
+    state = InterruptState()
+    cons = [sqlite3.connect(":memory:") for _ in range(2)]
+    try:
+        for con in cons:
+            assert set_progress_handler(con, 100, state=state) is state
+        state.cancel()
+        for con in cons:
+            with pytest.raises(sqlite3.OperationalError, match="interrupted"):
+                con.execute(COUNT).fetchall()
+    finally:
+        for con in cons:
+            con.close()
+
+
+def test_closed_connections_release_their_state() -> None:
+    con = sqlite3.connect(":memory:")
+    state = interrupt_state(con)
+    state.cancel()
+    con.close()
+
+    # even if the next connection gets the same handle
+    con = sqlite3.connect(":memory:")
+    try:
+        assert interrupt_state(con) is not state
+        assert not interrupt_state(con).is_interrupted()
+    finally:
+        con.close()
+
+
+def test_replace_state_after_registering() -> None:
+    con = sqlite3.connect(":memory:")
+    try:
+        first = set_progress_handler(con, 100)
+        create_function(con, "spin", 1, spin)
+        create_aggregate(con, "spinsum", 1, SpinSum)
+        second = InterruptState()
+        assert set_progress_handler(con, 100, state=second) is second
+        # registering again doesn't free the state the others point to
+        create_function(con, "spin", 1, spin)
+        third = InterruptState()
+        assert interrupt_state(con, third) is third
+        del first, second
+        assert con.execute("SELECT spin(10), spinsum(3)").fetchall() == [(10, 3)]
+
+        third.cancel()
+        with pytest.raises(sqlite3.OperationalError, match="interrupted"):
+            con.execute("SELECT spin(10)").fetchall()
+        with pytest.raises(sqlite3.OperationalError, match="interrupted"):
+            con.execute(COUNT).fetchall()
+        third.reset()
+        assert con.execute("SELECT spin(10), spinsum(3)").fetchall() == [(10, 3)]
+    finally:
+        con.close()
+
+
+def test_state_is_not_a_function() -> None:
+    con = sqlite3.connect(":memory:")
+    try:
+        create_function(con, "spin", 1, spin)
+        with pytest.raises(sqlite3.OperationalError, match="no such function"):
+            con.execute("SELECT numbsql_interrupted()").fetchall()
+    finally:
+        con.close()
+
+
+def test_check_interrupt_in_udf() -> None:
+    # without a progress handler, only the function can stop the query
+    con = sqlite3.connect(":memory:")
+    create_function(con, "spin", 1, spin)
+    assert con.execute("SELECT spin(10)").fetchall() == [(10,)]
+
+    timer = threading.Timer(0.1, interrupt_state(con).cancel)
+    timer.start()
+    try:
+        with pytest.raises(sqlite3.OperationalError, match="^interrupted$"):
+            con.execute("SELECT spin(9223372036854775807)").fetchall()
+    finally:
+        timer.join()
+
+
+def test_check_interrupt_in_udaf() -> None:
+    con = sqlite3.connect(":memory:")
+    create_aggregate(con, "spinsum", 1, SpinSum)
+    assert con.execute("SELECT spinsum(3)").fetchall() == [(3,)]
+
+    with pytest.raises(sqlite3.OperationalError, match="^interrupted$"):
+        with interrupt_state(con).deadline(0.1):
+            con.execute("SELECT spinsum(9223372036854775807)").fetchall()
+
+
+@njit(nogil=True)  # type: ignore[misc, untyped-decorator]
+def _count_up(n: int) -> int:
+    i = 0
+    while i < n:
+        check_interrupt()
+        i += 1
+    return i
+
+
+@sqlite_udf
+def spin_in_helper(n: int) -> int:
+    return _count_up(n)
+
+
+def test_check_interrupt_in_helper() -> None:
+    con = sqlite3.connect(":memory:")
+    create_function(con, "spin_in_helper", 1, spin_in_helper)
+    assert con.execute("SELECT spin_in_helper(10)").fetchall() == [(10,)]
+
+    with pytest.raises(sqlite3.OperationalError, match="^interrupted$"):
+        with interrupt_state(con).deadline(0.1):
+            con.execute("SELECT spin_in_helper(9223372036854775807)").fetchall()
+
+
+@sqlite_udf
+def add_one(n: int) -> int:
+    return n + 1
+
+
+def test_only_functions_that_check_read_the_state() -> None:
+    con = sqlite3.connect(":memory:")
+    create_function(con, "spin", 1, spin)
+    create_function(con, "add_one", 1, add_one)
+    assert con.execute("SELECT spin(1), add_one(1)").fetchall() == [(1, 2)]
+    # functions that never check don't publish the state on every call
+    checking = spin.scalar.inspect_llvm()  # type: ignore[attr-defined]
+    assert "pthread_setspecific" in checking
+    plain = add_one.scalar.inspect_llvm()  # type: ignore[attr-defined]
+    assert "pthread_setspecific" not in plain
+
+
+def test_check_interrupt_in_python() -> None:
+    # there's no connection to check
+    check_interrupt()
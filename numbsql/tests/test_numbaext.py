@@ -4,6 +4,7 @@ import os
 import pytest
 from numba import TypingError, boolean, int64, njit
 
+from numbsql import numbaext
 from numbsql.numbaext import is_not_null_pointer, sizeof, unsafe_cast
 
 ExceptionType = (
@@ -14,7 +15,7 @@ ExceptionType = (
 def test_sizeof_invalid() -> None:
     with pytest.raises(ExceptionType):
 
-        @njit(int64(int64))  # type: ignore[misc]
+        @njit(int64(int64))  # type: ignore[misc, untyped-decorator]
         def bad_sizeof(x: int) -> int:  # pragma: no cover
             return sizeof(x)
 
@@ -25,7 +26,7 @@ def test_sizeof_invalid() -> None:
 def test_is_null_invalid() -> None:
     with pytest.raises(ExceptionType):
 
-        @njit(boolean(int64))  # type: ignore[misc]
+        @njit(boolean(int64))  # type: ignore[misc, untyped-decorator]
         def bad_is_null_pointer(x: int) -> bool:  # pragma: no cover
             return is_not_null_pointer(x)
 
@@ -33,6 +34,15 @@ def test_is_null_invalid() -> None:
 def test_unsafe_case_invalid() -> None:
     with pytest.raises(ExceptionType):
 
-        @njit(int64(int64))  # type: ignore[misc]
+        @njit(int64(int64))  # type: ignore[misc, untyped-decorator]
         def bad_unsafe_cast(x: int) -> int:  # pragma: no cover
             return unsafe_cast(x, int64)
+
+
+def test_meminfo_layout_is_verified() -> None:
+    assert numbaext._meminfo_layout_is_verified()
+
+
+def test_unverified_numba_versions(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(numbaext.numba, "__version__", "0.99.0")
+    assert not numbaext._meminfo_layout_is_verified()
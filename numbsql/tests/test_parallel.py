@@ -0,0 +1,335 @@
+from __future__ import annotations
+
+import sqlite3
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import numpy as np
+import pytest
+from numba import types
+from numba.experimental import jitclass
+
+from numbsql import (
+    aggregate_partitions,
+    parallel_aggregate,
+    parallel_execute,
+    sqlite_udaf,
+    sqlite_udf,
+)
+from numbsql.exceptions import MissingAggregateMethod
+from numbsql.interrupt import InterruptState
+from numbsql.parallel import concatenate, rowid_predicates
+
+
+@sqlite_udf
+def square(x: int) -> int:
+    return x * x
+
+
+@sqlite_udaf
+@jitclass
+class SumSquares:
+    total: int
+
+    def __init__(self) -> None:
+        self.total = 0
+
+    def step(self, value: int) -> None:
+        self.total += value * value
+
+    def merge(self, other: SumSquares) -> None:
+        self.total += other.total
+
+    def finalize(self) -> int:
+        return self.total
+
+
+@sqlite_udaf
+@jitclass
+class Histogram:
+    counts: types.NestedArray(types.int64, (4,))  # type: ignore[valid-type]
+
+    def __init__(self) -> None:
+        self.counts[:] = 0
+
+    def step(self, value: int) -> None:
+        self.counts[value % 4] += 1
+
+    def merge(self, other: Histogram) -> None:
+        self.counts += other.counts
+
+    def finalize(self) -> int:
+        # the counts as the digits of a number
+        return (
+            self.counts[0] * 1_000_000
+            + self.counts[1] * 10_000
+            + self.counts[2] * 100
+            + self.counts[3]
+        )
+
+
+@sqlite_udaf
+@jitclass
+class WeightedSum:
+    total: float
+
+    def __init__(self) -> None:
+        self.total = 0.0
+
+    def step(self, value: float, weight: int) -> None:
+        self.total += value * weight
+
+    def finalize(self) -> float:
+        return self.total
+
+
+@sqlite_udaf
+@jitclass
+class Longest:
+    longest: str
+
+    def __init__(self) -> None:
+        self.longest = ""
+
+    def step(self, value: str) -> None:
+        if len(value) > len(self.longest):
+            self.longest = value
+
+    def merge(self, other: Longest) -> None:
+        self.step(other.longest)
+
+    def finalize(self) -> Optional[str]:
+        return self.longest
+
+
+@pytest.fixture(scope="module")  # type: ignore[misc]
+def database(tmp_path_factory: pytest.TempPathFactory) -> Path:
+    path = tmp_path_factory.mktemp("parallel") / "numbers.db"
+    con = sqlite3.connect(path)
+    con.execute("CREATE TABLE numbers (x INTEGER, parity TEXT)")
+    con.execute("CREATE TABLE empty (x INTEGER)")
+    con.executemany(
+        "INSERT INTO numbers VALUES (?, ?)",
+        [(x, "odd" if x % 2 else "even") for x in range(1000)],
+    )
+    con.commit()
+    con.close()
+    return path
+
+
+def test_rows_are_concatenated_in_rowid_order(database: Path) -> None:
+    assert parallel_execute(
+        database,
+        "SELECT square(x) FROM numbers WHERE x % 3 = ?",
+        (0,),
+        table="numbers",
+        functions=[square],
+        partitions=7,
+        combine=concatenate,
+    ) == [(x * x,) for x in range(0, 1000, 3)]
+
+
+def sum_first_column(results: List[List[Tuple[int]]]) -> List[Tuple[int]]:
+    return [(sum(rows[0][0] for rows in results),)]
+
+
+def test_aggregate(database: Path) -> None:
+    assert parallel_execute(
+        database,
+        "SELECT sum_squares(x) FROM numbers",
+        table="numbers",
+        functions={"sum_squares": SumSquares},
+        partitions=4,
+        combine=sum_first_column,
+    ) == [(sum(x * x for x in range(1000)),)]
+
+
+def test_predicates(database: Path) -> None:
+    result = parallel_execute(
+        database,
+        "SELECT parity, sum_squares(x) FROM numbers GROUP BY parity",
+        table="numbers",
+        functions={"sum_squares": SumSquares},
+        predicates=["parity = 'even'", "parity = 'odd'"],
+        # each partition is a group
+        combine=concatenate,
+    )
+    assert result == [
+        ("even", sum(x * x for x in range(0, 1000, 2))),
+        ("odd", sum(x * x for x in range(1, 1000, 2))),
+    ]
+
+
+def test_empty_table(database: Path) -> None:
+    assert parallel_execute(
+        database,
+        "SELECT sum_squares(x) FROM empty",
+        table="empty",
+        functions={"sum_squares": SumSquares},
+        combine=concatenate,
+    ) == [(None,)]
+
+
+def test_cancel(database: Path) -> None:
+    interrupt = InterruptState()
+    interrupt.cancel()
+    with pytest.raises(sqlite3.OperationalError, match="interrupted"):
+        parallel_execute(
+            database,
+            "SELECT * FROM numbers",
+            table="numbers",
+            combine=concatenate,
+            interrupt=interrupt,
+        )
+
+
+@pytest.mark.parametrize(  # type: ignore[misc]
+    ("partitions", "expected"),
+    [
+        (1, ["rowid BETWEEN 1 AND 10"]),
+        (
+            3,
+            [
+                "rowid BETWEEN 1 AND 4",
+                "rowid BETWEEN 5 AND 8",
+                "rowid BETWEEN 9 AND 10",
+            ],
+        ),
+        (20, [f"rowid BETWEEN {i} AND {i}" for i in range(1, 11)]),
+    ],
+)
+def test_rowid_predicates(partitions: int, expected: List[str]) -> None:
+    con = sqlite3.connect(":memory:")
+    con.execute("CREATE TABLE t (x INTEGER)")
+    con.executemany("INSERT INTO t VALUES (?)", [(x,) for x in range(10)])
+    assert rowid_predicates(con, "t", partitions) == expected
+    con.close()
+
+
+def test_rowid_predicates_of_tables_without_rowids() -> None:
+    con = sqlite3.connect(":memory:")
+    con.execute("CREATE TABLE t (x INTEGER PRIMARY KEY) WITHOUT ROWID")
+    con.execute("CREATE VIEW v AS SELECT x FROM t")
+    with pytest.raises(ValueError, match="WITHOUT ROWID table"):
+        rowid_predicates(con, "t", 2)
+    with pytest.raises(ValueError, match="is a view"):
+        rowid_predicates(con, "v", 2)
+    con.close()
+
+
+@pytest.mark.parametrize("partitions", [0, -1])  # type: ignore[misc]
+def test_partitions_must_be_positive(database: Path, partitions: int) -> None:
+    with pytest.raises(ValueError, match="at least 1"):
+        parallel_execute(
+            database,
+            "SELECT * FROM numbers",
+            table="numbers",
+            combine=concatenate,
+            partitions=partitions,
+        )
+
+
+def test_predicates_must_not_be_empty(database: Path) -> None:
+    with pytest.raises(ValueError, match="at least one predicate"):
+        parallel_execute(
+            database,
+            "SELECT * FROM numbers",
+            table="numbers",
+            combine=concatenate,
+            predicates=[],
+        )
+
+
+def test_missing_database(tmp_path: Path) -> None:
+    with pytest.raises(sqlite3.OperationalError):
+        parallel_execute(
+            tmp_path / "missing.db", "SELECT 1", table="t", combine=concatenate
+        )
+
+
+@pytest.mark.parametrize("num_partitions", [1, 3, 8])  # type: ignore[misc]
+def test_aggregate_partitions(num_partitions: int) -> None:
+    values = np.arange(1000)
+    partitions = [(part,) for part in np.array_split(values, num_partitions)]
+    assert aggregate_partitions(SumSquares, partitions, threads=2) == int(
+        (values * values).sum()
+    )
+
+
+def test_aggregate_partitions_of_lists() -> None:
+    assert aggregate_partitions(SumSquares, [([1, 2],), ([],), ([3],)]) == 14
+
+
+def test_aggregate_partitions_with_fixed_size_arrays() -> None:
+    partitions = [(np.arange(10),), (np.arange(0),), (np.arange(10, 15),)]
+    assert aggregate_partitions(Histogram, partitions) == 4_04_04_03
+
+
+def test_aggregate_partitions_requires_merge() -> None:
+    with pytest.raises(MissingAggregateMethod, match="`merge`"):
+        aggregate_partitions(WeightedSum, [([1.0], [2])])
+
+
+def test_aggregate_partitions_requires_partitions() -> None:
+    with pytest.raises(ValueError, match="at least one partition"):
+        aggregate_partitions(SumSquares, [])
+
+
+@pytest.mark.parametrize("partitions", [1, 3, 8])  # type: ignore[misc]
+def test_parallel_aggregate(database: Path, partitions: int) -> None:
+    assert parallel_aggregate(
+        database, SumSquares, ["x"], table="numbers", partitions=partitions
+    ) == [(sum(x * x for x in range(1000)),)]
+
+
+def test_parallel_aggregate_groups(database: Path) -> None:
+    result = parallel_aggregate(
+        database,
+        SumSquares,
+        ["x + ?"],
+        (10, 1, 990),
+        table="numbers",
+        group_by=["parity", "x > ?"],
+        where="x < ?",
+        partitions=4,
+    )
+    expected = {
+        (parity, int(x > 10)): 0 for x in range(990) for parity in ["even", "odd"]
+    }
+    for x in range(990):
+        expected["odd" if x % 2 else "even", int(x > 10)] += (x + 1) ** 2
+    assert sorted(result) == sorted((*key, total) for key, total in expected.items())
+
+
+def test_parallel_aggregate_with_fixed_size_arrays(database: Path) -> None:
+    assert parallel_aggregate(
+        database, Histogram, ["x"], table="numbers", group_by=["parity"], partitions=3
+    ) == [("even", 250_025_000), ("odd", 2_500_250)]
+
+
+def test_parallel_aggregate_with_heap_fields(database: Path) -> None:
+    assert parallel_aggregate(
+        database,
+        Longest,
+        ["printf('%.*c', x % 17, 'a')"],
+        table="numbers",
+        group_by=["parity"],
+        partitions=5,
+    ) == [("even", "a" * 16), ("odd", "a" * 16)]
+
+
+def test_parallel_aggregate_of_an_empty_table(database: Path) -> None:
+    assert parallel_aggregate(
+        database, SumSquares, ["x"], table="empty", partitions=3
+    ) == [(None,)]
+    assert (
+        parallel_aggregate(
+            database, SumSquares, ["x"], table="empty", group_by=["x"], partitions=3
+        )
+        == []
+    )
+
+
+def test_parallel_aggregate_requires_merge(database: Path) -> None:
+    with pytest.raises(MissingAggregateMethod, match="`merge`"):
+        parallel_aggregate(database, WeightedSum, ["x", "1"], table="numbers")
@@ -1,12 +1,27 @@
 from __future__ import annotations
 
+import concurrent.futures
 import sqlite3
-from typing import Callable, List, Optional, Tuple, TypeVar
+from typing import (
+    Annotated,
+    Callable,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    TypeVar,
+    Union,
+)
 
+import numpy as np
 import pytest
+from numba.core.errors import TypingError
+from numba.core.runtime import _nrt_python as nrt
+from numba.core.runtime import rtsys
+from numpy.typing import NDArray
 from pytest_benchmark.fixture import BenchmarkFixture
 
-from numbsql import create_function, sqlite_udf
+from numbsql import create_function, numbaext, sqlite_udf, unpacker
 
 
 def add_one_python(x: float) -> float:
@@ -185,7 +200,7 @@ def test_scalar_with_valid_nulls(
 )
 def test_scalar_with_invalid_nulls(con: sqlite3.Connection, expr: str) -> None:
     query = f"SELECT {expr} FROM null_t"
-    with pytest.raises(ValueError):
+    with pytest.raises(sqlite3.OperationalError, match="unexpected NULL"):
         con.execute(query).fetchall()
 
 
@@ -206,7 +221,7 @@ def test_string_null_scalar(con: sqlite3.Connection) -> None:
 
 def test_string_null_scalar_no_opt_null(con: sqlite3.Connection) -> None:
     query = "SELECT string_len_numba_no_opt(NULL)"
-    with pytest.raises(ValueError):
+    with pytest.raises(sqlite3.OperationalError, match="unexpected NULL"):
         con.execute(query)
 
 
@@ -227,6 +242,30 @@ def test_string_single_upper(con: sqlite3.Connection) -> None:
     assert test == expected
 
 
+@pytest.mark.parametrize("value", ["abc", "héllo", "日本語", "a😀b", "", "a\x00b"])
+def test_string_unicode(value: str) -> None:
+    con = sqlite3.connect(":memory:")
+    create_function(con, "string_len_numba", 1, string_len_numba)
+    create_function(con, "string_upper_numba", 1, string_upper_numba)
+    create_function(con, "string_identity_numba", 1, string_identity_numba)
+    assert con.execute(
+        "SELECT string_len_numba(?), string_upper_numba(?), string_identity_numba(?)",
+        (value, value, value),
+    ).fetchall() == [(len(value), value.upper(), value)]
+
+
+def test_string_invalid_utf8() -> None:
+    con = sqlite3.connect(":memory:")
+    create_function(con, "string_len_numba", 1, string_len_numba)
+    create_function(con, "string_identity_numba", 1, string_identity_numba)
+    assert con.execute(
+        """
+        SELECT string_len_numba(x), string_identity_numba(x)
+        FROM (SELECT CAST(X'61FF62E282' AS TEXT) AS x)
+        """
+    ).fetchall() == [(5, "a\ufffdb\ufffd\ufffd")]
+
+
 def run_scalar(con: sqlite3.Connection, expr: str) -> List[Tuple[Optional[float]]]:
     return con.execute(f"SELECT {expr} FROM large_t").fetchall()
 
@@ -270,3 +309,595 @@ def test_string_upper_scalar_bench(
     large_con: sqlite3.Connection, benchmark: BenchmarkFixture, expr: str
 ) -> None:
     assert benchmark(run_scalar, large_con, expr)
+
+
+def run_scalar_in_threads(
+    path: str, num_threads: int, expr: str
+) -> List[List[Tuple[Optional[float]]]]:
+    # every thread runs the whole query on a connection of its own, so
+    # perfect scaling takes as long as a single thread
+    def run(_: int) -> List[Tuple[Optional[float]]]:
+        con = sqlite3.connect(path)
+        try:
+            register_udfs(con)
+            return run_scalar(con, expr)
+        finally:
+            con.close()
+
+    with concurrent.futures.ThreadPoolExecutor(num_threads) as executor:
+        return list(executor.map(run, range(num_threads)))
+
+
+@pytest.mark.parametrize("num_threads", [1, 2, 4])  # type: ignore[misc]
+@pytest.mark.parametrize(  # type: ignore[misc]
+    "expr",
+    [
+        # aggregate in SQLite, so that each query is a single step that the
+        # sqlite3 module runs without the GIL, rather than many rows that
+        # it converts to Python objects with it
+        pytest.param("sum(add_one_optional_numba(value))", id="add_one_optional_numba"),
+        pytest.param(
+            "sum(add_one_optional_python(value))", id="add_one_optional_python"
+        ),
+    ],
+)
+def test_threads_bench(
+    large_con: sqlite3.Connection,
+    benchmark: BenchmarkFixture,
+    expr: str,
+    num_threads: int,
+) -> None:
+    _, _, path = large_con.execute("PRAGMA database_list").fetchone()
+    results = benchmark(run_scalar_in_threads, path, num_threads, expr)
+    assert len(results) == num_threads
+    assert all(result == results[0] for result in results)
+
+
+def test_lazy_function_is_compiled_on_registration() -> None:
+    @sqlite_udf(lazy=True)
+    def add_two(x: int) -> int:  # pragma: no cover
+        return x + 2
+
+    assert not hasattr(add_two, "scalar")
+
+    con = sqlite3.connect(":memory:")
+    create_function(con, "add_two", 1, add_two)
+    assert con.execute("SELECT add_two(1)").fetchall() == [(3,)]
+    con.close()
+
+
+def test_union_dispatches_on_storage_class() -> None:
+    @sqlite_udf
+    def plus_one(x: Optional[Union[int, float]]) -> Optional[Union[int, float]]:
+        return x + 1 if x is not None else None
+
+    con = sqlite3.connect(":memory:")
+    create_function(con, "plus_one", 1, plus_one)
+    result = con.execute(
+        "SELECT plus_one(9007199254740993), plus_one(1.5), plus_one(NULL)"
+    ).fetchall()
+    assert result == [(9007199254740994, 2.5, None)]
+    assert isinstance(result[0][0], int)
+
+    # values of other storage classes are converted to the first type
+    assert con.execute("SELECT plus_one('2')").fetchall() == [(3,)]
+    con.close()
+
+
+def test_union_specializations_per_argument() -> None:
+    @sqlite_udf
+    def kind(x: Union[int, float, str], y: Union[int, str]) -> str:
+        if isinstance(x, int):
+            a = "int"
+        elif isinstance(x, float):
+            a = "float"
+        else:
+            a = "str"
+        if isinstance(y, int):
+            return a + ",int"
+        return a + ",str"
+
+    con = sqlite3.connect(":memory:")
+    create_function(con, "kind", 2, kind)
+    assert con.execute(
+        "SELECT kind(1, 1), kind(1.0, 'a'), kind('a', 2)"
+    ).fetchall() == [("int,int", "float,str", "str,int")]
+    con.close()
+
+
+def test_union_return_type_must_match() -> None:
+    def half(x: Union[int, float]) -> Union[int, str]:
+        return x / 2  # type: ignore[return-value]
+
+    with pytest.raises(TypeError, match="returns `float64`"):
+        sqlite_udf(half)
+
+
+def test_narrow_types() -> None:
+    @sqlite_udf
+    def negate(x: bool) -> bool:
+        return not x
+
+    @sqlite_udf
+    def int8_identity(x: np.int8) -> np.int8:
+        return x
+
+    @sqlite_udf
+    def uint8_identity(x: np.uint8) -> np.uint8:
+        return x
+
+    @sqlite_udf
+    def uint64_identity(x: np.uint64) -> np.uint64:
+        return x
+
+    @sqlite_udf
+    def float32_double(x: Optional[np.float32]) -> Optional[np.float32]:
+        return x * np.float32(2) if x is not None else None
+
+    con = sqlite3.connect(":memory:")
+    create_function(con, "negate", 1, negate)
+    create_function(con, "int8_identity", 1, int8_identity)
+    create_function(con, "uint8_identity", 1, uint8_identity)
+    create_function(con, "uint64_identity", 1, uint64_identity)
+    create_function(con, "float32_double", 1, float32_double)
+    assert con.execute(
+        """
+        SELECT
+            negate(0),
+            negate(5),
+            int8_identity(-128),
+            int8_identity(128),
+            uint8_identity(255),
+            uint8_identity(-1),
+            float32_double(0.5),
+            float32_double(NULL)
+        """
+    ).fetchall() == [(1, 0, -128, -128, 255, 255, 1.0, None)]
+
+    # too large for SQLite's integers
+    ((large, roundtrip, small),) = con.execute(
+        """
+        SELECT
+            uint64_identity(-1),
+            uint64_identity(uint64_identity(-1)),
+            uint64_identity(9223372036854775807)
+        """
+    ).fetchall()
+    assert large == roundtrip == float(2**64 - 1)
+    assert small == 2**63 - 1
+
+
+def test_datetimes() -> None:
+    @sqlite_udf
+    def add_days(
+        t: np.datetime64, days: Annotated[np.timedelta64, "D"]
+    ) -> np.datetime64:
+        return t + days
+
+    @sqlite_udf
+    def shift(
+        t: Optional[Annotated[np.datetime64, "s", "integer"]],
+        delta: Annotated[np.timedelta64, "ms"],
+    ) -> Optional[Annotated[np.datetime64, "ms", "real"]]:
+        return t + delta if t is not None else None
+
+    @sqlite_udf
+    def elapsed(
+        start: Annotated[np.datetime64, "s", "real"],
+        end: Annotated[np.datetime64, "s", "text"],
+    ) -> Annotated[np.timedelta64, "s", "real"]:
+        return end - start
+
+    con = sqlite3.connect(":memory:")
+    create_function(con, "add_days", 2, add_days)
+    create_function(con, "shift", 2, shift)
+    create_function(con, "elapsed", 2, elapsed)
+    assert con.execute(
+        """
+        SELECT
+            add_days('2024-02-28 12:30:00.25', 1),
+            add_days('2024-02-28T12:30Z', 2),
+            add_days('2024-02-28 12:30:00+01:00', 0),
+            add_days('not a datetime', 1),
+            shift(unixepoch('2024-01-01'), 43200000) = julianday('2024-01-01 12:00'),
+            shift(NULL, 0),
+            elapsed(julianday('2024-01-01'), '2024-01-02 06:00')
+        """
+    ).fetchall() == [
+        (
+            "2024-02-29 12:30:00.250000",
+            "2024-03-01 12:30:00.000000",
+            "2024-02-28 11:30:00.000000",
+            None,
+            1,
+            None,
+            1.25,
+        )
+    ]
+    con.close()
+
+
+def test_datetime_storage_must_exist() -> None:
+    def identity(
+        t: Annotated[np.timedelta64, "text"],
+    ) -> np.timedelta64:  # pragma: no cover
+        return t
+
+    with pytest.raises(TypeError, match="isn't a unit or storage"):
+        sqlite_udf(identity)
+
+
+def test_variadic() -> None:
+    @sqlite_udf
+    def greatest(*args: float) -> Optional[float]:
+        if not len(args):
+            return None
+        result = args[0]
+        for value in args:
+            result = max(result, value)
+        return result
+
+    @sqlite_udf
+    def coalesce_num(default: float, *values: Optional[float]) -> float:
+        for value in values:
+            if value is not None:
+                return value
+        return default
+
+    @sqlite_udf
+    def reverse_concat(*words: str) -> str:
+        result = ""
+        for i in range(len(words)):
+            result += words[-1 - i]
+        return result
+
+    con = sqlite3.connect(":memory:")
+    create_function(con, "greatest", -1, greatest)
+    create_function(con, "coalesce_num", -1, coalesce_num)
+    create_function(con, "reverse_concat", -1, reverse_concat)
+    assert con.execute(
+        """
+        SELECT
+            greatest(1, 5.5, 3),
+            greatest(2),
+            greatest(),
+            coalesce_num(0, NULL, NULL, 7, 8),
+            coalesce_num(9),
+            reverse_concat('a', 'bé', '日本')
+        """
+    ).fetchall() == [(5.5, 2.0, None, 7.0, 9.0, "日本béa")]
+    with pytest.raises(sqlite3.OperationalError, match=r"takes at least 1 argument$"):
+        con.execute("SELECT coalesce_num()").fetchall()
+    con.close()
+
+
+def test_variadic_arguments_must_have_a_single_type() -> None:
+    def first(*args: Union[int, str]) -> int:  # pragma: no cover
+        return 0
+
+    with pytest.raises(TypeError, match="must have a single type"):
+        sqlite_udf(first)
+
+
+def test_null_policy() -> None:
+    @sqlite_udf(null_policy="return_null")
+    def plus(x: int, y: int) -> int:
+        return x + y
+
+    @sqlite_udf(null_policy="return_null")
+    def total(*args: int) -> int:
+        result = 0
+        for value in args:
+            result += value
+        return result
+
+    con = sqlite3.connect(":memory:")
+    create_function(con, "plus", 2, plus)
+    create_function(con, "total", -1, total)
+    assert con.execute(
+        "SELECT plus(1, 2), plus(NULL, 2), plus(1, NULL), total(1, 2), total(1, NULL)"
+    ).fetchall() == [(3, None, None, 3, None)]
+    con.close()
+
+
+def test_variadic_null_error() -> None:
+    @sqlite_udf
+    def total(*args: int) -> int:
+        result = 0
+        for value in args:
+            result += value
+        return result
+
+    con = sqlite3.connect(":memory:")
+    create_function(con, "total", -1, total)
+    with pytest.raises(sqlite3.OperationalError, match="unexpected NULL"):
+        con.execute("SELECT total(1, NULL, 3)").fetchall()
+    con.close()
+
+
+def test_null_policy_must_exist() -> None:
+    def identity(x: int) -> int:  # pragma: no cover
+        return x
+
+    with pytest.raises(ValueError, match="isn't a NULL policy"):
+        sqlite_udf(identity, null_policy="skip_row")
+
+
+def test_exceptions_fail_the_query() -> None:
+    @sqlite_udf
+    def checked_sqrt(x: float) -> float:
+        if x < 0:
+            raise ValueError("negative")
+        return np.sqrt(x)
+
+    con = sqlite3.connect(":memory:")
+    create_function(con, "checked_sqrt", 1, checked_sqrt)
+    assert con.execute("SELECT checked_sqrt(4.0)").fetchall() == [(2.0,)]
+    with pytest.raises(
+        sqlite3.OperationalError, match="'checked_sqrt' raised an exception"
+    ):
+        con.execute("SELECT checked_sqrt(-1.0)").fetchall()
+    con.close()
+
+
+class Split(NamedTuple):
+    head: str
+    length: int
+    ratio: float
+    empty: bool
+
+
+def test_json_tuples() -> None:
+    @sqlite_udf
+    def split(value: str) -> Optional[Split]:
+        if not value:
+            return None
+        i = value.find(" ")
+        head = value if i < 0 else value[:i]
+        return Split(head, len(value), len(head) / len(value), not head)
+
+    @sqlite_udf
+    def bounds(x: float) -> Tuple[Optional[int], Tuple[float, str]]:
+        return None if x < 0 else int(x), (x, 'say "hé"\n')
+
+    con = sqlite3.connect(":memory:")
+    create_function(con, "split", 1, split)
+    create_function(con, "bounds", 1, bounds)
+    assert con.execute(
+        """
+        SELECT
+            split('日本 language'),
+            split('x') ->> 'head',
+            split(''),
+            json_array(bounds(2.5)),
+            bounds(-1.0),
+            bounds(1e300) -> 1 ->> 0
+        """
+    ).fetchall() == [
+        (
+            '{"head":"日本","length":11,"ratio":0.18181818181818182,"empty":false}',
+            "x",
+            None,
+            '[[2,[2.5,"say \\"hé\\"\\n"]]]',
+            '[null,[-1.0,"say \\"hé\\"\\n"]]',
+            1e300,
+        )
+    ]
+    assert con.execute("SELECT key, value FROM json_each(split(' a'))").fetchall() == [
+        ("head", ""),
+        ("length", 2),
+        ("ratio", 0.0),
+        ("empty", 1),
+    ]
+    con.close()
+
+
+def test_packed_tuples() -> None:
+    @sqlite_udf
+    def stats(
+        values: NDArray[np.float64],
+    ) -> Annotated[Tuple[np.int32, float, bool], "blob"]:
+        return np.int32(len(values)), values.mean(), bool((values > 0).all())
+
+    con = sqlite3.connect(":memory:")
+    create_function(con, "stats", 1, stats)
+    create_function(con, "num_values", 1, unpacker(stats, 0))
+    create_function(con, "mean", 1, unpacker(stats, 1))
+    create_function(con, "positive", 1, unpacker(stats, "f2"))
+    data = np.array([1.0, 2.0, 4.5]).tobytes()
+    ((packed,),) = con.execute("SELECT stats(?)", (data,)).fetchall()
+    assert packed == np.int32(3).tobytes() + np.float64(2.5).tobytes() + b"\x01"
+    assert con.execute(
+        """
+        SELECT num_values(s), mean(s), positive(s), mean(NULL), mean(x'00')
+        FROM (SELECT stats(?) AS s)
+        """,
+        (data,),
+    ).fetchall() == [(3, 2.5, 1, None, None)]
+    con.close()
+
+
+def test_unpacker_requires_packed_tuples() -> None:
+    def pair(x: int) -> Tuple[int, int]:  # pragma: no cover
+        return x, x
+
+    def packed_pair(x: int) -> Annotated[Tuple[int, int], "blob"]:  # pragma: no cover
+        return x, x
+
+    with pytest.raises(TypeError, match="doesn't return tuples packed as BLOBs"):
+        unpacker(pair, 0)
+    with pytest.raises(TypeError, match="without a `total` field"):
+        unpacker(packed_pair, "total")
+    with pytest.raises(TypeError, match="without a field 2"):
+        unpacker(packed_pair, 2)
+    with pytest.raises(TypeError, match="without a field -1"):
+        unpacker(packed_pair, -1)
+
+
+def test_blob_arguments() -> None:
+    @sqlite_udf
+    def num_bytes(x: Optional[np.ndarray]) -> Optional[int]:
+        return x.size if x is not None else None
+
+    @sqlite_udf
+    def float_sum(x: NDArray[np.float32]) -> float:
+        return float(x.sum())
+
+    con = sqlite3.connect(":memory:")
+    create_function(con, "num_bytes", 1, num_bytes)
+    create_function(con, "float_sum", 1, float_sum)
+    blob = np.arange(5, dtype=np.float32).tobytes()
+    assert con.execute(
+        "SELECT num_bytes(?), num_bytes(NULL), num_bytes(x''), float_sum(?)",
+        (blob, blob),
+    ).fetchall() == [(20, None, 0, 10.0)]
+    con.close()
+
+
+def test_blob_arguments_are_read_only() -> None:
+    def clear(x: np.ndarray) -> int:  # pragma: no cover
+        x[0] = 0
+        return 0
+
+    with pytest.raises(TypingError, match="readonly"):
+        sqlite_udf(clear)
+
+
+def test_union_of_text_and_blob() -> None:
+    @sqlite_udf
+    def size(x: Union[str, np.ndarray]) -> int:
+        return len(x)
+
+    con = sqlite3.connect(":memory:")
+    create_function(con, "size", 1, size)
+    assert con.execute("SELECT size('abcd'), size(x'0102')").fetchall() == [(4, 2)]
+    con.close()
+
+
+def test_blob_results() -> None:
+    @sqlite_udf
+    def halves(n: int) -> NDArray[np.float64]:
+        return np.arange(n) / 2
+
+    @sqlite_udf
+    def evens(n: int) -> Optional[np.ndarray]:
+        return np.arange(n, dtype=np.int32)[::2] if n else None
+
+    @sqlite_udf
+    def reverse(x: bytes) -> bytes:
+        return x[::-1]
+
+    @sqlite_udf
+    def constant(n: int) -> bytes:
+        return b"abc"
+
+    con = sqlite3.connect(":memory:")
+    create_function(con, "halves", 1, halves)
+    create_function(con, "evens", 1, evens)
+    create_function(con, "reverse", 1, reverse)
+    create_function(con, "constant", 1, constant)
+    assert con.execute(
+        "SELECT halves(3), evens(5), evens(0), reverse(x'010203'), constant(1)"
+    ).fetchall() == [
+        (
+            (np.arange(3) / 2).tobytes(),
+            np.array([0, 2, 4], dtype=np.int32).tobytes(),
+            None,
+            b"\x03\x02\x01",
+            b"abc",
+        )
+    ]
+    con.close()
+
+
+def test_blob_results_are_not_copied() -> None:
+    @sqlite_udf
+    def ones(n: int) -> np.ndarray:
+        return np.ones(n, dtype=np.int32)
+
+    con = sqlite3.connect(":memory:")
+    create_function(con, "ones", 1, ones)
+    query = "SELECT ones(x) FROM (SELECT 3 AS x UNION ALL SELECT 4)"
+
+    nrt.memsys_enable_stats()
+    try:
+        before = rtsys.get_allocation_stats()
+        cur = con.execute(query)
+        assert cur.fetchone() == (np.ones(3, dtype=np.int32).tobytes(),)
+        # SQLite holds on to the array in the current row
+        during = rtsys.get_allocation_stats()
+        assert during.alloc - before.alloc == 2
+        assert during.free - before.free == 1
+
+        cur.close()
+        after = rtsys.get_allocation_stats()
+        assert after.free - before.free == 2
+    finally:
+        nrt.memsys_disable_stats()
+        con.close()
+
+
+def test_results_are_copied_without_a_verified_meminfo_layout(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(numbaext, "_ZERO_COPY_RESULTS", False)
+
+    # numba reuses the code setting results of a type once it's compiled, so
+    # use a dtype no other test returns
+    @sqlite_udf
+    def copied_ones(n: int) -> np.ndarray:
+        return np.ones(n, dtype=np.uint16)
+
+    con = sqlite3.connect(":memory:")
+    create_function(con, "copied_ones", 1, copied_ones)
+
+    nrt.memsys_enable_stats()
+    try:
+        before = rtsys.get_allocation_stats()
+        cur = con.execute("SELECT copied_ones(3)")
+        assert cur.fetchone() == (np.ones(3, dtype=np.uint16).tobytes(),)
+        # SQLite copied the array, which was released right away
+        during = rtsys.get_allocation_stats()
+        assert during.alloc - before.alloc == 1
+        assert during.free - before.free == 1
+        cur.close()
+    finally:
+        nrt.memsys_disable_stats()
+        con.close()
+
+
+def test_text_results_are_not_copied() -> None:
+    @sqlite_udf
+    def repeat(n: int) -> str:
+        return "ab" * n if n > 1 else "constant"
+
+    con = sqlite3.connect(":memory:")
+    create_function(con, "repeat", 1, repeat)
+    query = "SELECT repeat(x) FROM (SELECT 1 AS x UNION ALL SELECT 2)"
+
+    nrt.memsys_enable_stats()
+    try:
+        before = rtsys.get_allocation_stats()
+        cur = con.execute(query)
+        assert cur.fetchone() == ("constant",)
+        # SQLite copies the constant, and holds on to the string in the
+        # current row
+        during = rtsys.get_allocation_stats()
+        assert during.alloc - before.alloc == 1
+        assert during.free - before.free == 0
+
+        assert cur.fetchone() == ("abab",)
+        cur.close()
+        after = rtsys.get_allocation_stats()
+        assert after.free - before.free == 1
+    finally:
+        nrt.memsys_disable_stats()
+        con.close()
+
+
+def test_blob_result_dtype_must_match() -> None:
+    def halves(n: int) -> NDArray[np.float32]:  # pragma: no cover
+        return np.arange(n) / 2  # type: ignore[return-value]
+
+    with pytest.raises(TypeError, match="returns `array\\(float64"):
+        sqlite_udf(halves)
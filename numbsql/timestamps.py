@@ -0,0 +1,319 @@
+"""Conversions between NumPy's datetimes and timedeltas and SQLite values.
+
+SQLite has no date or time type. Its date and time functions work with text
+in ISO-8601 format, integer Unix timestamps and real Julian day numbers, so a
+`numpy.datetime64` type hint declares which of those a value is stored as,
+along with the unit of the value::
+
+    Annotated[np.datetime64, "s", "integer"]
+
+Datetimes are stored as ``"text"`` by default and timedeltas, which are
+counts of their unit or fractional days, as ``"integer"``. The default unit
+is microseconds.
+"""
+
+from __future__ import annotations
+
+import math
+import types as pytypes
+import typing
+from typing import Any, List, Optional, Tuple
+
+import numpy as np
+from numba import njit, types
+
+# the units that values can be declared with, and how many of each make a day
+UNITS_PER_DAY = {
+    "D": 1,
+    "h": 24,
+    "m": 24 * 60,
+    "s": 24 * 60 * 60,
+    "ms": 24 * 60 * 60 * 10**3,
+    "us": 24 * 60 * 60 * 10**6,
+    "ns": 24 * 60 * 60 * 10**9,
+}
+
+# the number of digits after the decimal point of seconds in text
+FRACTION_DIGITS = {"D": 0, "h": 0, "m": 0, "s": 0, "ms": 3, "us": 6, "ns": 9}
+
+DEFAULT_UNIT = "us"
+DATETIME_STORAGES: Tuple[str, ...] = ("text", "integer", "real")
+TIMEDELTA_STORAGES: Tuple[str, ...] = ("integer", "real")
+
+NANOSECONDS_PER_DAY = UNITS_PER_DAY["ns"]
+
+# the Julian day number of the Unix epoch
+UNIX_EPOCH_JULIAN_DAY = 2440587.5
+
+# NumPy's not-a-time
+NAT = np.iinfo(np.int64).min
+
+
+def datetime_type_hint(type_hint: Any) -> Optional[Tuple[types.Type, str]]:
+    """Return the numba type of a `numpy.datetime64` or `numpy.timedelta64`
+    type hint, and how its values are stored in SQLite.
+
+    Returns `None` for any other type hint.
+    """
+    metadata: List[Any] = []
+    if typing.get_origin(type_hint) is typing.Annotated:
+        type_hint, *metadata = typing.get_args(type_hint)
+
+    if type_hint is np.datetime64:
+        storages = DATETIME_STORAGES
+        numba_type: Any = types.NPDatetime
+    elif type_hint is np.timedelta64:
+        storages = TIMEDELTA_STORAGES
+        numba_type = types.NPTimedelta
+    else:
+        return None
+
+    unit = DEFAULT_UNIT
+    storage = storages[0]
+    for value in metadata:
+        if value in storages:
+            storage = value
+        elif value in UNITS_PER_DAY:
+            unit = value
+        else:
+            raise TypeError(
+                f"`{value!r}` isn't a unit or storage of `{type_hint.__name__}`, "
+                f"expected one of {list(UNITS_PER_DAY)} or {list(storages)}"
+            )
+    return numba_type(unit), storage
+
+
+def declared_storage(type_hint: Any) -> Optional[str]:
+    """Return how the datetime or timedelta values allowed by `type_hint`,
+    optional or not, are stored in SQLite.
+
+    Returns `None` if `type_hint` doesn't allow datetimes or timedeltas.
+    """
+    members: Tuple[Any, ...] = (type_hint,)
+    if typing.get_origin(type_hint) in (typing.Union, pytypes.UnionType):
+        members = typing.get_args(type_hint)
+    for member in members:
+        datetime_type = datetime_type_hint(member)
+        if datetime_type is not None:
+            _, storage = datetime_type
+            return storage
+    return None
+
+
+@njit(nogil=True)  # type: ignore[misc, untyped-decorator]
+def days_from_civil(year: int, month: int, day: int) -> int:
+    """Return the number of days from 1970-01-01 to a date of the proleptic
+    Gregorian calendar."""
+    year -= month <= 2
+    era = (year if year >= 0 else year - 399) // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * (month + (-3 if month > 2 else 9)) + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100
+    return era * 146097 + day_of_era + day_of_year - 719468
+
+
+@njit(nogil=True)  # type: ignore[misc, untyped-decorator]
+def civil_from_days(days: int) -> Tuple[int, int, int]:
+    """Return the year, month and day of the date `days` after 1970-01-01."""
+    days += 719468
+    era = (days if days >= 0 else days - 146096) // 146097
+    day_of_era = days - era * 146097
+    year_of_era = (
+        day_of_era - day_of_era // 1460 + day_of_era // 36524 - day_of_era // 146096
+    ) // 365
+    day_of_year = day_of_era - (
+        365 * year_of_era + year_of_era // 4 - year_of_era // 100
+    )
+    shifted_month = (5 * day_of_year + 2) // 153
+    day = day_of_year - (153 * shifted_month + 2) // 5 + 1
+    month = shifted_month + (3 if shifted_month < 10 else -9)
+    return year_of_era + era * 400 + (month <= 2), month, day
+
+
+@njit(nogil=True)  # type: ignore[misc, untyped-decorator]
+def parse_digits(data: np.ndarray, start: int, count: int) -> int:
+    """Parse `count` decimal digits of `data` starting at `start`.
+
+    Returns -1 if any of them isn't a digit or `data` is too short.
+    """
+    if start + count > len(data):
+        return -1
+    value = 0
+    for i in range(start, start + count):
+        digit = int(data[i]) - 0x30
+        if not 0 <= digit <= 9:
+            return -1
+        value = value * 10 + digit
+    return value
+
+
+@njit(nogil=True)  # type: ignore[misc, untyped-decorator]
+def parse_iso8601(data: np.ndarray, units_per_day: int) -> int:
+    """Parse the UTF-8 text `data` as an ISO-8601 date and time, and return
+    the number of units since the Unix epoch.
+
+    The text is formatted like SQLite's date and time functions expect it,
+    as ``YYYY-MM-DD``, optionally followed by ``HH:MM``, ``HH:MM:SS`` or
+    ``HH:MM:SS.SSS`` with any number of fractional digits and separated from
+    the date by a space or ``T``, and optionally followed by ``Z`` or a
+    ``+HH:MM`` or ``-HH:MM`` offset from UTC. Any other text is NaT.
+    Fractions of the unit are rounded down.
+    """
+    year = parse_digits(data, 0, 4)
+    month = parse_digits(data, 5, 2)
+    day = parse_digits(data, 8, 2)
+    if (
+        year < 0
+        or month < 1
+        or month > 12
+        or day < 1
+        or day > 31
+        or data[4] != 0x2D
+        or data[7] != 0x2D
+    ):
+        return NAT
+
+    n = len(data)
+    seconds = 0
+    nanoseconds = 0
+    i = 10
+    if i < n and (data[i] == 0x20 or data[i] == 0x54):
+        hours = parse_digits(data, i + 1, 2)
+        minutes = parse_digits(data, i + 4, 2)
+        if (
+            hours < 0
+            or hours > 24
+            or minutes < 0
+            or minutes > 59
+            or data[i + 3] != 0x3A
+        ):
+            return NAT
+        seconds = hours * 3600 + minutes * 60
+        i += 6
+        if i < n and data[i] == 0x3A:
+            whole_seconds = parse_digits(data, i + 1, 2)
+            if whole_seconds < 0 or whole_seconds > 60:
+                return NAT
+            seconds += whole_seconds
+            i += 3
+            if i < n and data[i] == 0x2E:
+                i += 1
+                scale = 10**8
+                start = i
+                while i < n and 0x30 <= data[i] <= 0x39:
+                    nanoseconds += (int(data[i]) - 0x30) * scale
+                    scale //= 10
+                    i += 1
+                if i == start:
+                    return NAT
+
+    if i < n and data[i] == 0x5A:
+        i += 1
+    elif i < n and (data[i] == 0x2B or data[i] == 0x2D):
+        offset_hours = parse_digits(data, i + 1, 2)
+        offset_minutes = parse_digits(data, i + 4, 2)
+        if offset_hours < 0 or offset_minutes < 0 or data[i + 3] != 0x3A:
+            return NAT
+        offset = offset_hours * 3600 + offset_minutes * 60
+        seconds -= offset if data[i] == 0x2B else -offset
+        i += 6
+    if i != n:
+        return NAT
+
+    days = days_from_civil(year, month, day)
+    nanoseconds_per_unit = NANOSECONDS_PER_DAY // units_per_day
+    return (
+        days * units_per_day + (seconds * 10**9 + nanoseconds) // nanoseconds_per_unit
+    )
+
+
+@njit(nogil=True)  # type: ignore[misc, untyped-decorator]
+def write_digits(result: np.ndarray, start: int, count: int, value: int) -> None:
+    """Write the last `count` decimal digits of `value` to `result`, starting
+    at `start`."""
+    for i in range(start + count - 1, start - 1, -1):
+        result[i] = 0x30 + value % 10
+        value //= 10
+
+
+@njit(nogil=True)  # type: ignore[misc, untyped-decorator]
+def format_iso8601(count: int, units_per_day: int, digits: int) -> np.ndarray:
+    """Format the datetime `count` units after the Unix epoch as UTF-8 text
+    in ISO-8601 format.
+
+    Dates are formatted as ``YYYY-MM-DD``, and anything else as
+    ``YYYY-MM-DD HH:MM:SS`` followed by `digits` fractional digits, which is
+    the format of SQLite's `datetime` function.
+    """
+    days = count // units_per_day
+    year, month, day = civil_from_days(days)
+    negative = int(year < 0)
+    year = abs(year)
+    year_digits = max(4, len(str(year)))
+    start = year_digits + negative
+
+    n = start + 6
+    if units_per_day > 1:
+        n += 9 + (digits + 1 if digits else 0)
+    result = np.empty(n, dtype=np.uint8)
+    if negative:
+        result[0] = 0x2D
+    write_digits(result, negative, year_digits, year)
+    result[start] = 0x2D
+    write_digits(result, start + 1, 2, month)
+    result[start + 3] = 0x2D
+    write_digits(result, start + 4, 2, day)
+
+    if units_per_day > 1:
+        nanoseconds = (count - days * units_per_day) * (
+            NANOSECONDS_PER_DAY // units_per_day
+        )
+        seconds = nanoseconds // 10**9
+        result[start + 6] = 0x20
+        write_digits(result, start + 7, 2, seconds // 3600)
+        result[start + 9] = 0x3A
+        write_digits(result, start + 10, 2, seconds // 60 % 60)
+        result[start + 12] = 0x3A
+        write_digits(result, start + 13, 2, seconds % 60)
+        if digits:
+            result[start + 15] = 0x2E
+            write_digits(
+                result,
+                start + 16,
+                digits,
+                nanoseconds % 10**9 // 10 ** (9 - digits),
+            )
+    return result
+
+
+@njit(nogil=True)  # type: ignore[misc, untyped-decorator]
+def from_days(days: float, units_per_day: int) -> int:
+    """Convert a number of days to the nearest whole number of units.
+
+    NaN and values out of the range of datetimes are NaT.
+    """
+    units = days * units_per_day + 0.5
+    if not -9.2e18 < units < 9.2e18:
+        return NAT
+    return math.floor(units)
+
+
+@njit(nogil=True)  # type: ignore[misc, untyped-decorator]
+def to_days(count: int, units_per_day: int) -> float:
+    """Convert a number of units to a number of days."""
+    return count / units_per_day
+
+
+@njit(nogil=True)  # type: ignore[misc, untyped-decorator]
+def from_julian_day(julian_day: float, units_per_day: int) -> int:
+    """Convert a Julian day number to the nearest number of units since the
+    Unix epoch."""
+    return from_days(julian_day - UNIX_EPOCH_JULIAN_DAY, units_per_day)
+
+
+@njit(nogil=True)  # type: ignore[misc, untyped-decorator]
+def to_julian_day(count: int, units_per_day: int) -> float:
+    """Convert a number of units since the Unix epoch to a Julian day
+    number."""
+    days = count // units_per_day
+    return days + (count - days * units_per_day) / units_per_day + UNIX_EPOCH_JULIAN_DAY